@@ -1,3 +1,4 @@
+from collections import OrderedDict
 from flask import Blueprint
 from flask import redirect
 from flask import render_template
@@ -5,11 +6,20 @@ from flask import request
 from flask import url_for
 from flask import session
 from flask import flash
-from bcrypt import hashpw
-from bcrypt import gensalt
+from flask import jsonify
+from flask import current_app
 from model import *
 from forms import AddSubjectForm, AddSpecializationForm, NewStudentForm, StudentEditForm, TeacherEditForm, SubjectEditForm, AdminLoginForm, NewTeacherForm
+from forms import ImportForm
 from forms import flash_errors
+from reports import grade_matrix, student_averages, teacher_grade_counts
+from instrumentation import get_metrics
+from passwords import get_verifier, hash_password
+from cache import identity_key, SUBJECT_CHOICES
+from invalidation import publish
+from pagination import paginate
+from versions import conditional_page
+from deletion import remove, is_scheduled, get_purger, not_scheduled
 from wrappers import guest_status_required, admin_required
 
 admin_blueprint = Blueprint('admin_blueprint', 'admin_blueprint')
@@ -47,7 +57,7 @@ def new_student():
                     last_name=form.last_name.data,
                     group=form.group.data,
                     username=form.username.data,
-                    password=hashpw(form.password.data.encode('utf-8'), gensalt())
+                    password=hash_password(form.password.data)
                 )
         except IntegrityError:
             flash('Username already taken')
@@ -60,19 +70,40 @@ def new_student():
     return render_template('new_student.html', form=form)
 
 
+@admin_blueprint.route('/import/<any(students, teachers):kind>/', methods=['GET', 'POST'])
+@admin_required
+def import_users(kind):
+    """Creates students or teachers from an uploaded CSV file, reporting rejected rows."""
+    form = ImportForm()
+    report = None
+    if form.validate_on_submit():
+        from importer import import_upload  # with its process pool, imported by the first import
+        report = import_upload(kind, form.file.data)
+        flash('{} {} imported, {} rows rejected.'.format(report.created, kind, report.rejected))
+    flash_errors(form)
+    return render_template('admin_import.html', form=form, kind=kind, report=report)
+
+
+def _remove(kind, object_id, name):
+    """Removes a record with everything referring to it; one with many grades in the background."""
+    if is_scheduled(kind, object_id):
+        flash(name + ' is already being removed.')
+    elif remove(kind, object_id, current_app.config['DELETE_IN_BACKGROUND_ABOVE']):
+        flash(name + ' deleted.')
+    else:
+        get_purger().wake()
+        flash(name + ' has many grades and is being removed in the background.')
+
+
 @admin_blueprint.route('/student_profile/<username>/', methods=['GET', 'POST'])
 @admin_required
 def student_profile(username):
     student = Student.get(Student.username == username)
     if request.method == 'POST':  # removing
-        with get_db().transaction():
-            if student.delete_instance(recursive=True):
-                flash(student.username + ' deleted.')
-                return redirect(url_for('admin_blueprint.admin_students'))
-            flash('Something went wrong.')
-    subjects = Subject.select()
-    grades = Grade.select().where(Grade.student == student)
-    return render_template('student_profile.html', student=student, subjects=subjects, grades=grades)
+        _remove('student', student.id, student.username)
+        return redirect(url_for('admin_blueprint.admin_students'))
+    return render_template('student_profile.html', student=student, grade_matrix=grade_matrix(student),
+                           averages=student_averages(student))
 
 
 @admin_blueprint.route('/student_profile/<username>/edit/', methods=['GET', 'POST'])
@@ -85,11 +116,13 @@ def student_edit(username):
             student.first_name = form.first_name.data
             student.last_name = form.last_name.data
             student.group = form.group.data
-            if student.save():
-                flash(student.username + ' edited.')
-                return redirect(url_for('admin_blueprint.admin_students'))
-            else:
-                flash('Something went wrong.')
+            saved = student.save()
+        if saved:
+            publish(identity_key('S', student.id))
+            flash(student.username + ' edited.')
+            return redirect(url_for('admin_blueprint.admin_students'))
+        else:
+            flash('Something went wrong.')
     flash_errors(form)
     return render_template('student_edit.html', student=student, form=form)
 
@@ -105,7 +138,7 @@ def new_teacher():
                     first_name=form.first_name.data,
                     last_name=form.last_name.data,
                     username=form.username.data,
-                    password=hashpw(form.password.data.encode('utf-8'), gensalt())
+                    password=hash_password(form.password.data)
                 )
         except IntegrityError:
             flash('Username already taken')
@@ -123,13 +156,11 @@ def new_teacher():
 def teacher_profile(username):
     teacher = Teacher.get(Teacher.username == username)
     if request.method == 'POST':
-        with get_db().transaction():
-            if teacher.delete_instance(recursive=True):
-                flash(teacher.username + ' deleted.')
-                return redirect(url_for('admin_blueprint.admin_teachers'))
-            flash('Something went wrong while trying to delete a record.')
-    specs = TeacherSubject.select().where(TeacherSubject.teacher == teacher)
-    return render_template('teacher_profile.html', teacher=teacher, specializations=specs)
+        _remove('teacher', teacher.id, teacher.username)
+        return redirect(url_for('admin_blueprint.admin_teachers'))
+    specs = TeacherSubject.select(TeacherSubject, Subject).join(Subject).where(TeacherSubject.teacher == teacher)
+    return render_template('teacher_profile.html', teacher=teacher, specializations=specs,
+                           grade_counts=teacher_grade_counts(teacher))
 
 
 @admin_blueprint.route('/teacher_profile/<username>/edit', methods=['GET', 'POST'])
@@ -142,6 +173,7 @@ def teacher_edit(username):
             teacher.first_name = form.first_name.data
             teacher.last_name = form.last_name.data
             if teacher.save():
+                publish(identity_key('T', teacher.id))
                 flash(teacher.username + ' updated.')
             else:
                 flash('Something went wrong.')
@@ -157,10 +189,12 @@ def add_specialization(username):
     if form.validate_on_submit():
         try:
             with get_db().transaction():
-                spec = TeacherSubject.get_or_create(
+                TeacherSubject.create(
                     teacher=Teacher.get(Teacher.username == username),
                     specialization=Subject.get(Subject.name == form.subject_select.data)
                 )
+        except IntegrityError:  # unique (teacher, specialization) index
+            flash('Teacher already has this specialization')
         except DatabaseError:
             flash('An error occurred, try again')
         else:
@@ -182,6 +216,7 @@ def add_subject():
         except DatabaseError:
             flash('An error occurred, try again.')
         else:
+            publish(SUBJECT_CHOICES)
             flash('Subject added.')
     flash_errors(form)
     return render_template('add_subject.html', form=form)
@@ -191,10 +226,7 @@ def add_subject():
 @admin_required
 def subject_remove(name):
     subj = Subject.get(Subject.name == name)
-    if subj.delete_instance(recursive=True):  # delete instance and all its' occurrences as foreign fields
-        flash(subj.name + ' subject has been removed.')
-    else:
-        flash('Something went wrong.')
+    _remove('subject', subj.id, subj.name + ' subject')
     return redirect(url_for('admin_blueprint.admin_subjects'))
 
 
@@ -206,31 +238,76 @@ def subject_edit(name):
     if form.validate_on_submit():
         with get_db().transaction():
             subject.name = form.name.data
-            if subject.save():
-                flash(subject.name + ' subject updated.')
-            else:
-                flash('Something went wrong.')
-            flash_errors(form)
+            saved = subject.save()
+        if saved:
+            publish(SUBJECT_CHOICES)
+            flash(subject.name + ' subject updated.')
+        else:
+            flash('Something went wrong.')
+        flash_errors(form)
         return redirect(url_for('admin_blueprint.admin_subjects'))
     return render_template('subject_edit.html', subject=subject, form=form)
 
 
+# sort orders of the listings, each served by an index
+_student_orders = OrderedDict([
+    ('last_name', (Student.last_name, Student.id)),
+    ('username', (Student.username,)),
+    ('group', (Student.group, Student.last_name, Student.id)),
+])
+_teacher_orders = OrderedDict([
+    ('last_name', (Teacher.last_name, Teacher.id)),
+    ('username', (Teacher.username,)),
+])
+_subject_orders = OrderedDict([
+    ('name', (Subject.name,)),
+])
+
+
 @admin_blueprint.route('/students/')
 @admin_required
 def admin_students():
-    students = Student.select()
-    return render_template('admin_students.html', students=students)
+    group = request.args.get('group', '').strip()
+    students = Student.select().where(not_scheduled('student'))
+    if group:
+        students = students.where(Student.group == group)
+
+    def render():
+        page = paginate(Student, students, _student_orders, {'group': group})
+        return render_template('admin_students.html', students=page.items, page=page, group=group)
+    return conditional_page(['students'], render)
 
 
 @admin_blueprint.route('/teachers/')
 @admin_required
 def admin_teachers():
-    teachers = Teacher.select()
-    return render_template('admin_teachers.html', teachers=teachers)
+    def render():
+        page = paginate(Teacher, Teacher.select().where(not_scheduled('teacher')), _teacher_orders)
+        return render_template('admin_teachers.html', teachers=page.items, page=page)
+    return conditional_page(['teachers'], render)
 
 
 @admin_blueprint.route('/subjects')
 @admin_required
 def admin_subjects():
-    subjects = Subject.select()
-    return render_template('admin_subjects.html', subjects=subjects)
+    def render():
+        page = paginate(Subject, Subject.select().where(not_scheduled('subject')), _subject_orders)
+        return render_template('admin_subjects.html', subjects=page.items, page=page)
+    return conditional_page(['subjects'], render)
+
+
+@admin_blueprint.route('/export.<any(csv, xlsx):fmt>')
+@admin_required
+def school_export(fmt):
+    from export import export_school  # imported by the first export, like the other export views
+    return export_school(fmt)
+
+
+@admin_blueprint.route('/metrics/')
+@admin_required
+def metrics():
+    """Per-endpoint request statistics and slowest statements, gathered while INSTRUMENTATION is on,
+    and the state of the login password verification queue."""
+    snapshot = get_metrics().snapshot()
+    snapshot['password_verification'] = get_verifier().stats()
+    return jsonify(snapshot)
@@ -0,0 +1,166 @@
+"""Group analytics: per subject mean, median, standard deviation and distribution of grades,
+and every student's mean and percentile rank within the group in each subject.
+Grades of a group are loaded once as columns (student index, subject index, grade) and every statistic
+is computed by vectorized NumPy group-by operations (bincount, lexsort), without loops over grades.
+group_reports does the same for the whole school from two queries:
+
+    python analytics.py --database gradebook.db --output analytics.json
+
+Available only if numpy is installed."""
+import argparse
+import json
+from time import time
+from model import Student, Subject, Grade, MIN_GRADE, MAX_GRADE, get_db
+from deletion import not_scheduled, grades_not_scheduled
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_width = MAX_GRADE - MIN_GRADE + 1  # buckets of a distribution, one per value of the grade scale
+
+
+def _grade_columns(group=None):
+    """(student ids, subject ids, grades) arrays of grades, of a group or of all groups, leaving out grades
+    of records scheduled for removal. Rows are read from the cursor, without building model instances."""
+    query = Grade.select(Grade.student, Grade.subject, Grade.grade).where(grades_not_scheduled())
+    if group is not None:
+        query = query.join(Student).where(Student.group == group)
+    rows = numpy.array(get_db().execute_sql(*query.sql()).fetchall(), dtype=numpy.float64).reshape(-1, 3)
+    return rows[:, 0].astype(numpy.int64), rows[:, 1].astype(numpy.int64), rows[:, 2]
+
+
+def _positions(ids, values):
+    """Positions of values in the array ids."""
+    order = numpy.argsort(ids)
+    return order[numpy.searchsorted(ids, values, sorter=order)]
+
+
+class GroupReport(object):
+    """Statistics of a group. Arrays are indexed by subject (rows) and student (columns)
+    in the order of subjects and students; statistics without grades are NaN."""
+    def __init__(self, group, students, subjects, student_index, subject_index, grades):
+        self.group = group
+        self.students = students
+        self.subjects = subjects
+        subjects_count, students_count = len(subjects), len(students)
+
+        self.count = numpy.bincount(subject_index, minlength=subjects_count)
+        total = numpy.bincount(subject_index, grades, minlength=subjects_count)
+        squares = numpy.bincount(subject_index, grades * grades, minlength=subjects_count)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            self.mean = total / self.count
+            self.std = numpy.sqrt(numpy.maximum(squares / self.count - self.mean * self.mean, 0))
+
+        # grades sorted within subjects; the median of a subject lies in the middle of its run
+        ordered = grades[numpy.lexsort((grades, subject_index))]
+        starts = numpy.cumsum(self.count) - self.count
+        graded = self.count > 0
+        self.median = numpy.full(subjects_count, numpy.nan)
+        self.median[graded] = (ordered[(starts + (self.count - 1) // 2)[graded]] +
+                               ordered[(starts + self.count // 2)[graded]]) / 2
+
+        # rounded half up, as reports.group_statistics does in SQL
+        buckets = numpy.clip(numpy.floor(grades + 0.5).astype(numpy.int64), MIN_GRADE, MAX_GRADE) - MIN_GRADE
+        self.distribution = numpy.bincount(subject_index * _width + buckets,
+                                           minlength=subjects_count * _width).reshape(subjects_count, _width)
+
+        cells = subject_index * students_count + student_index
+        cell_count = numpy.bincount(cells, minlength=subjects_count * students_count).reshape(
+            subjects_count, students_count)
+        cell_total = numpy.bincount(cells, grades, minlength=subjects_count * students_count).reshape(
+            subjects_count, students_count)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            self.student_mean = cell_total / cell_count
+        # percentile rank: share of the subject's graded students with a lower mean, equal ones counting half
+        means = self.student_mean
+        below = (means[:, numpy.newaxis, :] < means[:, :, numpy.newaxis]).sum(axis=2)
+        equal = (means[:, numpy.newaxis, :] == means[:, :, numpy.newaxis]).sum(axis=2)
+        ranked = (cell_count > 0).sum(axis=1)[:, numpy.newaxis]
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            self.percentile = numpy.where(cell_count > 0, 100.0 * (below + 0.5 * equal) / ranked, numpy.nan)
+
+    def graded_subjects(self):
+        """Indexes of subjects with grades."""
+        return [index for index in range(len(self.subjects)) if self.count[index]]
+
+    def subject_rows(self):
+        """(subject, count, mean, median, standard deviation, distribution) of subjects with grades."""
+        return [(self.subjects[i], int(self.count[i]), float(self.mean[i]), float(self.median[i]),
+                 float(self.std[i]), self.distribution[i].tolist()) for i in self.graded_subjects()]
+
+    def student_rows(self):
+        """(student, [(mean, percentile rank) or None for every subject with grades])."""
+        subjects = self.graded_subjects()
+        return [(student, [(float(self.student_mean[i, j]), float(self.percentile[i, j]))
+                           if self.percentile[i, j] == self.percentile[i, j] else None for i in subjects])
+                for j, student in enumerate(self.students)]
+
+    def to_dict(self):
+        return {
+            'group': self.group,
+            'subjects': [dict(subject=subject.name, count=count, mean=mean, median=median, std=std,
+                              distribution=distribution)
+                         for subject, count, mean, median, std, distribution in self.subject_rows()],
+            'students': [dict(username=student.username,
+                              subjects={self.subjects[i].name: dict(mean=cell[0], percentile=cell[1])
+                                        for i, cell in zip(self.graded_subjects(), cells) if cell})
+                         for student, cells in self.student_rows()],
+        }
+
+
+def group_report(group):
+    """GroupReport of a group, from three queries: students, subjects and the group's grades."""
+    students = list(Student.select().where(Student.group == group, not_scheduled('student'))
+                    .order_by(Student.last_name, Student.id))
+    subjects = list(Subject.select().where(not_scheduled('subject')).order_by(Subject.name))
+    student_ids, subject_ids, grades = _grade_columns(group)
+    return GroupReport(group, students, subjects,
+                       _positions(numpy.array([student.id for student in students], dtype=numpy.int64), student_ids),
+                       _positions(numpy.array([subject.id for subject in subjects], dtype=numpy.int64), subject_ids),
+                       grades)
+
+
+def group_reports():
+    """GroupReport of every group, ordered by group. All grades are read by one query and split by group."""
+    students = list(Student.select().where(not_scheduled('student')).order_by(Student.group, Student.last_name,
+                                                                             Student.id))
+    subjects = list(Subject.select().where(not_scheduled('subject')).order_by(Subject.name))
+    student_ids, subject_ids, grades = _grade_columns()
+    if not students:
+        return []
+    groups, student_group = numpy.unique([student.group for student in students], return_inverse=True)
+    group_starts = numpy.searchsorted(student_group, numpy.arange(len(groups)))  # students are sorted by group
+    student_positions = _positions(numpy.array([student.id for student in students], dtype=numpy.int64),
+                                   student_ids)
+    subject_positions = _positions(numpy.array([subject.id for subject in subjects], dtype=numpy.int64), subject_ids)
+    grade_group = student_group[student_positions]
+    order = numpy.argsort(grade_group, kind='stable')
+    bounds = numpy.searchsorted(grade_group[order], numpy.arange(len(groups) + 1))
+    reports = []
+    for index, group in enumerate(groups.tolist()):
+        rows = order[bounds[index]:bounds[index + 1]]
+        first = group_starts[index]
+        last = group_starts[index + 1] if index + 1 < len(groups) else len(students)
+        reports.append(GroupReport(group, students[first:last], subjects, student_positions[rows] - first,
+                                   subject_positions[rows], grades[rows]))
+    return reports
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compute analytics of every group.')
+    parser.add_argument('--database', default='gradebook.db')
+    parser.add_argument('--output', default='analytics.json')
+    args = parser.parse_args(argv)
+    db = get_db()
+    db.init(args.database)
+    start = time()
+    reports = group_reports()
+    with open(args.output, 'w') as output:
+        json.dump([report.to_dict() for report in reports], output)
+    print('{} groups in {:.2f} s.'.format(len(reports), time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+"""Read-only JSON API, version 1, for teachers and admins logged in through the usual session.
+
+    GET /api/v1/students/?group=1&fields=id,username      students, optionally of one group
+    GET /api/v1/students/<username>?include=grades         one student, with grades if asked for
+    GET /api/v1/groups/                                    groups with numbers of students
+    GET /api/v1/subjects/
+    GET /api/v1/teachers/?fields=username,specializations
+    GET /api/v1/grades/?student=<id>&subject=<id>&teacher=<id>
+    GET /api/v1/batch/<students|teachers|subjects|grades>?ids=1,2,3
+    GET /api/v1/audit/students/<id>?as_of=2018-01-31T12:00 grades a student had then, from the grade log
+
+Listings are paginated by cursors (see pagination.py): 'next' and 'previous' hold URLs of the adjacent pages.
+'fields' selects a subset of fields of every item. Related records are fetched by joins, or by one extra
+query for a whole page, never one query per item."""
+from collections import OrderedDict
+from datetime import datetime
+from functools import wraps
+from flask import Blueprint, abort, jsonify, request, session
+from peewee import fn
+from model import Student, Teacher, Subject, TeacherSubject, Grade, _sqlite_max_variables
+from pagination import paginate
+from deletion import not_scheduled, grades_not_scheduled
+from exceptions import HistoryUnavailable
+import audit
+
+api_blueprint = Blueprint('api_blueprint', 'api_blueprint')
+
+_student_fields = OrderedDict([
+    ('id', lambda student: student.id),
+    ('first_name', lambda student: student.first_name),
+    ('last_name', lambda student: student.last_name),
+    ('group', lambda student: student.group),
+    ('username', lambda student: student.username),
+])
+_teacher_fields = OrderedDict([
+    ('id', lambda teacher: teacher.id),
+    ('first_name', lambda teacher: teacher.first_name),
+    ('last_name', lambda teacher: teacher.last_name),
+    ('username', lambda teacher: teacher.username),
+    ('specializations', lambda teacher: teacher.specialization_names),  # set by _load_specializations
+])
+_subject_fields = OrderedDict([
+    ('id', lambda subject: subject.id),
+    ('name', lambda subject: subject.name),
+])
+_grade_fields = OrderedDict([
+    ('id', lambda grade: grade.id),
+    ('grade', lambda grade: float(grade.grade)),
+    ('student', lambda grade: grade.student.username),
+    ('subject', lambda grade: grade.subject.name),
+    ('teacher', lambda grade: grade.teacher.username),
+])
+
+_student_orders = OrderedDict([
+    ('last_name', (Student.last_name, Student.id)),
+    ('username', (Student.username,)),
+])
+_teacher_orders = OrderedDict([('last_name', (Teacher.last_name, Teacher.id)), ('username', (Teacher.username,))])
+_subject_orders = OrderedDict([('name', (Subject.name,))])
+_grade_orders = OrderedDict([('id', (Grade.id,))])
+
+
+def api_access_required(f):
+    """Like teacher_or_admin_required, but answers 401 instead of redirecting to a login page."""
+    @wraps(f)
+    def func(*args, **kwargs):
+        if session.get('type') in ('X', 'T'):
+            return f(*args, **kwargs)
+        return jsonify(error='Log in as a teacher or admin.'), 401
+    return func
+
+
+def _error(status, message):
+    response = jsonify(error=message)
+    response.status_code = status
+    abort(response)
+
+
+def _selected(fields):
+    """Names of fields requested by the 'fields' argument, all of them by default."""
+    names = [name.strip() for name in request.args.get('fields', '').split(',') if name.strip()]
+    unknown = [name for name in names if name not in fields]
+    if unknown:
+        _error(400, 'Unknown fields: ' + ', '.join(unknown))
+    return names or list(fields)
+
+
+def _serialize(rows, fields, names):
+    return [OrderedDict((name, fields[name](row)) for name in names) for row in rows]
+
+
+def _grades_query():
+    """Grades together with their student, subject and teacher, in one joined query.
+    Grades of records scheduled for removal are left out."""
+    return (Grade
+            .select(Grade, Student, Subject, Teacher)
+            .join(Student)
+            .switch(Grade)
+            .join(Subject)
+            .switch(Grade)
+            .join(Teacher)
+            .where(grades_not_scheduled()))
+
+
+def _load_specializations(teachers):
+    """Sets specialization_names of every teacher, with a single query for all of them."""
+    names = {teacher.id: [] for teacher in teachers}
+    if names:
+        query = (TeacherSubject
+                 .select(TeacherSubject.teacher, Subject.name)
+                 .join(Subject)
+                 .where(TeacherSubject.teacher << list(names))
+                 .order_by(Subject.name)
+                 .tuples())
+        for teacher_id, name in query:
+            names[teacher_id].append(name)
+    for teacher in teachers:
+        teacher.specialization_names = names[teacher.id]
+
+
+def _page_response(model_class, query, orders, fields, filters=None, prepare=None):
+    names = _selected(fields)
+    page = paginate(model_class, query, orders, filters, {'fields': request.args.get('fields')})
+    if prepare is not None:
+        prepare(page.items, names)
+    return jsonify(items=_serialize(page.items, fields, names), total=page.total,
+                   next=page.next_url, previous=page.previous_url)
+
+
+def _prepare_teachers(teachers, names):
+    if 'specializations' in names:
+        _load_specializations(teachers)
+
+
+@api_blueprint.route('/students/')
+@api_access_required
+def students():
+    query = Student.select().where(not_scheduled('student'))
+    group = request.args.get('group', '').strip()
+    if group:
+        query = query.where(Student.group == group)
+    return _page_response(Student, query, _student_orders, _student_fields, {'group': group})
+
+
+@api_blueprint.route('/students/<username>')
+@api_access_required
+def student(username):
+    found = Student.select().where(Student.username == username, not_scheduled('student')).first()
+    if found is None:
+        _error(404, 'No such student.')
+    data = _serialize([found], _student_fields, _selected(_student_fields))[0]
+    if request.args.get('include') == 'grades':
+        data['grades'] = _serialize(_grades_query().where(Grade.student == found).order_by(Grade.id),
+                                    _grade_fields, list(_grade_fields))
+    return jsonify(data)
+
+
+@api_blueprint.route('/groups/')
+@api_access_required
+def groups():
+    query = (Student
+             .select(Student.group, fn.COUNT(Student.id))
+             .where(not_scheduled('student'))
+             .group_by(Student.group)
+             .order_by(Student.group)
+             .tuples())
+    return jsonify(items=[OrderedDict([('group', group), ('students', count)]) for group, count in query])
+
+
+@api_blueprint.route('/subjects/')
+@api_access_required
+def subjects():
+    return _page_response(Subject, Subject.select().where(not_scheduled('subject')), _subject_orders, _subject_fields)
+
+
+@api_blueprint.route('/teachers/')
+@api_access_required
+def teachers():
+    return _page_response(Teacher, Teacher.select().where(not_scheduled('teacher')), _teacher_orders, _teacher_fields,
+                          prepare=_prepare_teachers)
+
+
+@api_blueprint.route('/grades/')
+@api_access_required
+def grades():
+    query = _grades_query()
+    filters = {}
+    for name, field in (('student', Grade.student), ('subject', Grade.subject), ('teacher', Grade.teacher)):
+        value = request.args.get(name, type=int)
+        if value is not None:
+            query = query.where(field == value)
+            filters[name] = value
+    return _page_response(Grade, query, _grade_orders, _grade_fields, filters)
+
+
+_batch_resources = {
+    'students': (Student, lambda: Student.select().where(not_scheduled('student')), _student_fields, None),
+    'teachers': (Teacher, lambda: Teacher.select().where(not_scheduled('teacher')), _teacher_fields,
+                 _prepare_teachers),
+    'subjects': (Subject, lambda: Subject.select().where(not_scheduled('subject')), _subject_fields, None),
+    'grades': (Grade, _grades_query, _grade_fields, None),
+}
+_batch_limit = _sqlite_max_variables - 3  # conditions leaving out scheduled removals bind up to three variables
+
+
+@api_blueprint.route('/batch/<any(students, teachers, subjects, grades):resource>')
+@api_access_required
+def batch(resource):
+    """Records of many ids at once: {"items": {id: record}, "missing": [ids]}, in a single query
+    (plus one for specializations of teachers)."""
+    model_class, query, fields, prepare = _batch_resources[resource]
+    try:
+        ids = sorted(set(int(value) for value in request.args.get('ids', '').split(',') if value.strip()))
+    except ValueError:
+        _error(400, 'ids have to be integers separated by commas.')
+    if len(ids) > _batch_limit:
+        _error(400, 'At most {} ids can be requested at once.'.format(_batch_limit))
+    names = _selected(fields)
+    rows = list(query().where(model_class.id << ids)) if ids else []
+    if prepare is not None:
+        prepare(rows, names)
+    found = OrderedDict((str(row.id), record) for row, record in zip(rows, _serialize(rows, fields, names)))
+    return jsonify(items=found, missing=[row_id for row_id in ids if str(row_id) not in found])
+
+
+def _moment(text):
+    """Datetime of 'YYYY-MM-DDTHH:MM[:SS]', or date of 'YYYY-MM-DD', meaning its end."""
+    for pattern in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            moment = datetime.strptime(text, pattern)
+        except ValueError:
+            continue
+        return moment.date() if pattern == '%Y-%m-%d' else moment
+    _error(400, 'as_of has to be a date, YYYY-MM-DD, or a time, YYYY-MM-DDTHH:MM[:SS].')
+
+
+@api_blueprint.route('/audit/students/<int:student_id>')
+@api_access_required
+def student_history(student_id):
+    """Grades a student had at as_of, rebuilt from the grade log, also of removed students, subjects and teachers."""
+    as_of = request.args.get('as_of', '').strip()
+    moment = _moment(as_of) if as_of else datetime.now()
+    try:
+        grades = audit.grades_as_of(student_id, moment)
+    except HistoryUnavailable as e:
+        _error(404, str(e))
+    return jsonify(student=student_id, as_of=moment.isoformat(),
+                   grades=[dict(grade, grade=float(grade['grade'])) for grade in grades])
@@ -0,0 +1,215 @@
+"""Append-only log of grade changes and grades of a student as they were at any moment.
+
+Code adding or removing grades logs them with log_grades, one INSERT ... SELECT per statement writing
+the grades, in the same transaction: grading, bulk grading, set-based and background removals. Grades added
+or removed by raw SQL elsewhere are not logged. Updates are rare single rows and are logged by a trigger
+whichever code path makes them. An event holds the grade's student, subject and teacher, its new and previous
+value, the time in milliseconds and the term; triggers on the log refuse to update or delete events.
+The log is insert-only integers in id order with a single index, on (student_id, id). SQLite has no
+table partitions: the term is a column, and ids, which grow with time, make each term a contiguous range.
+
+Snapshots copy all grades at a point of the log, the first one when the log is created; more are taken
+by a periodic job, a new one when the term changes or SNAPSHOT_INTERVAL events have been logged since.
+Grades are copied in ranges of ids, each in its own transaction (see migrations.in_batches), and
+a snapshot is used only once it is completed. Grades changed meanwhile are logged after the snapshot's
+event, so replaying its later events brings every copied grade, whenever it was copied, up to date:
+
+    python audit.py --database gradebook.db --snapshot
+    python audit.py --database gradebook.db --student 12 --as-of 2018-01-31
+
+Grades as of a moment are those of the latest snapshot completed by then, with the student's later events
+replayed; both are read by ranges of an index on the student."""
+import argparse
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from decimal import Decimal
+from peewee import SQL
+from model import Grade, GradeEvent, GradeSnapshot, get_db
+from exceptions import HistoryUnavailable
+
+CREATED, CHANGED, DELETED = 1, 2, 3
+ACTIONS = {CREATED: 'created', CHANGED: 'changed', DELETED: 'deleted'}
+SNAPSHOT_INTERVAL = 100000  # events logged since the last snapshot, after which a new one is due
+
+_now = "CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)"  # milliseconds since the epoch
+_month = "CAST(strftime('%m', 'now', 'localtime') AS INTEGER)"
+_term = ("(CAST(strftime('%Y', 'now', 'localtime') AS INTEGER) * 2 - "
+         "CASE WHEN {0} >= 9 THEN 0 WHEN {0} = 1 THEN 2 ELSE 1 END)").format(_month)  # see term_of
+_insert = 'INSERT INTO gradeevent (term, at, action, grade_id, student_id, subject_id, teacher_id, grade, previous) '
+_log = _insert + ('SELECT ' + _term + ', ' + _now + ', {action}, {row}.id, {row}.student_id, {row}.subject_id, '
+                  '{row}.teacher_id, {grade}, {previous}')
+_triggers = [
+    # a grade moved to another student is deleted from the log of the first one
+    ('grade_audit_update', 'AFTER UPDATE OF student_id, subject_id, teacher_id, grade ON grade',
+     _log.format(action=DELETED, row='old', grade='NULL', previous='old.grade') +
+     ' WHERE old.student_id <> new.student_id;\n    ' +
+     _log.format(action=CHANGED, row='new', grade='new.grade', previous='old.grade') + ';'),
+    ('gradeevent_no_update', 'BEFORE UPDATE ON gradeevent', "SELECT RAISE(ABORT, 'grade events are append-only');"),
+    ('gradeevent_no_delete', 'BEFORE DELETE ON gradeevent', "SELECT RAISE(ABORT, 'grade events are append-only');"),
+]
+_trigger_template = '''CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN
+    {body}
+END'''
+# rows of a student in a snapshot are adjacent in the primary key, without a rowid and a second index
+_create_snapshot_grades = ('CREATE TABLE snapshotgrade (snapshot_id INTEGER NOT NULL, student_id INTEGER NOT NULL, '
+                           'grade_id INTEGER NOT NULL, subject_id INTEGER NOT NULL, teacher_id INTEGER NOT NULL, '
+                           'grade DECIMAL(3, 1) NOT NULL, PRIMARY KEY (snapshot_id, student_id, grade_id)) '
+                           'WITHOUT ROWID')
+
+
+def term_of(moment):
+    """Term of a date as a number: twice the year the school year starts in, plus 1 for the summer term.
+    Winter terms run from September to January, summer terms from February to August."""
+    if moment.month >= 9:
+        return moment.year * 2
+    return moment.year * 2 - (2 if moment.month == 1 else 1)
+
+
+def term_name(term):
+    """E.g. '2017/18 winter' of term_of(date(2017, 10, 1))."""
+    year = term // 2
+    return '{}/{:02d} {}'.format(year, (year + 1) % 100, 'summer' if term % 2 else 'winter')
+
+
+def _until(moment):
+    """Milliseconds since the epoch, before which events happened by moment: a datetime, naive ones
+    in local time, or a date, meaning its end."""
+    if not isinstance(moment, datetime):
+        moment = datetime.combine(moment + timedelta(days=1), datetime.min.time())
+        return int(moment.timestamp() * 1000)
+    return int(moment.timestamp() * 1000) + 1
+
+
+def log_grades(action, condition):
+    """Logs CREATED or DELETED of every grade matching condition, in one statement. Call it in the transaction
+    writing the grades, after inserting them or before deleting them."""
+    grade, previous = (Grade.grade, SQL('NULL')) if action == CREATED else (SQL('NULL'), Grade.grade)
+    sql, params = (Grade.select(SQL(_term), SQL(_now), SQL(str(action)), Grade.id, Grade.student, Grade.subject,
+                                Grade.teacher, grade, previous)
+                   .where(condition)
+                   .sql())
+    get_db().execute_sql(_insert + sql, params)
+
+
+def last_grade_id():
+    """Id of the latest grade, 0 if there is none. Grades with greater ids, inserted later in the same
+    transaction, are those it added."""
+    return Grade.select(Grade.id).order_by(Grade.id.desc()).scalar() or 0
+
+
+def _completed():
+    return GradeSnapshot.select().where(GradeSnapshot.completed_at.is_null(False))
+
+
+def take_snapshot(db):
+    """Copies every grade into a new snapshot of the log's current end, in ranges of ids each committed
+    on its own, and marks it completed after the last one. Grades of snapshots, which were interrupted
+    before, are dropped first."""
+    from migrations import in_batches
+    with db.transaction():
+        db.execute_sql('DELETE FROM snapshotgrade WHERE snapshot_id IN '
+                       '(SELECT id FROM gradesnapshot WHERE completed_at IS NULL)')
+        GradeSnapshot.delete().where(GradeSnapshot.completed_at.is_null()).execute()
+        db.execute_sql('INSERT INTO gradesnapshot (event_id, term, taken_at) '
+                       'SELECT COALESCE(MAX(id), 0), {}, {} FROM gradeevent'.format(_term, _now))
+        snapshot = GradeSnapshot.select().order_by(GradeSnapshot.id.desc()).get()
+    in_batches(db, 'grade', 'INSERT INTO snapshotgrade (snapshot_id, student_id, grade_id, subject_id, teacher_id, '
+                            'grade) SELECT {}, student_id, id, subject_id, teacher_id, grade FROM grade '
+                            'WHERE id > ? AND id <= ?'.format(snapshot.id))
+    with db.transaction():
+        db.execute_sql('UPDATE gradesnapshot SET completed_at = {} WHERE id = ?'.format(_now), [snapshot.id])
+    return GradeSnapshot.get(GradeSnapshot.id == snapshot.id)
+
+
+def snapshot_due(db):
+    """True if the term changed or SNAPSHOT_INTERVAL events were logged since the last completed snapshot."""
+    last = _completed().order_by(GradeSnapshot.id.desc()).first()
+    if last is None or last.term != term_of(datetime.now()):
+        return True
+    return GradeEvent.select().where(GradeEvent.id > last.event_id + SNAPSHOT_INTERVAL).exists()
+
+
+def create_audit_log(db):
+    """Creates the log, its triggers and the snapshot tables in one transaction, then takes the first snapshot.
+    History before it is not known; if it is interrupted, snapshot_due finds none and the periodic job takes it.
+    Returns False if the log exists."""
+    if db.execute_sql("SELECT 1 FROM sqlite_master WHERE name = 'snapshotgrade'").fetchone():
+        return False
+    with db.transaction():
+        db.create_tables([GradeEvent, GradeSnapshot], safe=True)
+        db.execute_sql(_create_snapshot_grades)
+        for name, event, body in _triggers:
+            db.execute_sql(_trigger_template.format(name=name, event=event, body=body))
+    take_snapshot(db)
+    return True
+
+
+def events(student_id, term=None):
+    """Logged changes of a student's grades, oldest first, optionally of one term."""
+    query = GradeEvent.select().where(GradeEvent.student_id == student_id)
+    if term is not None:
+        query = query.where(GradeEvent.term == term)
+    return query.order_by(GradeEvent.id)
+
+
+def grades_as_of(student_id, moment):
+    """Grades a student had at moment (see _until), as dicts with id, subject_id, teacher_id and grade,
+    ordered by subject and id like Grade.Meta.order_by. Raises HistoryUnavailable before the first snapshot
+    is completed."""
+    until = _until(moment)
+    snapshot = _completed().where(GradeSnapshot.completed_at < until).order_by(GradeSnapshot.id.desc()).first()
+    if snapshot is None:
+        raise HistoryUnavailable('Grades are logged since the first snapshot, which is later.')
+    state = OrderedDict()
+    rows = get_db().execute_sql('SELECT grade_id, subject_id, teacher_id, grade FROM snapshotgrade '
+                                'WHERE snapshot_id = ? AND student_id = ?', [snapshot.id, student_id])
+    for grade_id, subject_id, teacher_id, grade in rows:
+        state[grade_id] = (subject_id, teacher_id, Decimal(str(grade)))
+    replayed = (GradeEvent
+                .select(GradeEvent.action, GradeEvent.grade_id, GradeEvent.subject_id, GradeEvent.teacher_id,
+                        GradeEvent.grade)
+                .where(GradeEvent.student_id == student_id, GradeEvent.id > snapshot.event_id,
+                       GradeEvent.at < until)
+                .order_by(GradeEvent.id)
+                .tuples())
+    for action, grade_id, subject_id, teacher_id, grade in replayed:
+        if action == DELETED:
+            state.pop(grade_id, None)
+        else:
+            state[grade_id] = (subject_id, teacher_id, grade)
+    ordered = sorted(state.items(), key=lambda item: (item[1][0], item[0]))
+    return [dict(id=grade_id, subject_id=subject_id, teacher_id=teacher_id, grade=grade)
+            for grade_id, (subject_id, teacher_id, grade) in ordered]
+
+
+def _date(text):
+    return datetime.strptime(text, '%Y-%m-%d').date()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Snapshot the grade log or show a student\'s history.')
+    parser.add_argument('--database', default='gradebook.db')
+    parser.add_argument('--snapshot', action='store_true', help='take a snapshot, if one is due')
+    parser.add_argument('--force', action='store_true', help='take a snapshot even if none is due')
+    parser.add_argument('--student', type=int, help='id of a student, whose logged changes are listed')
+    parser.add_argument('--as-of', type=_date, help='list grades the student had at the end of this date instead')
+    args = parser.parse_args(argv)
+    db = get_db()
+    db.init(args.database)
+    if args.snapshot or args.force:
+        if args.force or snapshot_due(db):
+            print('Snapshot {} taken.'.format(take_snapshot(db).id))
+        else:
+            print('No snapshot is due.')
+    if args.student is not None and args.as_of is not None:
+        for grade in grades_as_of(args.student, args.as_of):
+            print('{id}\tsubject {subject_id}\tteacher {teacher_id}\t{grade}'.format(**grade))
+    elif args.student is not None:
+        for event in events(args.student):
+            print('{:%Y-%m-%d %H:%M:%S}\t{}\t{}\tgrade {}\tsubject {}\tteacher {}\t{} -> {}'.format(
+                datetime.fromtimestamp(event.at / 1000), term_name(event.term), ACTIONS[event.action],
+                event.grade_id, event.subject_id, event.teacher_id, event.previous, event.grade))
+
+
+if __name__ == '__main__':
+    main()
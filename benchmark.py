@@ -0,0 +1,324 @@
+"""Benchmark harness: seeds a synthetic school into a separate database
+and measures latency and throughput of every read-only route through Flask's test client.
+
+    python benchmark.py --scale small --output results.json
+    python benchmark.py --scale small --output new.json --baseline results.json
+
+Results are written as JSON, so runs can be compared with each other (--baseline).
+Routes changing data (logins, grading, removals) are not measured, which keeps every run on the same dataset.
+Every request renders its page; --cached measures pages served from the page cache as well, separately.
+Startup of a worker (import, create_app and the first requests) is measured in fresh processes."""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from bcrypt import hashpw, gensalt
+import model
+from model import Student, Teacher, Subject, TeacherSubject, Grade
+from model import insert_in_batches
+import summaries
+from migrations import run_migrations
+from audit import take_snapshot
+
+SCALES = {
+    'tiny': dict(students=50, groups=5, subjects=5, teachers=5, grades=1000),
+    'small': dict(students=2000, groups=40, subjects=20, teachers=80, grades=100000),
+    'medium': dict(students=10000, groups=200, subjects=100, teachers=500, grades=1000000),
+    'school': dict(students=50000, groups=500, subjects=200, teachers=2000, grades=10000000),
+}
+BENCHMARK_PASSWORD = 'benchmark'
+
+
+def _drop_schema(db):
+    """Drops every table of the database, with their indexes and triggers."""
+    db.execute_sql('DROP TABLE IF EXISTS person_search')  # a full-text index drops its own tables
+    for name in db.get_tables():
+        if not name.startswith('sqlite_'):
+            db.execute_sql('DROP TABLE "{}"'.format(name))
+
+
+def seed(db, students, groups, subjects, teachers, grades, seed_value=0):
+    """(Re)creates the schema by running every migration, as gradebook.create_tables does in a deployment,
+    and fills it with a reproducible synthetic dataset.
+    Every account shares one precomputed bcrypt hash of BENCHMARK_PASSWORD, so seeding costs a single hash.
+    Returns seeding time in seconds."""
+    start = time.time()
+    rng = random.Random(seed_value)
+    password = hashpw(BENCHMARK_PASSWORD.encode('utf-8'), gensalt()).decode('utf-8')
+    _drop_schema(db)
+    run_migrations(db)
+    db.execute_sql('PRAGMA synchronous = OFF')
+    with db.transaction():
+        insert_in_batches(Subject, ({'name': 'subject{}'.format(i)} for i in range(1, subjects + 1)))
+        insert_in_batches(Teacher, ({'first_name': 'Teacher',
+                                     'last_name': 'No. {}'.format(i),
+                                     'username': 'teacher{}'.format(i),
+                                     'password': password} for i in range(1, teachers + 1)))
+        insert_in_batches(Student, ({'first_name': 'Student',
+                                     'last_name': 'No. {}'.format(i),
+                                     'group': str(i % groups + 1),
+                                     'username': 'student{}'.format(i),
+                                     'password': password} for i in range(1, students + 1)))
+        insert_in_batches(TeacherSubject, ({'teacher': teacher, 'specialization': subject}
+                                           for teacher in range(1, teachers + 1)
+                                           for subject in rng.sample(range(1, subjects + 1), min(3, subjects))))
+    with db.transaction():
+        insert_in_batches(Grade, ({'student': rng.randint(1, students),
+                                   'subject': rng.randint(1, subjects),
+                                   'teacher': rng.randint(1, teachers),
+                                   'grade': rng.randint(1, 6)} for _ in range(grades)))
+    summaries.rebuild(db)
+    take_snapshot(db)  # seeded grades are a snapshot, not logged events
+    db.execute_sql('PRAGMA synchronous = NORMAL')
+    return time.time() - start
+
+
+def _hot_queries():
+    """(name, query) of the queries run most often by the routes."""
+    return [
+        ('group_students', Student.select().where(Student.group == '1').order_by(Student.last_name)),
+        ('groups', Student.select(Student.group).distinct().order_by(Student.group.asc())),
+        ('student_grades', Grade.select().where(Grade.student == 1)),
+        ('subject_grades', Grade.select().where(Grade.subject == 1).order_by(Grade.subject, Grade.student)),
+        ('admin_students_page', Student.select().where((Student.last_name >= 'No. 5') & (
+            (Student.last_name > 'No. 5') | (Student.last_name == 'No. 5') & (Student.id > 5)))
+         .order_by(Student.last_name, Student.id).limit(51)),
+        ('teacher_specializations', TeacherSubject.select().where(TeacherSubject.teacher == 1)),
+        ('specialization_exists', TeacherSubject.select().where(TeacherSubject.teacher == 1,
+                                                                TeacherSubject.specialization == 1)),
+    ]
+
+
+def query_plans(db):
+    """{query name: lines of SQLite's EXPLAIN QUERY PLAN} of the hot queries."""
+    plans = {}
+    for name, query in _hot_queries():
+        sql, params = query.sql()
+        plans[name] = [row[-1] for row in db.execute_sql('EXPLAIN QUERY PLAN ' + sql, params)]
+    return plans
+
+
+def drop_composite_indexes(db):
+    """Replaces indexes added by migrations.composite_indexes with those of foreign keys it dropped,
+    to measure a database which was not migrated."""
+    from migrations import _composite_indexes, _redundant_indexes, _create_indexes, _indexes
+    for name, table, columns, unique in _composite_indexes:
+        db.execute_sql('DROP INDEX IF EXISTS "{}"'.format(name))
+    _create_indexes(db, [index for index in _redundant_indexes if index[0] not in _indexes(db, index[1])])
+
+
+def _percentile(sorted_samples, percent):
+    """Nearest-rank percentile of already sorted samples."""
+    index = max(0, int(round(percent / 100.0 * len(sorted_samples))) - 1)
+    return sorted_samples[index]
+
+
+def _routes():
+    """(name, session type, url) of every read-only route of the application."""
+    return [
+        ('homepage', None, '/'),
+        ('student_login', None, '/student_login/'),
+        ('teacher_login', None, '/teacher_login/'),
+        ('admin_login', None, '/admin/login/'),
+        ('student_profile', 'S', '/student_profile/'),
+        ('group', 'S', '/group/'),
+        ('student_profile_foreign', 'T', '/student_profile/student1'),
+        ('add_grade', 'T', '/add_grade/'),
+        ('teacher_profile', 'T', '/teacher_profile/'),
+        ('groups', 'T', '/groups/'),
+        ('group_foreign', 'T', '/group/1/'),
+        ('group_export', 'T', '/group/1/export.csv'),
+        ('group_analytics', 'T', '/group/1/analytics'),
+        ('search', 'T', '/search/?q=no+5&kind=student&format=json'),
+        ('subject_export', 'T', '/subject/subject1/export.csv'),
+        ('admin.new_student', 'X', '/admin/new_student/'),
+        ('admin.student_profile', 'X', '/admin/student_profile/student1/'),
+        ('admin.student_edit', 'X', '/admin/student_profile/student1/edit/'),
+        ('admin.new_teacher', 'X', '/admin/new_teacher/'),
+        ('admin.teacher_profile', 'X', '/admin/teacher_profile/teacher1/'),
+        ('admin.teacher_edit', 'X', '/admin/teacher_profile/teacher1/edit'),
+        ('admin.add_specialization', 'X', '/admin/add_specialization/teacher1/'),
+        ('admin.add_subject', 'X', '/admin/add_subject/'),
+        ('admin.subject_edit', 'X', '/admin/subject/subject1/edit/'),
+        ('admin.admin_students', 'X', '/admin/students/'),
+        ('admin.admin_teachers', 'X', '/admin/teachers/'),
+        ('admin.admin_subjects', 'X', '/admin/subjects'),
+        ('admin.school_export', 'X', '/admin/export.csv'),
+    ]
+
+
+def _client_for(app, user_type):
+    """Test client with a prepared session, which skips password checks of the login routes."""
+    client = app.test_client()
+    if user_type is not None:
+        with client.session_transaction() as session:
+            session['logged_in'] = True
+            session['type'] = user_type
+            if user_type == 'S':
+                session['user_id'] = Student.get(Student.username == 'student1').id
+                session['username'] = 'student1'
+            elif user_type == 'T':
+                session['user_id'] = Teacher.get(Teacher.username == 'teacher1').id
+                session['username'] = 'teacher1'
+    return client
+
+
+def measure(app, requests_per_route, warmup=2, conditional_pages=False):
+    """Returns per-route statistics: latency percentiles, throughput and SQL statements per request.
+    Pages are rendered on every request unless conditional_pages, which serves them from the page cache
+    once warmed up (see versions.py)."""
+    app.testing = True
+    app.config['INSTRUMENTATION'] = True
+    app.config['CONDITIONAL_PAGES'] = conditional_pages
+    results = {}
+    for name, user_type, url in _routes():
+        client = _client_for(app, user_type)
+        for _ in range(warmup):
+            client.get(url, buffered=True)
+        samples = []
+        queries = 0
+        status = None
+        for _ in range(requests_per_route):
+            start = time.perf_counter()
+            response = client.get(url, buffered=True)
+            samples.append(time.perf_counter() - start)
+            status = response.status_code
+            queries = int(response.headers.get('X-Query-Count', 0))
+        samples.sort()
+        results[name] = {'url': url,
+                         'status': status,
+                         'queries': queries,
+                         'requests': len(samples),
+                         'p50_ms': round(_percentile(samples, 50) * 1000, 3),
+                         'p99_ms': round(_percentile(samples, 99) * 1000, 3),
+                         'mean_ms': round(sum(samples) / len(samples) * 1000, 3),
+                         'rps': round(len(samples) / sum(samples), 2)}
+    return results
+
+
+# run in a fresh interpreter: python -c _startup_script <database> <template cache directory>
+_startup_script = """
+import json, sys, time
+start = time.perf_counter()
+import gradebook
+imported = time.perf_counter()
+app = gradebook.create_app({'DATABASE': sys.argv[1], 'TEMPLATE_CACHE_DIR': sys.argv[2]})
+created = time.perf_counter()
+client = app.test_client()
+client.get('/teacher_login/')
+first = time.perf_counter()
+client.get('/teacher_login/')
+second = time.perf_counter()
+print(json.dumps({'import_ms': (imported - start) * 1000, 'create_app_ms': (created - imported) * 1000,
+                  'first_request_ms': (first - created) * 1000, 'second_request_ms': (second - first) * 1000}))
+"""
+
+
+def measure_startup(database, runs=5):
+    """Median milliseconds of importing the application, create_app and its first and second request,
+    each run in a new process. The first run compiles templates into an empty bytecode cache,
+    its first request is reported separately as first_request_cold_ms."""
+    cache = tempfile.mkdtemp()
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [os.path.dirname(os.path.abspath(__file__))] + [path for path in [os.environ.get('PYTHONPATH')] if path]))
+    samples = []
+    try:
+        for _ in range(runs):
+            output = subprocess.check_output([sys.executable, '-c', _startup_script, database, cache],
+                                             env=environment)
+            samples.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+    finally:
+        shutil.rmtree(cache)
+    results = {name: round(sorted(sample[name] for sample in samples)[len(samples) // 2], 3)
+               for name in samples[0]}
+    results['first_request_cold_ms'] = round(samples[0]['first_request_ms'], 3)
+    results['runs'] = runs
+    return results
+
+
+def compare(current, baseline):
+    """Prints p50/p99 changes of every route against a baseline run."""
+    print('{:<28} {:>10} {:>10} {:>8} {:>10} {:>10} {:>8}'.format(
+        'route', 'p50 base', 'p50 now', 'change', 'p99 base', 'p99 now', 'change'))
+    for name, now in sorted(current['routes'].items()):
+        base = baseline['routes'].get(name)
+        if base is None:
+            continue
+        print('{:<28} {:>10.2f} {:>10.2f} {:>7.0f}% {:>10.2f} {:>10.2f} {:>7.0f}%'.format(
+            name,
+            base['p50_ms'], now['p50_ms'], (now['p50_ms'] / base['p50_ms'] - 1) * 100,
+            base['p99_ms'], now['p99_ms'], (now['p99_ms'] / base['p99_ms'] - 1) * 100))
+    for name, now in sorted(current.get('startup', {}).items()):
+        base = baseline.get('startup', {}).get(name)
+        if base and name != 'runs':
+            print('startup {:<20} {:>10.2f} {:>10.2f} {:>7.0f}%'.format(name, base, now, (now / base - 1) * 100))
+    for name, plan in sorted(current.get('plans', {}).items()):
+        base = baseline.get('plans', {}).get(name)
+        if base is not None and base != plan:
+            print('\nplan of {} changed:\n  was: {}\n  now: {}'.format(name, ' / '.join(base), ' / '.join(plan)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Seed a synthetic school and benchmark every route.')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    for option in ('students', 'groups', 'subjects', 'teachers', 'grades'):
+        parser.add_argument('--' + option, type=int, help='overrides the scale preset')
+    parser.add_argument('--database', default='benchmark.db')
+    parser.add_argument('--no-seed', action='store_true', help='reuse an already seeded database')
+    parser.add_argument('--requests', type=int, default=50, help='measured requests per route')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the dataset')
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare against')
+    parser.add_argument('--startup-runs', type=int, default=5, help='processes measuring startup, 0 skips it')
+    parser.add_argument('--cached', action='store_true',
+                        help='also measure routes served from the page cache, reported as cached_routes')
+    parser.add_argument('--without-indexes', action='store_true',
+                        help='drop composite indexes before measuring, as in a database which was not migrated')
+    args = parser.parse_args(argv)
+
+    scale = dict(SCALES[args.scale])
+    for option in scale:
+        if getattr(args, option) is not None:
+            scale[option] = getattr(args, option)
+
+    from gradebook import app  # configures the database, which is then pointed at the benchmark file
+    db = model.get_db()
+    db.init(args.database)
+    seed_time = None
+    if not args.no_seed:
+        seed_time = seed(db, seed_value=args.seed, **scale)
+    if args.without_indexes:
+        drop_composite_indexes(db)
+    plans = query_plans(db)
+    db.close()
+
+    results = {'meta': {'scale': scale,
+                        'seed': args.seed,
+                        'seed_seconds': seed_time,
+                        'requests_per_route': args.requests,
+                        'python': platform.python_version(),
+                        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')},
+               'plans': plans,
+               'routes': measure(app, args.requests)}
+    if args.cached:
+        results['cached_routes'] = measure(app, args.requests, conditional_pages=True)
+    if args.startup_runs:
+        results['startup'] = measure_startup(args.database, args.startup_runs)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Small in-process cache of values derived from the database.
+Values are computed on first use and dropped explicitly by the views, which change underlying data."""
+from collections import OrderedDict
+from threading import Lock
+
+SUBJECT_CHOICES = 'subject_choices'
+
+
+class Cache(object):
+    def __init__(self):
+        self._values = {}
+        self._generations = {}
+        self._lock = Lock()
+
+    def get(self, key, compute):
+        """Returns cached value of key, computing and storing it first if needed.
+        A value computed while the key was being invalidated is returned, but not stored."""
+        with self._lock:
+            if key in self._values:
+                return self._values[key]
+            generation = self._generations.get(key, 0)
+        value = compute()
+        with self._lock:
+            if self._generations.get(key, 0) == generation:
+                self._values[key] = value
+        return value
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._values.pop(key, None)
+                self._generations[key] = self._generations.get(key, 0) + 1
+
+    def clear(self):
+        self.invalidate(*list(self._values))
+
+
+class PageCache(object):
+    """Rendered pages, keyed by ETags (see versions.py), least recently used ones being evicted.
+    Keys embed versions of the data shown, so entries never need invalidating."""
+    def __init__(self):
+        self._pages = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, render, max_entries):
+        with self._lock:
+            if key in self._pages:
+                self._pages.move_to_end(key)
+                return self._pages[key]
+        page = render()
+        with self._lock:
+            self._pages[key] = page
+            while len(self._pages) > max_entries:
+                self._pages.popitem(last=False)
+        return page
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+
+def identity_key(user_type, user_id):
+    """Key of the time, since which session snapshots of given user are valid (see view.get_current_identity)."""
+    return 'identity', user_type, user_id
+
+
+_cache = Cache()
+
+
+def get_cache():
+    return _cache
@@ -0,0 +1,209 @@
+"""Removal of students, teachers and subjects together with the rows referring to them.
+remove deletes dependents by set-based DELETE ... WHERE statements in one transaction, instead of peewee's
+delete_instance(recursive=True), which loads and deletes them row by row. Records with more grades than
+a threshold are scheduled instead: they are hidden at once (see not_scheduled), and a background purger
+deletes their grades in chunks, each chunk in its own short transaction, so grading waits for one chunk
+at most; the record itself goes last.
+Scheduled removals interrupted by a restart are finished by
+
+    python deletion.py --database gradebook.db"""
+import argparse
+from threading import Event, Lock, Thread
+from time import sleep
+from peewee import IntegrityError
+from model import Student, Teacher, Subject, TeacherSubject, Grade, GradeSummary, PendingDeletion, get_db
+from cache import identity_key, SUBJECT_CHOICES
+from invalidation import publish
+from summaries import refresh_students
+from versions import bump_grade_versions, bump_versions
+from audit import log_grades, DELETED
+
+PURGE_CHUNK_SIZE = 1000
+
+# kind: (model, rows referring to it as (model, foreign key)); they go before the record, whose row version triggers read
+_dependents = {
+    'student': (Student, ((Grade, Grade.student), (GradeSummary, GradeSummary.student))),
+    'teacher': (Teacher, ((Grade, Grade.teacher), (TeacherSubject, TeacherSubject.teacher))),
+    'subject': (Subject, ((Grade, Grade.subject), (GradeSummary, GradeSummary.subject),
+                          (TeacherSubject, TeacherSubject.specialization))),
+}
+_grade_fields = {'student': Grade.student, 'teacher': Grade.teacher, 'subject': Grade.subject}
+
+
+def _published_keys(kind, object_id):
+    if kind == 'subject':
+        return (SUBJECT_CHOICES,)
+    return (identity_key('S' if kind == 'student' else 'T', object_id),)
+
+
+def _listed_keys(kind, object_id):
+    """Versions of pages listing a record."""
+    if kind == 'student':
+        student = Student.get(Student.id == object_id)
+        return ['students', 'student:' + student.username, 'group:' + student.group]
+    if kind == 'teacher':
+        return ['teachers', 'teacher:' + Teacher.get(Teacher.id == object_id).username]
+    return ['subjects']
+
+
+def not_scheduled(kind, field=None):
+    """Condition excluding records of a kind scheduled for removal, or rows whose field refers to one.
+    They are deleted in the background, until then logins, listings, search, the API, exports, reports
+    and grading leave them out."""
+    if field is None:
+        field = _dependents[kind][0].id
+    return ~(field << PendingDeletion.select(PendingDeletion.object_id).where(PendingDeletion.kind == kind))
+
+
+def grades_not_scheduled():
+    """Condition excluding grades of students, teachers and subjects scheduled for removal."""
+    return (not_scheduled('student', Grade.student) & not_scheduled('teacher', Grade.teacher) &
+            not_scheduled('subject', Grade.subject))
+
+
+def _graded_students(condition):
+    return [student_id for student_id, in Grade.select(Grade.student).where(condition).distinct().tuples()]
+
+
+def _grading_teachers(condition):
+    return [teacher_id for teacher_id, in Grade.select(Grade.teacher).where(condition).distinct().tuples()]
+
+
+def delete_now(kind, object_id):
+    """Deletes a student, teacher or subject and every row referring to it, in one transaction.
+    Summaries of students graded by a removed teacher are recomputed. Returns True if the record existed."""
+    model_class, dependents = _dependents[kind]
+    condition = _grade_fields[kind] == object_id
+    with get_db().transaction():
+        graded = _graded_students(condition)
+        bump_grade_versions(graded, _grading_teachers(condition))  # while the removed record still exists
+        log_grades(DELETED, condition)
+        for dependent, field in dependents:
+            dependent.delete().where(field == object_id).execute()
+        deleted = model_class.delete().where(model_class.id == object_id).execute()
+        PendingDeletion.delete().where(PendingDeletion.kind == kind, PendingDeletion.object_id == object_id).execute()
+        if kind == 'teacher':
+            refresh_students(graded)  # summaries of other students and subjects stay as they are
+    if deleted:
+        publish(*_published_keys(kind, object_id))
+    return bool(deleted)
+
+
+def schedule(kind, object_id):
+    """Schedules removal of a record, done by purge, e.g. after get_purger().wake(). The record and its grades
+    are hidden from then on, pages listing them are revalidated."""
+    condition = _grade_fields[kind] == object_id
+    try:
+        with get_db().transaction():
+            PendingDeletion.create(kind=kind, object_id=object_id)
+            bump_versions(_listed_keys(kind, object_id))
+            bump_grade_versions(_graded_students(condition), _grading_teachers(condition))
+    except IntegrityError:  # already scheduled
+        return
+    publish(*_published_keys(kind, object_id))
+
+
+def remove(kind, object_id, threshold):
+    """Deletes a record at once if it has at most threshold grades, otherwise schedules it.
+    Returns True if it was deleted, False if scheduled."""
+    grades = Grade.select(Grade.id).where(_grade_fields[kind] == object_id).limit(threshold + 1).count()
+    if grades <= threshold:
+        delete_now(kind, object_id)
+        return True
+    schedule(kind, object_id)
+    return False
+
+
+def is_scheduled(kind, object_id):
+    return PendingDeletion.select().where(PendingDeletion.kind == kind,
+                                          PendingDeletion.object_id == object_id).exists()
+
+
+def purge_chunk(kind, object_id, chunk_size=PURGE_CHUNK_SIZE):
+    """Deletes up to chunk_size grades of a scheduled record, in one transaction; once none are left,
+    the record itself. Summaries of the students graded are recomputed. Returns the number of grades deleted,
+    0 when the removal is complete."""
+    chunk = Grade.id << (Grade.select(Grade.id).where(_grade_fields[kind] == object_id)
+                         .order_by(Grade.id).limit(chunk_size))
+    with get_db().transaction():
+        graded = _graded_students(chunk)
+        bump_grade_versions(graded, _grading_teachers(chunk))
+        log_grades(DELETED, chunk)
+        deleted = Grade.delete().where(chunk).execute()
+        refresh_students(graded)
+    if not deleted:
+        delete_now(kind, object_id)
+    return deleted
+
+
+def purge(chunk_size=PURGE_CHUNK_SIZE, pause=0):
+    """Completes every scheduled removal, sleeping pause seconds between chunks so that other
+    writers get the database lock. Returns the number of grades deleted."""
+    purged = 0
+    for kind, object_id in list(PendingDeletion.select(PendingDeletion.kind, PendingDeletion.object_id).tuples()):
+        while True:
+            deleted = purge_chunk(kind, object_id, chunk_size)
+            if not deleted:
+                break
+            purged += deleted
+            sleep(pause)
+    return purged
+
+
+class Purger(object):
+    """Thread of this worker running purge whenever a removal is scheduled, started by the first one."""
+    def __init__(self, chunk_size=PURGE_CHUNK_SIZE, pause=0.05):
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self._wake = Event()
+        self._lock = Lock()
+        self._thread = None
+
+    def wake(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='purger')
+                self._thread.daemon = True
+                self._thread.start()
+        self._wake.set()
+
+    def run_once(self):
+        db = get_db()
+        opened = db.is_closed()
+        if opened:
+            db.connect()
+        try:
+            return purge(self.chunk_size, self.pause)
+        finally:
+            if opened:
+                db.close()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            try:
+                self.run_once()
+            except Exception:  # e.g. the database is locked for long, the next removal retries
+                pass
+
+
+_purger = Purger()
+
+
+def get_purger():
+    return _purger
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Finish scheduled removals of students, teachers and subjects.')
+    parser.add_argument('--database', default='gradebook.db')
+    parser.add_argument('--chunk-size', type=int, default=PURGE_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+    db = get_db()
+    db.init(args.database)
+    print('{} grades purged.'.format(purge(args.chunk_size)))
+
+
+if __name__ == '__main__':
+    main()
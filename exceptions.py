@@ -1,2 +1,14 @@
 class WrongPassword(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class VerifierBusy(Exception):
+    pass
+
+
+class HistoryUnavailable(Exception):
+    pass
+
+
+class NonNumericGrades(Exception):
+    pass
@@ -0,0 +1,88 @@
+"""Gradebook export: grades of a group, a subject or the whole school as CSV or XLSX.
+Rows are read with a server-side cursor and written out as they arrive, so memory use does not grow with the export.
+XLSX is available only if openpyxl is installed."""
+import csv
+import io
+import re
+import tempfile
+from importlib.util import find_spec
+from flask import Response, abort, request, stream_with_context
+from werkzeug.wsgi import wrap_file
+from model import Student, Subject, Teacher, Grade
+from deletion import grades_not_scheduled
+
+COLUMNS = ('group', 'student', 'first_name', 'last_name', 'subject', 'grade', 'teacher')
+# openpyxl takes long to import, it is imported by the first XLSX export
+FORMATS = ('csv', 'xlsx') if find_spec('openpyxl') is not None else ('csv',)
+_rows_per_chunk = 500
+
+
+def grades_query():
+    """All grades with their student, subject and teacher, in Grade's natural (student, subject) order.
+    Grades of records scheduled for removal are left out."""
+    return (Grade
+            .select(Student.group, Student.username, Student.first_name, Student.last_name,
+                    Subject.name, Grade.grade, Teacher.username)
+            .join(Student)
+            .switch(Grade)
+            .join(Subject)
+            .switch(Grade)
+            .join(Teacher)
+            .where(grades_not_scheduled())
+            .order_by(Grade.student, Grade.subject, Grade.id))
+
+
+def _csv_chunks(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % _rows_per_chunk == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _attachment(filename):
+    return {'Content-Disposition': 'attachment; filename="{}"'.format(filename)}
+
+
+def export_response(query, name, fmt):
+    """Response with rows of given query, as an attachment named '<name>.<fmt>'."""
+    if fmt not in FORMATS:
+        abort(404)
+    name = re.sub(r'[^\w-]', '_', name)
+    rows = query.tuples().iterator()
+    filename = '{}.{}'.format(name, fmt)
+    if fmt == 'xlsx':
+        from openpyxl import Workbook
+        # write-only workbooks keep rows on disk, the finished file is then sent in blocks
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet(name[:31])
+        sheet.append(COLUMNS)
+        for row in rows:
+            sheet.append(row)
+        output = tempfile.TemporaryFile()
+        workbook.save(output)
+        output.seek(0)
+        return Response(wrap_file(request.environ, output), direct_passthrough=True, headers=_attachment(filename),
+                        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    return Response(stream_with_context(_csv_chunks(rows)), mimetype='text/csv', headers=_attachment(filename))
+
+
+def export_group(group_number, fmt):
+    return export_response(grades_query().where(Student.group == str(group_number)),
+                           'group_{}_grades'.format(group_number), fmt)
+
+
+def export_subject(name, fmt):
+    return export_response(grades_query().where(Subject.name == name), '{}_grades'.format(name), fmt)
+
+
+def export_school(fmt):
+    return export_response(grades_query(), 'school_grades', fmt)
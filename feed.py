@@ -0,0 +1,156 @@
+"""Server-Sent Events feed of new grades, for a student's profile and for a group page.
+One poller thread per worker reads grades logged as created since the last event it has seen (a single
+query of the primary key of the append-only grade log, see audit.py) and hands them to the connections
+subscribed in this worker, so idle connections cost no queries. Events are never deleted, so their ids,
+unlike those of grades, are not reused and the poller misses none. add_grade_ and bulk grading wake the
+poller at once; grades given through other workers arrive within FEED_POLL_INTERVAL. Streams hold no
+database connection.
+
+Every open stream occupies its server thread, so deployments with many listeners should run
+an asynchronous worker class, e.g. gunicorn -k gevent, where they are greenlets instead."""
+import json
+from queue import Queue, Full, Empty
+from threading import Event, Lock, Thread
+from flask import Response
+from peewee import fn
+from model import Student, Subject, GradeEvent, get_db
+from audit import CREATED
+
+HEARTBEAT_SECONDS = 15
+_queue_size = 100
+
+
+def _grade_events(after_id, condition=None, limit=None):
+    query = (GradeEvent
+             .select(GradeEvent.id, GradeEvent.grade_id, GradeEvent.grade, Student.id, Student.username,
+                     Student.group, Subject.id, Subject.name)
+             .join(Student, on=(GradeEvent.student_id == Student.id))
+             .switch(GradeEvent)
+             .join(Subject, on=(GradeEvent.subject_id == Subject.id))
+             .where((GradeEvent.id > after_id) & (GradeEvent.action == CREATED))
+             .order_by(GradeEvent.id)
+             .tuples())
+    if condition is not None:
+        query = query.where(condition)
+    if limit is not None:
+        query = query.limit(limit)
+    return [dict(id=event_id, grade_id=grade_id, grade=str(grade), student_id=student_id, student=username,
+                 group=group, subject_id=subject_id, subject=subject)
+            for event_id, grade_id, grade, student_id, username, group, subject_id, subject in query]
+
+
+def latest_event_id():
+    """Id of the latest event of the grade log, 0 if there is none."""
+    return GradeEvent.select(fn.MAX(GradeEvent.id)).scalar() or 0
+
+
+class GradeFeed(object):
+    def __init__(self, poll_interval=2.0):
+        self.poll_interval = poll_interval
+        self._subscribers = {}  # queue: filter function
+        self._lock = Lock()
+        self._wake = Event()
+        self._last_id = None
+        self._thread = None
+
+    def subscribe(self, accepts, after_id):
+        """Queue receiving grade events for which accepts(event) is true, from those after after_id
+        (see latest_event_id) on, unless other subscribers have had them delivered already."""
+        queue = Queue(_queue_size)
+        with self._lock:
+            if self._last_id is None or not self._subscribers:  # grades from before do not matter
+                self._last_id = after_id
+            self._subscribers[queue] = accepts
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='grade-feed')
+                self._thread.daemon = True
+                self._thread.start()
+        return queue
+
+    def unsubscribe(self, queue):
+        with self._lock:
+            self._subscribers.pop(queue, None)
+
+    def notify(self):
+        """Makes the poller look for new grades now, instead of after the poll interval."""
+        self._wake.set()
+
+    def poll(self):
+        """Delivers grades added since the previous poll to subscribers. Returns number of grades read."""
+        with self._lock:
+            after_id = self._last_id
+        db = get_db()
+        opened = db.is_closed()
+        if opened:
+            db.connect()
+        try:
+            events = _grade_events(after_id)
+        finally:
+            if opened:
+                db.close()
+        with self._lock:
+            events = [event for event in events if event['id'] > self._last_id]  # not delivered meanwhile
+            if events:
+                self._last_id = events[-1]['id']
+            subscribers = list(self._subscribers.items())
+        for event in events:
+            for queue, accepts in subscribers:
+                if accepts(event):
+                    try:
+                        queue.put_nowait(event)
+                    except Full:  # a client not reading its stream loses events rather than memory
+                        pass
+        return len(events)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            with self._lock:
+                if not self._subscribers:
+                    continue
+            try:
+                self.poll()
+            except Exception:  # the database may be briefly unavailable, keep the feed alive
+                pass
+
+
+_feed = GradeFeed()
+
+
+def get_feed():
+    return _feed
+
+
+def _format(event):
+    return 'id: {}\nevent: grade\ndata: {}\n\n'.format(event['id'], json.dumps(event))
+
+
+def event_stream(accepts, condition, last_event_id=None):
+    """Response streaming grade events accepted by accepts. Grades, which a reconnecting client missed
+    after its Last-Event-ID, are read from the database (matching condition) before streaming starts.
+    The stream subscribes once the server starts sending it, so a response which is never sent leaves
+    no subscription behind."""
+    latest = latest_event_id()
+    missed = []
+    if last_event_id is not None:
+        missed = _grade_events(last_event_id, condition, limit=_queue_size)
+    sent = missed[-1]['id'] if missed else 0
+
+    def stream():
+        queue = _feed.subscribe(accepts, latest)
+        try:
+            for event in missed:
+                yield _format(event)
+            while True:
+                try:
+                    event = queue.get(timeout=HEARTBEAT_SECONDS)
+                    if event['id'] > sent:  # not among the missed ones
+                        yield _format(event)
+                except Empty:
+                    yield ': heartbeat\n\n'  # keeps proxies from closing the connection
+        finally:
+            _feed.unsubscribe(queue)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
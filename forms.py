@@ -1,8 +1,11 @@
 from flask import flash
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired
 from wtforms import StringField, PasswordField, SelectField, DecimalField, SubmitField
-from wtforms.validators import InputRequired, EqualTo, Length
-from model import Student, Subject
+from wtforms.validators import InputRequired, EqualTo, Length, NumberRange
+from model import Subject, MIN_GRADE, MAX_GRADE
+from cache import get_cache, SUBJECT_CHOICES
+from deletion import not_scheduled
 
 _ir_msg_template = '%s field is required.'
 _l_msg_template = '%s field has to be %d-%d characters long.'
@@ -39,6 +42,11 @@ class NewTeacherForm(FlaskForm):
     submit = SubmitField('Submit')
 
 
+class ImportForm(FlaskForm):
+    file = FileField('CSV file', validators=[FileRequired(message=_ir_msg_template % 'CSV file')])
+    submit = SubmitField('Import')
+
+
 class TeacherEditForm(FlaskForm):
     first_name = StringField('First name', validators=[InputRequired(message=_ir_msg_template % 'First name')])
     last_name = StringField('Last name', validators=[InputRequired(message=_ir_msg_template % 'Last name')])
@@ -75,33 +83,55 @@ class StudentLoginForm(FlaskForm):
     submit = SubmitField('Login')
 
 
+def _load_subject_choices():
+    options = [(name, name) for name, in Subject.select(Subject.name).where(not_scheduled('subject')).tuples()]
+    options.insert(0, ('', ''))  # add first empty option
+    return options
+
+
+def subject_choices():
+    """Options of subject select fields, cached until invalidated by a change of subjects."""
+    return get_cache().get(SUBJECT_CHOICES, _load_subject_choices)
+
+
 class AddGradeForm(FlaskForm):
-    _student_query = Student.select()
-    _student_options = [(student.username, student.first_name + ' ' + student.last_name) for student in _student_query]
-    _student_options.insert(0, ('', ''))
-    student_select = SelectField(
-        'Student',
-        validators=[InputRequired(message=_ir_msg_template % 'Student')],
-        choices=_student_options)
-
-    _subject_query = Subject.select()
-    _subject_options = [(subject.name, subject.name) for subject in _subject_query]
-    _subject_options.insert(0, ('', ''))  # add first empty option
+    # a username, completed by the search endpoint instead of listing every student
+    student_select = StringField('Student', validators=[InputRequired(message=_ir_msg_template % 'Student')])
     subject_select = SelectField(
         'Subject',
         validators=[InputRequired(message=_ir_msg_template % 'Subject')],
-        choices=_subject_options)
-
-    grade = DecimalField('Grade', validators=[InputRequired(message=_ir_msg_template % 'Grade')])
+        choices=[])
+    grade = DecimalField('Grade', validators=[
+        InputRequired(message=_ir_msg_template % 'Grade'),
+        NumberRange(min=MIN_GRADE, max=MAX_GRADE, message='Grade has to be between %d and %d.' % (MIN_GRADE, MAX_GRADE))])
     submit = SubmitField('Submit')
 
+    def __init__(self, *args, **kwargs):
+        super(AddGradeForm, self).__init__(*args, **kwargs)
+        self.subject_select.choices = subject_choices()
+
 
 class AddSpecializationForm(FlaskForm):
-    _subject_query = Subject.select()
-    _subject_options = [(subject.name, subject.name) for subject in _subject_query]
-    _subject_options.insert(0, ('', ''))
     subject_select = SelectField(
         'Subject',
         validators=[InputRequired(message=_ir_msg_template % 'Subject')],
-        choices=_subject_options)
-    submit = SubmitField('Submit')
\ No newline at end of file
+        choices=[])
+    submit = SubmitField('Submit')
+
+    def __init__(self, *args, **kwargs):
+        super(AddSpecializationForm, self).__init__(*args, **kwargs)
+        self.subject_select.choices = subject_choices()
+
+
+class BulkGradeForm(FlaskForm):
+    """Grades of one subject for a whole group.
+    Grade inputs are rendered per student as 'grade_<student id>' and validated by the view."""
+    subject_select = SelectField(
+        'Subject',
+        validators=[InputRequired(message=_ir_msg_template % 'Subject')],
+        choices=[])
+    submit = SubmitField('Submit')
+
+    def __init__(self, *args, **kwargs):
+        super(BulkGradeForm, self).__init__(*args, **kwargs)
+        self.subject_select.choices = subject_choices()
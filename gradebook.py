@@ -1,101 +1,180 @@
 """Gradebook web application, by Adrian Trawka - https://github.com/a-trawka"""
+import os
+import stat
 from flask import Flask, g, render_template
-from wrappers import login_required, guest_status_required, teacher_required, student_required
-from model import *
-from admin import admin_blueprint
-from view import student_login_, student_profile_, student_profile_foreign_, add_grade_, \
-    teacher_login_, teacher_profile_, groups_, group_, group_foreign_, logout_
-
-app = Flask(__name__)
-app.config['DEBUG'] = True
-app.config['SECRET_KEY'] = 'development'
-app.config['WTF_CSRF_ENABLED'] = False
-app.register_blueprint(admin_blueprint, url_prefix='/admin')
-
-db = get_db()
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.utils import import_string
+from wrappers import login_required, guest_status_required, teacher_required, student_required, \
+    teacher_or_admin_required
+from model import configure_db, get_db, MIN_GRADE, MAX_GRADE
+from instrumentation import init_instrumentation
+from passwords import configure_verifier
+from invalidation import get_bus
+from feed import get_feed
+from deletion import get_purger
+
+# Startup does no more than the first request needs: views of view.py and export.py, and the importer used by
+# admin.py, are imported by their first request, so are openpyxl, numpy and bcrypt by the code using them, and
+# the database is connected by the first request. Templates are compiled to bytecode cached on disk, which later workers load instead.
+
+
+class LazyView(object):
+    """View function given by its import name, imported when it is first called."""
+    def __init__(self, import_name):
+        self.__module__, self.__name__ = import_name.rsplit('.', 1)
+        self.import_name = import_name
+        self._view = None
+
+    def __call__(self, *args, **kwargs):
+        if self._view is None:
+            self._view = import_string(self.import_name)
+        return self._view(*args, **kwargs)
+
+
+def template_cache(directory=None):
+    """Bytecode cache of templates in directory, created private to this user. Cached bytecode is executed,
+    so a directory others own or may write to is refused. None uses Jinja's default, a private directory
+    of this user in the temporary directory, checked likewise."""
+    if directory is None:
+        return FileSystemBytecodeCache()
+    if not os.path.isdir(directory):
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.lstat(directory)
+    if (not stat.S_ISDIR(info.st_mode) or info.st_mode & 0o022 or
+            hasattr(os, 'getuid') and info.st_uid != os.getuid()):
+        raise RuntimeError('Template cache directory {} has to be owned and writable only by this user.'.format(
+            directory))
+    return FileSystemBytecodeCache(directory)
+
+
+def create_app(config=None):
+    """Application with default settings, overridden by the file named by GRADEBOOK_SETTINGS and then by config."""
+    app = Flask(__name__)
+    app.config['DEBUG'] = True
+    app.config['SECRET_KEY'] = 'development'
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['INSTRUMENTATION'] = False
+    app.config['ADMIN_PAGE_SIZE'] = 50  # rows of admin listings, ?per_page= overrides up to ADMIN_MAX_PAGE_SIZE
+    app.config['ADMIN_MAX_PAGE_SIZE'] = 500
+    app.config['CONDITIONAL_PAGES'] = True  # ETags and a cache of rendered pages, see versions.py
+    app.config['PAGE_CACHE_SIZE'] = 1000
+    app.config['SESSION_IDENTITY'] = True  # pages needing only name and group read them from the session
+    app.config['FEED_POLL_INTERVAL'] = 2.0  # seconds until grades given through other workers are pushed
+    app.config['INVALIDATION_POLL_INTERVAL'] = 1.0  # seconds, how stale other workers' writes may be in caches
+    app.config['DATABASE'] = 'gradebook.db'
+    app.config['DATABASE_PRAGMAS'] = [
+        ('journal_mode', 'wal'),  # readers do not block the writer and vice versa
+        ('busy_timeout', 5000),  # ms to wait for a lock held by another worker
+        ('synchronous', 'normal'),  # safe with WAL, fsync on checkpoints only
+        ('cache_size', -16000),  # KiB
+        ('mmap_size', 64 * 1024 * 1024),
+    ]
+    app.config['DATABASE_MAX_CONNECTIONS'] = 20
+    app.config['DATABASE_STALE_TIMEOUT'] = 300
+    app.config['PASSWORD_WORKERS'] = 2  # processes checking login passwords
+    app.config['PASSWORD_QUEUE_LIMIT'] = 32  # logins waiting beyond this are answered with 503 at once
+    app.config['PASSWORD_TIMEOUT'] = 10
+    app.config['DELETE_IN_BACKGROUND_ABOVE'] = 10000  # grades; removals of records with more are purged in chunks
+    app.config['PURGE_CHUNK_SIZE'] = 1000
+    app.config['TEMPLATE_CACHE'] = True  # compiled templates, shared by workers and kept across restarts
+    app.config['TEMPLATE_CACHE_DIR'] = None  # None: Jinja's private directory of this user
+    app.config.from_envvar('GRADEBOOK_SETTINGS', silent=True)
+    app.config.update(config or {})
+
+    if app.config['TEMPLATE_CACHE']:
+        app.jinja_env.bytecode_cache = template_cache(app.config['TEMPLATE_CACHE_DIR'])
+
+    app.jinja_env.globals.update(MIN_GRADE=MIN_GRADE, MAX_GRADE=MAX_GRADE)  # bounds of grade inputs
+    from admin import admin_blueprint
+    from api import api_blueprint
+    app.register_blueprint(admin_blueprint, url_prefix='/admin')
+    app.register_blueprint(api_blueprint, url_prefix='/api/v1')
+    for rule, endpoint, view_func, methods in _routes:
+        app.add_url_rule(rule, endpoint, view_func, methods=methods)
+    app.before_request(before_request)
+    app.teardown_request(teardown_request)
+
+    configure_db(app.config['DATABASE'], app.config['DATABASE_PRAGMAS'],
+                 app.config['DATABASE_MAX_CONNECTIONS'], app.config['DATABASE_STALE_TIMEOUT'])
+    init_instrumentation(app, get_db())
+    get_bus().poll_interval = app.config['INVALIDATION_POLL_INTERVAL']
+    get_feed().poll_interval = app.config['FEED_POLL_INTERVAL']
+    get_purger().chunk_size = app.config['PURGE_CHUNK_SIZE']
+    configure_verifier(app.config['PASSWORD_WORKERS'], app.config['PASSWORD_QUEUE_LIMIT'],
+                       app.config['PASSWORD_TIMEOUT'])
+    return app
+
+
+def warm_up(app):
+    """Does what the first requests would otherwise do: imports every view, compiles (or loads from
+    the bytecode cache) every template and opens a database connection. Call it in a new worker,
+    e.g. from gunicorn's post_worker_init hook, before it takes requests."""
+    for rule, endpoint, view_func, methods in _routes:
+        view_func = getattr(view_func, '__wrapped__', view_func)
+        if isinstance(view_func, LazyView):
+            import_string(view_func.import_name)
+    for name in app.jinja_env.list_templates():
+        if name.endswith('.html'):
+            app.jinja_env.get_template(name)
+    db = get_db()
+    db.connect()
+    db.close()
 
 
 def create_tables():
-    """Create database tables from models, unless they already exist."""
-    db.create_tables([Student, Teacher, Subject, TeacherSubject, Grade], safe=True)
+    """Create database tables, or migrate existing ones to the current schema (see migrations.py)."""
+    from migrations import run_migrations
+    run_migrations(get_db())
 
 
-@app.before_request
 def before_request():
+    db = get_db()
     g.db = db
-    db.connect()
+    if db.is_closed():
+        db.connect()
+    get_bus().poll()  # drop what other workers changed
 
 
-@app.after_request
-def after_request(response):
-    g.db.close()
-    return response
+def teardown_request(exc):
+    # runs after streamed responses have finished, as well as after views which raised;
+    # the connection goes back to the pool
+    db = get_db()
+    if not db.is_closed():
+        db.close()
 
 
 # URL routes:
-@app.route('/')
 def homepage():
     return render_template('homepage.html')
 
 
-@app.route('/student_login/', methods=['GET', 'POST'])
-@guest_status_required
-def student_login():
-    return student_login_()
-
-
-@app.route('/student_profile/')
-@student_required
-def student_profile():
-    return student_profile_()
-
-
-@app.route('/student_profile/<username>')
-@teacher_required
-def student_profile_foreign(username):
-    return student_profile_foreign_(username)
-
-
-@app.route('/add_grade/', methods=['GET', 'POST'])
-@teacher_required
-def add_grade():
-    return add_grade_()
-
-
-@app.route('/teacher_login/', methods=['GET', 'POST'])
-@guest_status_required
-def teacher_login():
-    return teacher_login_()
-
-
-@app.route('/teacher_profile/')
-@teacher_required
-def teacher_profile():
-    return teacher_profile_()
-
-
-@app.route('/groups/')
-@teacher_required
-def groups():
-    return groups_()
-
-
-@app.route('/group/')
-@student_required
-def group():
-    return group_()
-
-
-@app.route('/group/<int:group_number>/')
-@teacher_required
-def group_foreign(group_number):
-    return group_foreign_(group_number)
-
-
-@app.route('/logout/')
-@login_required
-def logout():
-    return logout_()
+_get_post = ['GET', 'POST']
+# (rule, endpoint, view function, methods)
+_routes = [
+    ('/', 'homepage', homepage, None),
+    ('/student_login/', 'student_login', guest_status_required(LazyView('view.student_login_')), _get_post),
+    ('/student_profile/', 'student_profile', student_required(LazyView('view.student_profile_')), None),
+    ('/student_profile/<username>', 'student_profile_foreign',
+     teacher_required(LazyView('view.student_profile_foreign_')), None),
+    ('/add_grade/', 'add_grade', teacher_required(LazyView('view.add_grade_')), _get_post),
+    ('/teacher_login/', 'teacher_login', guest_status_required(LazyView('view.teacher_login_')), _get_post),
+    ('/teacher_profile/', 'teacher_profile', teacher_required(LazyView('view.teacher_profile_')), None),
+    ('/groups/', 'groups', teacher_required(LazyView('view.groups_')), None),
+    ('/group/', 'group', student_required(LazyView('view.group_')), None),
+    ('/group/<int:group_number>/', 'group_foreign', teacher_required(LazyView('view.group_foreign_')), _get_post),
+    ('/group/<int:group_number>/analytics', 'group_analytics',
+     teacher_required(LazyView('view.group_analytics_')), None),
+    ('/group/<int:group_number>/export.<any(csv, xlsx):fmt>', 'group_export',
+     teacher_or_admin_required(LazyView('export.export_group')), None),
+    ('/subject/<name>/export.<any(csv, xlsx):fmt>', 'subject_export',
+     teacher_or_admin_required(LazyView('export.export_subject')), None),
+    ('/feed/', 'student_feed', student_required(LazyView('view.student_feed_')), None),
+    ('/group/<int:group_number>/feed', 'group_feed', teacher_required(LazyView('view.group_feed_')), None),
+    ('/search/', 'search', teacher_or_admin_required(LazyView('view.search_')), None),
+    ('/logout/', 'logout', login_required(LazyView('view.logout_')), None),
+]
+
+app = create_app()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,120 @@
+"""Bulk import of students and teachers from CSV files.
+Rows are validated with NewStudentForm/NewTeacherForm, passwords are hashed across a process pool
+(bcrypt is CPU-bound, threads would be serialized by the GIL) and records are inserted in batched transactions.
+A duplicate username rejects only its own row.
+
+    python importer.py students students.csv
+    python importer.py teachers teachers.csv --workers 8
+
+CSV files need a header row: first_name, last_name, group (students only), username, password."""
+import argparse
+import csv
+import io
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.datastructures import MultiDict
+from forms import NewStudentForm, NewTeacherForm
+from model import Student, Teacher, get_db, insert_in_batches
+from passwords import hash_password
+from peewee import IntegrityError
+
+KINDS = {
+    'students': (Student, NewStudentForm, ('first_name', 'last_name', 'group', 'username')),
+    'teachers': (Teacher, NewTeacherForm, ('first_name', 'last_name', 'username')),
+}
+BATCH_SIZE = 500
+
+
+class ImportReport(object):
+    def __init__(self):
+        self.created = 0
+        self.errors = []  # (line number, username, message)
+
+    def error(self, line, username, message):
+        self.errors.append((line, username, message))
+
+    @property
+    def rejected(self):
+        return len(set(line for line, username, message in self.errors))
+
+
+def _validated_rows(rows, form_class, fields, report):
+    """Yields (line number, record) of rows accepted by form_class. Rejected rows are added to report."""
+    for line, row in enumerate(rows, 2):  # line 1 is the header
+        row = {key.strip(): (value or '') if key.strip() == 'password' else (value or '').strip()
+               for key, value in row.items() if key}
+        formdata = MultiDict(row)
+        formdata['confirm'] = row.get('password', '')
+        form = form_class(formdata=formdata, meta={'csrf': False})
+        if not form.validate():
+            for errors in form.errors.values():
+                for message in errors:
+                    report.error(line, row.get('username', ''), message)
+            continue
+        record = {field: getattr(form, field).data for field in fields}
+        record['password'] = form.password.data
+        yield line, record
+
+
+def _insert_batch(model_class, batch, report):
+    """Inserts a batch in one transaction. If a username is taken, rows are retried one by one,
+    so that only conflicting rows are rejected."""
+    db = get_db()
+    with db.transaction():
+        try:
+            with db.savepoint():
+                insert_in_batches(model_class, (record for line, record in batch))
+            report.created += len(batch)
+            return
+        except IntegrityError:
+            pass
+        for line, record in batch:
+            try:
+                with db.savepoint():
+                    model_class.insert(**record).execute()
+            except IntegrityError:
+                report.error(line, record['username'], 'Username already taken')
+            else:
+                report.created += 1
+
+
+def import_users(kind, csv_file, workers=None, batch_size=BATCH_SIZE):
+    """Imports students or teachers (kind) from a text-mode CSV file object. Returns ImportReport.
+    Has to be called within Flask app context, since forms used for validation depend on it."""
+    model_class, form_class, fields = KINDS[kind]
+    report = ImportReport()
+    rows = list(_validated_rows(csv.DictReader(csv_file), form_class, fields, report))
+    if rows:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            hashes = pool.map(hash_password, [record['password'] for line, record in rows], chunksize=16)
+            for (line, record), password in zip(rows, hashes):
+                record['password'] = password
+    for start in range(0, len(rows), batch_size):
+        _insert_batch(model_class, rows[start:start + batch_size], report)
+    report.errors.sort()
+    return report
+
+
+def import_upload(kind, file_storage, workers=None):
+    """import_users for a file uploaded through a form."""
+    return import_users(kind, io.TextIOWrapper(file_storage.stream, encoding='utf-8-sig'), workers)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Import students or teachers from a CSV file.')
+    parser.add_argument('kind', choices=sorted(KINDS))
+    parser.add_argument('file')
+    parser.add_argument('--database', default='gradebook.db')
+    parser.add_argument('--workers', type=int, help='hashing processes, number of CPUs by default')
+    args = parser.parse_args(argv)
+
+    from gradebook import app
+    get_db().init(args.database)
+    with app.app_context(), open(args.file, encoding='utf-8-sig', newline='') as csv_file:
+        report = import_users(args.kind, csv_file, args.workers)
+    for line, username, message in report.errors:
+        print('line {} ({}): {}'.format(line, username, message))
+    print('{} {} imported, {} rows rejected.'.format(report.created, args.kind, report.rejected))
+
+
+if __name__ == '__main__':
+    main()
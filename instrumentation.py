@@ -0,0 +1,175 @@
+"""Optional per-request instrumentation: query count, SQL time, template render time and wall time.
+Enabled with app.config['INSTRUMENTATION'], aggregated per endpoint and exposed by /admin/metrics/."""
+import heapq
+from threading import Lock
+from time import perf_counter
+from flask import current_app, g, request, has_app_context
+from jinja2 import Template
+
+_QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+_MS_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class Histogram(object):
+    """Fixed-bucket histogram. A value falls into the first bucket whose upper bound it does not exceed."""
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def as_dict(self):
+        labels = ['<={}'.format(bound) for bound in self.bounds] + ['>{}'.format(self.bounds[-1])]
+        return {'count': self.count,
+                'total': round(self.total, 3),
+                'mean': round(self.total / self.count, 3) if self.count else 0,
+                'max': round(self.max, 3),
+                'histogram': dict(zip(labels, self.counts))}
+
+
+class EndpointStats(object):
+    def __init__(self):
+        self.errors = 0
+        self.queries = Histogram(_QUERY_BUCKETS)
+        self.sql_ms = Histogram(_MS_BUCKETS)
+        self.render_ms = Histogram(_MS_BUCKETS)
+        self.wall_ms = Histogram(_MS_BUCKETS)
+
+    def as_dict(self):
+        return {'requests': self.wall_ms.count,
+                'errors': self.errors,
+                'queries': self.queries.as_dict(),
+                'sql_ms': self.sql_ms.as_dict(),
+                'render_ms': self.render_ms.as_dict(),
+                'wall_ms': self.wall_ms.as_dict()}
+
+
+class RequestMetrics(object):
+    """Measurements of a single request, kept on flask.g while it is handled."""
+    def __init__(self):
+        self.start = perf_counter()
+        self.queries = 0
+        self.sql_time = 0.0
+        self.render_time = 0.0
+        self.status = None
+
+
+class MetricsRegistry(object):
+    """Process-wide, thread-safe store of per-endpoint statistics and of the slowest statements seen."""
+    def __init__(self, slow_query_log_size=20):
+        self.slow_query_log_size = slow_query_log_size
+        self._endpoints = {}
+        self._slow_queries = []  # min-heap of (seconds, sequence number, entry)
+        self._sequence = 0
+        self._lock = Lock()
+
+    def record_request(self, endpoint, metrics, wall_time):
+        with self._lock:
+            stats = self._endpoints.setdefault(endpoint, EndpointStats())
+            if metrics.status is None or metrics.status >= 500:
+                stats.errors += 1
+            stats.queries.add(metrics.queries)
+            stats.sql_ms.add(metrics.sql_time * 1000)
+            stats.render_ms.add(metrics.render_time * 1000)
+            stats.wall_ms.add(wall_time * 1000)
+
+    def record_query(self, endpoint, sql, params, seconds):
+        entry = {'endpoint': endpoint, 'sql': sql, 'params': [str(param) for param in params or ()],
+                 'ms': round(seconds * 1000, 3)}
+        with self._lock:
+            self._sequence += 1
+            item = (seconds, self._sequence, entry)
+            if len(self._slow_queries) < self.slow_query_log_size:
+                heapq.heappush(self._slow_queries, item)
+            elif seconds > self._slow_queries[0][0]:
+                heapq.heapreplace(self._slow_queries, item)
+
+    def snapshot(self):
+        with self._lock:
+            return {'endpoints': {name: stats.as_dict() for name, stats in self._endpoints.items()},
+                    'slow_queries': [entry for _, _, entry in sorted(self._slow_queries, reverse=True)]}
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+            self._slow_queries = []
+
+
+_registry = MetricsRegistry()
+
+
+def get_metrics():
+    return _registry
+
+
+def _current_request_metrics():
+    if has_app_context():
+        return getattr(g, 'request_metrics', None)
+
+
+class TimedTemplate(Template):
+    """Jinja template, which adds its render time to metrics of the current request."""
+    def render(self, *args, **kwargs):
+        start = perf_counter()
+        try:
+            return Template.render(self, *args, **kwargs)
+        finally:
+            metrics = _current_request_metrics()
+            if metrics is not None:
+                metrics.render_time += perf_counter() - start
+
+
+def init_instrumentation(app, db):
+    """Registers request hooks, the query listener and the timed template class.
+    Measurements are only taken while app.config['INSTRUMENTATION'] is set."""
+    app.config.setdefault('INSTRUMENTATION', False)
+    app.config.setdefault('INSTRUMENTATION_SLOW_QUERY_MS', 100)
+    app.config.setdefault('INSTRUMENTATION_SLOW_QUERY_LOG_SIZE', 20)
+    _registry.slow_query_log_size = app.config['INSTRUMENTATION_SLOW_QUERY_LOG_SIZE']
+    app.jinja_env.template_class = TimedTemplate
+
+    def on_query(sql, params, seconds):
+        metrics = _current_request_metrics()
+        if metrics is None or current_app._get_current_object() is not app:  # one listener per application
+            return
+        metrics.queries += 1
+        metrics.sql_time += seconds
+        _registry.record_query(request.endpoint, sql, params, seconds)
+        if seconds * 1000 >= app.config['INSTRUMENTATION_SLOW_QUERY_MS']:
+            app.logger.warning('Slow query (%.1f ms) in %s: %s %r', seconds * 1000, request.endpoint, sql, params)
+
+    db.listeners.append(on_query)
+
+    @app.before_request
+    def start_request_metrics():
+        if app.config['INSTRUMENTATION']:
+            g.request_metrics = RequestMetrics()
+
+    @app.after_request
+    def add_timing_headers(response):
+        metrics = _current_request_metrics()
+        if metrics is not None:
+            metrics.status = response.status_code
+            response.headers['X-Query-Count'] = str(metrics.queries)
+            response.headers['Server-Timing'] = 'sql;dur={:.3f}, render;dur={:.3f}, total;dur={:.3f}'.format(
+                metrics.sql_time * 1000, metrics.render_time * 1000, (perf_counter() - metrics.start) * 1000)
+        return response
+
+    @app.teardown_request
+    def finish_request_metrics(exc):
+        metrics = _current_request_metrics()
+        if metrics is not None:
+            g.request_metrics = None
+            _registry.record_request(request.endpoint or 'unknown', metrics, perf_counter() - metrics.start)
@@ -0,0 +1,82 @@
+"""Invalidation of in-process caches across worker processes.
+A write publishes the cache keys it affects; every worker polls the change log now and then
+(INVALIDATION_POLL_INTERVAL, one indexed query) and drops only those keys from its own cache.
+The change log is the changeevent table of the gradebook database by default. Other backends,
+e.g. Redis streams, need only publish(keys), latest() and read(after_id)."""
+import json
+from threading import Lock
+from time import time
+from cache import get_cache
+from model import ChangeEvent, get_db, insert_in_batches
+
+
+class DatabaseChangeLog(object):
+    """Change log stored in the database, trimmed to the keep most recent events."""
+    def __init__(self, keep=10000):
+        self.keep = keep
+
+    def publish(self, keys):
+        with get_db().transaction():
+            insert_in_batches(ChangeEvent, ({'key': key} for key in keys))
+            ChangeEvent.delete().where(ChangeEvent.id <= self.latest() - self.keep).execute()
+
+    def latest(self):
+        return ChangeEvent.select(ChangeEvent.id).order_by(ChangeEvent.id.desc()).scalar() or 0
+
+    def read(self, after_id):
+        """(id, key) of events after given id, oldest first."""
+        return list(ChangeEvent.select(ChangeEvent.id, ChangeEvent.key)
+                    .where(ChangeEvent.id > after_id).order_by(ChangeEvent.id).tuples())
+
+
+def _decode(key):
+    key = json.loads(key)
+    return tuple(key) if isinstance(key, list) else key  # tuples were encoded as lists
+
+
+class InvalidationBus(object):
+    def __init__(self, cache, backend=None, poll_interval=1.0):
+        self.cache = cache
+        self.backend = backend or DatabaseChangeLog()
+        self.poll_interval = poll_interval
+        self._last_id = None
+        self._last_poll = 0
+        self._lock = Lock()
+
+    def publish(self, *keys):
+        """Drops keys from the local cache and announces them to other workers.
+        Call after the transaction changing the data has been committed."""
+        self.cache.invalidate(*keys)
+        self.backend.publish([json.dumps(key) for key in keys])
+
+    def poll(self, force=False):
+        """Drops keys published by any worker since the previous poll. Returns the number of events applied.
+        If events were trimmed before this worker read them, the whole cache is cleared."""
+        with self._lock:
+            now = time()
+            if not force and now - self._last_poll < self.poll_interval:
+                return 0
+            self._last_poll = now
+            if self._last_id is None:  # nothing cached yet, older events do not matter
+                self._last_id = self.backend.latest()
+                return 0
+            events = self.backend.read(self._last_id)
+            if not events:
+                return 0
+            if events[0][0] > self._last_id + 1:
+                self.cache.clear()
+            else:
+                self.cache.invalidate(*set(_decode(key) for event_id, key in events))
+            self._last_id = events[-1][0]
+            return len(events)
+
+
+_bus = InvalidationBus(get_cache())
+
+
+def get_bus():
+    return _bus
+
+
+def publish(*keys):
+    _bus.publish(*keys)
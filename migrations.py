@@ -0,0 +1,256 @@
+"""Versioned schema migrations of gradebook databases, new and existing.
+
+    python migrations.py --database gradebook.db              applies pending migrations
+    python migrations.py --database gradebook.db --status     lists migrations and their timings
+    python migrations.py --database gradebook.db --batch-size 5000
+
+MIGRATIONS is the ordered history of the schema; the schemamigration table records which of them
+a database has, when they were applied and how long they took, so each runs once. Migrations still check
+whether they are needed, since databases created before the table may already have their changes.
+Backfills of large tables run online, in batches of BATCH_SIZE ids, each committed on its own with
+a pause in between, so grading waits for one batch at most. SQLite builds an index, and rebuilds
+a table for a changed column, in a single statement; those hold the write lock until done."""
+import argparse
+from datetime import datetime
+from time import sleep, time
+from peewee import DecimalField
+from playhouse.migrate import SqliteMigrator, migrate
+from model import Student, Teacher, Subject, TeacherSubject, Grade, GradeSummary, ResourceVersion, ChangeEvent, \
+    PendingDeletion, SchemaMigration, get_db
+from versions import create_version_triggers
+from search import create_search_index
+from audit import create_audit_log
+import summaries
+from exceptions import NonNumericGrades
+
+BATCH_SIZE = 10000  # rows of a backfill committed at once
+BATCH_PAUSE = 0.01  # seconds between batches, in which other writers get the lock
+
+
+def in_batches(db, table, *statements, column='id'):
+    """Runs statements, each with placeholders for a range 'column > ? AND column <= ?', over all rows
+    of table in ranges of BATCH_SIZE values of column, all statements of a range in its own transaction."""
+    low, high = db.execute_sql('SELECT MIN("{0}"), MAX("{0}") FROM "{1}"'.format(column, table)).fetchone()
+    if low is None:
+        return
+    for start in range(low - 1, high, BATCH_SIZE):
+        with db.transaction():
+            for statement in statements:
+                db.execute_sql(statement, [start, start + BATCH_SIZE])
+        sleep(BATCH_PAUSE)
+
+
+def _columns(db, table):
+    """{column name: declared type} of given table."""
+    return {row[1]: row[2] for row in db.execute_sql('PRAGMA table_info("{}")'.format(table))}
+
+
+def initial_schema(db):
+    """Creates tables of the first version in an empty database: students, teachers, subjects,
+    specializations and grades. Their indexes are those of the current models, later migrations find them."""
+    if set(db.get_tables()) & {'student', 'teacher', 'subject', 'teachersubject', 'grade'}:
+        return False
+    db.create_tables([Student, Teacher, Subject, TeacherSubject, Grade])
+    return True
+
+
+def numeric_grades(db):
+    """Converts grade.grade from a text column to a numeric one, keeping its values.
+    Values are copied in batches; an interrupted copy is completed by the next run. Text which is not
+    a number would become 0, a valid grade: NonNumericGrades is raised before anything is changed."""
+    columns = _columns(db, 'grade')
+    if columns.get('grade', '').upper().startswith('DECIMAL'):
+        return False
+    invalid = db.execute_sql("SELECT id, grade FROM grade WHERE CAST(grade AS REAL) = 0 "
+                             "AND TRIM(grade) NOT IN ('0', '0.0') ORDER BY id LIMIT 20").fetchall()
+    if invalid:
+        raise NonNumericGrades('Grades which are not numbers, as (id, grade), have to be corrected first: {}'.format(
+            ', '.join('({}, {!r})'.format(grade_id, grade) for grade_id, grade in invalid)))
+    migrator = SqliteMigrator(db)
+    if 'grade_value' not in columns:
+        with db.transaction():
+            migrate(migrator.add_column('grade', 'grade_value',
+                                        DecimalField(max_digits=3, decimal_places=1, null=True)))
+    in_batches(db, 'grade', 'UPDATE grade SET grade_value = CAST(grade AS REAL) WHERE id > ? AND id <= ?')
+    with db.transaction():
+        migrate(migrator.drop_column('grade', 'grade'),
+                migrator.rename_column('grade', 'grade_value', 'grade'),
+                migrator.add_not_null('grade', 'grade'))
+    return True
+
+
+def _indexes(db, table):
+    return set(row[1] for row in db.execute_sql('PRAGMA index_list("{}")'.format(table)))
+
+
+# (index name, table, columns, unique), named the way peewee names indexes declared in Meta.indexes
+_composite_indexes = [
+    ('grade_student_id_subject_id', 'grade', ('student_id', 'subject_id'), False),
+    ('grade_subject_id_student_id', 'grade', ('subject_id', 'student_id'), False),
+    ('student_group_last_name', 'student', ('group', 'last_name'), False),
+    ('teachersubject_teacher_id_specialization_id', 'teachersubject', ('teacher_id', 'specialization_id'), True),
+]
+# (index name, table, columns, unique) of foreign keys, which older versions indexed on their own;
+# each is the first column of a composite index, which serves the same lookups
+_redundant_indexes = [
+    ('grade_student_id', 'grade', ('student_id',), False),
+    ('grade_subject_id', 'grade', ('subject_id',), False),
+    ('teachersubject_teacher_id', 'teachersubject', ('teacher_id',), False),
+]
+
+
+def _create_indexes(db, indexes):
+    for name, table, columns, unique in indexes:
+        db.execute_sql('CREATE {}INDEX "{}" ON "{}" ({})'.format(
+            'UNIQUE ' if unique else '', name, table, ', '.join('"{}"'.format(column) for column in columns)))
+
+
+def composite_indexes(db):
+    """Adds composite indexes declared by the models and drops indexes of their first columns, which every
+    insert would otherwise update as well. Duplicate specializations, which the unique index would reject,
+    are removed first."""
+    missing = [index for index in _composite_indexes if index[0] not in _indexes(db, index[1])]
+    redundant = [index for index in _redundant_indexes if index[0] in _indexes(db, index[1])]
+    if not missing and not redundant:
+        return False
+    with db.transaction():
+        db.execute_sql('DELETE FROM teachersubject WHERE id NOT IN '
+                       '(SELECT MIN(id) FROM teachersubject GROUP BY teacher_id, specialization_id)')
+        _create_indexes(db, missing)
+        for name, table, columns, unique in redundant:
+            db.execute_sql('DROP INDEX "{}"'.format(name))
+    return True
+
+
+_listing_indexes = [
+    ('student_last_name', 'student', ('last_name',), False),
+    ('teacher_last_name', 'teacher', ('last_name',), False),
+]
+
+
+def listing_indexes(db):
+    """Adds indexes, which serve the sort orders of paginated admin listings."""
+    missing = [index for index in _listing_indexes if index[0] not in _indexes(db, index[1])]
+    if not missing:
+        return False
+    with db.transaction():
+        _create_indexes(db, missing)
+    return True
+
+
+def _summaries_complete(db):
+    """True if the student graded last has summaries; batches fill summaries in student id order."""
+    return bool(db.execute_sql('SELECT 1 FROM gradesummary WHERE student_id = '
+                               '(SELECT MAX(student_id) FROM grade) OR NOT EXISTS (SELECT 1 FROM grade)').fetchone())
+
+
+def grade_summaries(db):
+    """Creates the gradesummary table and fills it from existing grades, in batches of students."""
+    if _columns(db, 'gradesummary') and _summaries_complete(db):
+        return False
+    db.create_tables([GradeSummary], safe=True)
+    condition = 'WHERE student_id > ? AND student_id <= ?'
+    # a batch first removes what an interrupted run, or grading meanwhile, has left of it
+    in_batches(db, 'grade', 'DELETE FROM gradesummary ' + condition,
+               summaries.summary_insert + summaries.summary_select.format(condition), column='student_id')
+    return True
+
+
+def search_index(db):
+    """Creates the full-text search table of students and teachers (see search.py)."""
+    return create_search_index(db)
+
+
+def resource_versions(db):
+    """Creates the resourceversion table and triggers bumping it (see versions.py)."""
+    if _columns(db, 'resourceversion'):
+        return False
+    db.create_tables([ResourceVersion])
+    create_version_triggers(db)
+    return True
+
+
+def change_log(db):
+    """Creates the changeevent table, through which workers invalidate each other's caches."""
+    if _columns(db, 'changeevent'):
+        return False
+    db.create_tables([ChangeEvent])
+    return True
+
+
+def pending_deletions(db):
+    """Creates the pendingdeletion table of removals purged in the background (see deletion.py)."""
+    if _columns(db, 'pendingdeletion'):
+        return False
+    db.create_tables([PendingDeletion])
+    return True
+
+
+def grade_audit_log(db):
+    """Creates the append-only grade log, its triggers and the first snapshot of grades, copied in batches
+    (see audit.py)."""
+    return create_audit_log(db)
+
+
+MIGRATIONS = [initial_schema, numeric_grades, composite_indexes, grade_summaries, listing_indexes, search_index,
+              resource_versions, change_log, pending_deletions, grade_audit_log]
+
+
+def applied_migrations(db):
+    """{name: SchemaMigration} of migrations applied to the database."""
+    db.create_tables([SchemaMigration], safe=True)
+    return {migration.name: migration for migration in SchemaMigration.select()}
+
+
+def run_migrations(db, report=None):
+    """Applies migrations, which the database does not have yet, in order, recording each which changed something
+    with its duration; the others, e.g. search_index without FTS5, are tried again by the next run.
+    report(name, seconds, changed) is called after each. Returns names of migrations, which changed something."""
+    applied = applied_migrations(db)
+    changed = []
+    for migration in MIGRATIONS:
+        name = migration.__name__
+        if name in applied:
+            continue
+        start = time()
+        result = bool(migration(db))
+        seconds = time() - start
+        if result:
+            with db.transaction():
+                SchemaMigration.create(name=name, applied_at=datetime.now(), seconds=seconds, changed=result)
+            changed.append(name)
+        if report is not None:
+            report(name, seconds, result)
+    return changed
+
+
+def _print_migration(name, seconds, changed):
+    print('{:<20} {:8.2f} s{}'.format(name, seconds, '' if changed else '  (nothing to change)'))
+
+
+def main(argv=None):
+    global BATCH_SIZE
+    parser = argparse.ArgumentParser(description='Create or migrate a gradebook database to the current schema.')
+    parser.add_argument('--database', default='gradebook.db')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='rows of a backfill committed at once')
+    parser.add_argument('--status', action='store_true', help='list migrations instead of applying them')
+    args = parser.parse_args(argv)
+    BATCH_SIZE = args.batch_size
+    db = get_db()
+    db.init(args.database)
+    if args.status:
+        applied = applied_migrations(db)
+        for version, migration in enumerate(MIGRATIONS, 1):
+            record = applied.get(migration.__name__)
+            print('{:>3} {:<20} {}'.format(version, migration.__name__, 'pending' if record is None else
+                                           '{:%Y-%m-%d %H:%M}, {:.2f} s'.format(record.applied_at, record.seconds)))
+        return
+    try:
+        applied = run_migrations(db, _print_migration)
+    except NonNumericGrades as error:
+        parser.exit(1, '{}\n'.format(error))
+    print('Applied: ' + ', '.join(applied) if applied else 'Database is up to date.')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,73 @@
 from peewee import *
-
-
-_db = SqliteDatabase('gradebook.db')
+from playhouse.pool import PooledSqliteDatabase
+from time import perf_counter
+
+
+class GradebookDatabase(PooledSqliteDatabase):
+    """Pooled SQLite database, which reports every executed statement to registered listeners.
+    Each listener is called with (sql, params, seconds) once the statement has finished.
+    Closing the database returns the connection of current thread to the pool."""
+    def __init__(self, *args, **kwargs):
+        super(GradebookDatabase, self).__init__(*args, **kwargs)
+        self.listeners = []
+
+    def init(self, database, pragmas=None, **connect_kwargs):
+        # pooled connections still point at the previous file
+        if getattr(self, 'database', None) is not None:
+            if not self.is_closed():
+                self.close()
+            self.close_all()
+        if pragmas is not None:
+            self._pragmas = list(pragmas)  # what pragmas= of the constructor sets, peewee applies them on connect
+        super(GradebookDatabase, self).init(database, **connect_kwargs)
+
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        if not self.listeners:
+            return super(GradebookDatabase, self).execute_sql(sql, params, *args, **kwargs)
+        start = perf_counter()
+        try:
+            return super(GradebookDatabase, self).execute_sql(sql, params, *args, **kwargs)
+        finally:
+            elapsed = perf_counter() - start
+            for listener in self.listeners:
+                listener(sql, params, elapsed)
+
+
+_db = GradebookDatabase(None, pragmas=[])  # initialized by configure_db()
+_sqlite_max_variables = 999
+
+MIN_GRADE = 0
+MAX_GRADE = 6
 
 
 def get_db():
     return _db
 
 
+def configure_db(path, pragmas=(), max_connections=20, stale_timeout=None):
+    """Points the database at given file. Pragmas, (name, value) pairs, are set on every new connection.
+    Pooled connections are reused by threads, up to max_connections, and recycled after stale_timeout seconds."""
+    _db.init(path, pragmas=pragmas)
+    _db.max_connections = max_connections
+    _db.stale_timeout = stale_timeout
+
+
+def insert_in_batches(model_class, rows):
+    """Inserts rows (dicts) with multi-row INSERT statements, sized to fit SQLite's limit of bound variables.
+    Does not open a transaction on its own."""
+    batch = []
+    batch_size = None
+    for row in rows:
+        if batch_size is None:
+            batch_size = max(1, _sqlite_max_variables // len(row))
+        batch.append(row)
+        if len(batch) == batch_size:
+            model_class.insert_many(batch).execute()
+            batch = []
+    if batch:
+        model_class.insert_many(batch).execute()
+
+
 class BaseModel(Model):
     class Meta:
         database = _db
@@ -29,18 +89,28 @@ class Teacher(BaseModel):
     def __repr__(self):
         return '{} {} - {}'.format(self.first_name, self.last_name, self.username)
 
+    class Meta:
+        indexes = (
+            (('last_name',), False),  # admin listing, paginated on (last_name, id)
+        )
+
 
 class TeacherSubject(BaseModel):
     """TeacherSubject, in other words - specializations
     One teacher can teach many subjects,
     as well as one subject can be taught by many teachers.
     Many-to-many relationship model."""
-    teacher = ForeignKeyField(Teacher, related_name='teachers')
+    teacher = ForeignKeyField(Teacher, related_name='teachers', index=False)  # leads the unique index below
     specialization = ForeignKeyField(Subject, related_name='specializations')
 
     def __repr__(self):
         return '{} taught by {}'.format(repr(self.specialization), repr(self.teacher))
 
+    class Meta:
+        indexes = (
+            (('teacher', 'specialization'), True),
+        )
+
 
 class Student(BaseModel):
     first_name = CharField()
@@ -52,15 +122,106 @@ class Student(BaseModel):
     def __repr__(self):
         return '{} {}, group {} - {}'.format(self.first_name, self.last_name, self.group, self.username)
 
+    class Meta:
+        indexes = (
+            (('group', 'last_name'), False),  # group listings, ordered by last name
+            (('last_name',), False),  # admin listing, paginated on (last_name, id)
+        )
+
 
 class Grade(BaseModel):
-    student = ForeignKeyField(Student)
-    subject = ForeignKeyField(Subject)
+    student = ForeignKeyField(Student, index=False)  # student and subject lead the composite indexes below
+    subject = ForeignKeyField(Subject, index=False)
     teacher = ForeignKeyField(Teacher)
-    grade = CharField()
+    grade = DecimalField(max_digits=3, decimal_places=1)
 
     def __repr__(self):
         return 'student:{}, subject:{}, grade:{}, teacher:{}'.format(repr(self.student), repr(self.subject), self.grade, repr(self.teacher))
 
     class Meta:
         order_by = ('student', 'subject',)
+        indexes = (
+            (('student', 'subject'), False),  # student's grades, in the default order
+            (('subject', 'student'), False),  # per subject reports
+        )
+
+
+class GradeSummary(BaseModel):
+    """Aggregates of one student's grades in one subject, kept up to date by summaries.py
+    in the transactions, which add or remove grades."""
+    student = ForeignKeyField(Student, related_name='summaries', index=False)  # leads the unique index below
+    subject = ForeignKeyField(Subject, related_name='summaries')
+    count = IntegerField()
+    total = DecimalField(max_digits=10, decimal_places=1)
+    lowest = DecimalField(max_digits=3, decimal_places=1)
+    highest = DecimalField(max_digits=3, decimal_places=1)
+    last_grade = DecimalField(max_digits=3, decimal_places=1)  # of the most recently added grade
+
+    def __repr__(self):
+        return 'student:{}, subject:{}, count:{}, average:{}'.format(
+            repr(self.student), repr(self.subject), self.count, self.total / self.count)
+
+    class Meta:
+        indexes = (
+            (('student', 'subject'), True),
+        )
+
+
+class ResourceVersion(BaseModel):
+    """Change counter of a resource shown by some pages, e.g. 'student:<username>' or 'subjects'.
+    Counters are bumped by triggers (see versions.py), pages derive their ETags from them."""
+    key = CharField(primary_key=True)
+    version = IntegerField()
+
+
+class ChangeEvent(BaseModel):
+    """Invalidation of an in-process cache key, published for every worker (see invalidation.py).
+    Ids only grow, workers read events after the last id they have seen."""
+    key = TextField()  # JSON of the cache key
+
+
+class PendingDeletion(BaseModel):
+    """Student, teacher or subject scheduled for removal, whose grades are being purged in chunks
+    (see deletion.py). The record itself is removed after its last grade."""
+    kind = CharField()  # 'student', 'teacher' or 'subject'
+    object_id = IntegerField()
+
+    class Meta:
+        indexes = (
+            (('kind', 'object_id'), True),
+        )
+
+
+class GradeEvent(BaseModel):
+    """Change of a grade, appended in the transaction making it and never updated (see audit.py).
+    Ids are not foreign keys, events outlive the grades, students and teachers they refer to."""
+    term = IntegerField()  # see audit.term_of
+    at = BigIntegerField()  # milliseconds since the epoch
+    action = IntegerField()  # audit.CREATED, CHANGED or DELETED
+    grade_id = IntegerField()
+    student_id = IntegerField()
+    subject_id = IntegerField()
+    teacher_id = IntegerField()
+    grade = DecimalField(max_digits=3, decimal_places=1, null=True)  # None once deleted
+    previous = DecimalField(max_digits=3, decimal_places=1, null=True)  # None when created
+
+    class Meta:
+        indexes = (
+            (('student_id', 'id'), False),  # a student's history
+        )
+
+
+class GradeSnapshot(BaseModel):
+    """All grades after event event_id of the grade log, copied into the snapshotgrade table (see audit.py)."""
+    event_id = IntegerField()  # 0 if the log was empty
+    term = IntegerField()
+    taken_at = BigIntegerField()  # milliseconds since the epoch
+    completed_at = BigIntegerField(null=True)  # None until every grade is copied
+
+
+class SchemaMigration(BaseModel):
+    """Migration applied to this database (see migrations.py), with the time it took."""
+    name = CharField(primary_key=True)
+    applied_at = DateTimeField()
+    seconds = FloatField()
+    changed = BooleanField()  # False if the database already had what the migration adds
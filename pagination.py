@@ -0,0 +1,99 @@
+"""Keyset (seek) pagination of admin listings.
+A page is fetched as 'rows after (or before) the last row shown' in an indexed order, instead of with OFFSET,
+so page 1000 costs as much as page 1. Cursors are the sort key values of the boundary row, kept in the URL."""
+import json
+from flask import abort, current_app, request, url_for
+from peewee import fn
+
+
+class Page(object):
+    def __init__(self, items, next_cursor, previous_cursor, total, args):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.total = total
+        self.args = args  # listing arguments (sort, filters, per_page), kept by the links
+        self.next_url = self.url(after=next_cursor) if next_cursor else None
+        self.previous_url = self.url(before=previous_cursor) if previous_cursor else None
+
+    def url(self, **args):
+        """URL of the current listing with some of its arguments replaced. Cursors are dropped."""
+        merged = dict(request.view_args or {}, **self.args)
+        merged.update(args)
+        return url_for(request.endpoint, **{key: value for key, value in merged.items() if value})
+
+
+def _seek(order, values, backwards):
+    """Condition selecting rows after (or before) the row with given sort key values:
+    (a, b, c) > (x, y, z) is a > x or a = x and (b > y or b = y and c > z).
+    The redundant leading a >= x lets SQLite seek the index instead of scanning it from the start."""
+    fields_and_values = list(zip(order, values))
+    field, value = fields_and_values[-1]
+    condition = field < value if backwards else field > value
+    for field, value in reversed(fields_and_values[:-1]):
+        condition = ((field < value) if backwards else (field > value)) | ((field == value) & condition)
+    if len(order) > 1:
+        field, value = fields_and_values[0]
+        condition = ((field <= value) if backwards else (field >= value)) & condition
+    return condition
+
+
+def _cursor(row, order):
+    return json.dumps([getattr(row, field.name) for field in order], separators=(',', ':'))
+
+
+def _decode(cursor, order):
+    try:
+        values = json.loads(cursor)
+    except ValueError:
+        abort(400)
+    if not isinstance(values, list) or len(values) != len(order):
+        abort(400)
+    return values
+
+
+def estimate_count(model_class, query=None):
+    """Number of rows for the listing header. Filtered listings are counted exactly, on the filter's index;
+    a whole table is estimated by its largest id, a single index lookup, which overcounts removed rows."""
+    if query is not None:
+        return query.count()
+    return model_class.select(fn.MAX(model_class.id)).scalar() or 0
+
+
+def paginate(model_class, query, orders, filters=None, keep=None):
+    """Page of query (selecting model_class) in the order chosen by the 'sort' request argument.
+    orders, an OrderedDict, maps sort names to tuples of fields, the first entry being the default;
+    the last field of each has to be unique, and the tuple should match an index.
+    filters holds listing arguments already applied to query, so that links keep them; keep holds other
+    arguments for the links, which do not change the rows.
+    Page size comes from 'per_page', capped by ADMIN_MAX_PAGE_SIZE, or ADMIN_PAGE_SIZE."""
+    sort = request.args.get('sort')
+    if sort not in orders:
+        sort = next(iter(orders))
+    order = orders[sort]
+    size = request.args.get('per_page', current_app.config['ADMIN_PAGE_SIZE'], type=int)
+    size = max(1, min(size, current_app.config['ADMIN_MAX_PAGE_SIZE']))
+    filters = {key: value for key, value in (filters or {}).items() if value}
+    total = estimate_count(model_class, query if filters else None)
+
+    after, before = request.args.get('after'), request.args.get('before')
+    backwards = before is not None and after is None
+    cursor = before if backwards else after
+    page_query = query
+    if cursor is not None:
+        page_query = page_query.where(_seek(order, _decode(cursor, order), backwards))
+    rows = list(page_query.order_by(*[field.desc() if backwards else field for field in order]).limit(size + 1))
+    more = len(rows) > size
+    rows = rows[:size]
+    if backwards:
+        rows.reverse()
+    next_cursor = previous_cursor = None
+    if rows:
+        if more or backwards:
+            next_cursor = _cursor(rows[-1], order)
+        if (more and backwards) or (cursor is not None and not backwards):
+            previous_cursor = _cursor(rows[0], order)
+    args = dict(keep or {}, **filters)
+    args.update(sort=sort if sort != next(iter(orders)) else None,
+                per_page=size if 'per_page' in request.args else None)
+    return Page(rows, next_cursor, previous_cursor, total, args)
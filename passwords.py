@@ -0,0 +1,102 @@
+"""Password verification on a bounded pool of worker processes.
+A bcrypt check costs tens of milliseconds of CPU, so a burst of logins run on request threads would occupy
+every worker of the site. Checks are handed to a few processes instead, and logins beyond the queue limit
+are turned away at once rather than piling up."""
+import hmac
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from threading import Lock
+from exceptions import VerifierBusy
+
+# bcrypt (and cffi under it) is imported by the first hash or check, not when the application starts
+
+
+def hash_password(password):
+    """bcrypt hash of password, as stored in Student.password and Teacher.password."""
+    from bcrypt import hashpw, gensalt
+    return hashpw(password.encode('utf-8'), gensalt()).decode('utf-8')
+
+
+def _matches(stored_hash, password):
+    from bcrypt import hashpw, gensalt
+    if stored_hash is None:  # unknown username: a hash of the same cost as stored ones takes as long as a check
+        hashpw(password.encode('utf-8'), gensalt())
+        return False
+    stored_hash = stored_hash.encode('utf-8')
+    return hmac.compare_digest(hashpw(password.encode('utf-8'), stored_hash), stored_hash)
+
+
+class PasswordVerifier(object):
+    def __init__(self, workers=2, queue_limit=32, timeout=10):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.timeout = timeout
+        self.pending = 0  # checks submitted to the pool and neither finished nor cancelled
+        self.rejected = 0
+        self._pool = None
+        self._lock = Lock()
+
+    def _release(self, future=None):
+        with self._lock:
+            self.pending -= 1
+
+    def verify(self, stored_hash, password):
+        """True if password matches stored_hash. None stands for an unknown username: the password is then
+        hashed at the cost of stored hashes, so that the answer (False) takes as long as for an existing user.
+        Raises VerifierBusy if queue_limit checks are already in the pool or the check times out."""
+        with self._lock:
+            if self.pending >= self.queue_limit:
+                self.rejected += 1
+                raise VerifierBusy('Too many password checks in progress')
+            self.pending += 1
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            pool = self._pool
+        try:
+            future = pool.submit(_matches, stored_hash, password)
+        except Exception:
+            self._release()
+            raise
+        try:
+            matches = future.result(self.timeout)
+        except TimeoutError:
+            # a check still queued is dropped; one already running keeps its place until it ends
+            if not future.cancel():
+                future.add_done_callback(self._release)
+            else:
+                self._release()
+            with self._lock:
+                self.rejected += 1
+            raise VerifierBusy('Password check timed out')
+        except BaseException:
+            self._release()
+            raise
+        self._release()
+        return matches
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+    def stats(self):
+        with self._lock:
+            return {'workers': self.workers,
+                    'queue_limit': self.queue_limit,
+                    'pending': self.pending,
+                    'rejected': self.rejected}
+
+
+_verifier = PasswordVerifier()
+
+
+def get_verifier():
+    return _verifier
+
+
+def configure_verifier(workers, queue_limit, timeout):
+    """Sets pool size, queue limit and timeout (seconds) of the verifier. A running pool is replaced."""
+    _verifier.shutdown()
+    _verifier.workers = workers
+    _verifier.queue_limit = queue_limit
+    _verifier.timeout = timeout
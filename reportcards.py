@@ -0,0 +1,175 @@
+"""Report cards of every student, rendered at term end by a batch job.
+
+    python reportcards.py --database gradebook.db --output report_cards --term "2017/18 winter"
+
+All grades are streamed in one pass, ordered by (student, subject) as Grade.Meta.order_by, and merged
+with students ordered by id into one card per student; the main process only reads the database,
+while a pool of processes renders cards through templates/report_card.html and writes them. Cards list
+grades with the macro of the student profile page (templates/_grades.html), from data of the same shape
+as grade_matrix and student_averages give; they are standalone files, without the site's layout.
+Output is content-addressed: a card is stored as cards/<hash[:2]>/<hash>.html, so unchanged cards of
+a rerun are not written again, and manifest.tsv maps student id and username to its file.
+The manifest grows in student id order, an interrupted run continues after its last line."""
+import argparse
+import hashlib
+import os
+import sys
+from collections import deque
+from itertools import groupby, islice
+from multiprocessing import Pool, cpu_count
+from time import time
+from jinja2 import Environment, FileSystemLoader
+from model import Student, Subject, Teacher, Grade, get_db
+
+TEMPLATE = 'report_card.html'
+MANIFEST = 'manifest.tsv'
+_templates = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+_worker = {}  # template and settings of a pool process, set by _init_worker
+
+
+def _students(after_id):
+    return (Student
+            .select(Student.id, Student.first_name, Student.last_name, Student.group, Student.username)
+            .where(Student.id > after_id)
+            .order_by(Student.id)
+            .tuples()
+            .iterator())
+
+
+def _grades(after_id):
+    return (Grade
+            .select(Grade.student, Grade.subject, Grade.grade, Teacher.first_name, Teacher.last_name)
+            .join(Teacher)
+            .where(Grade.student > after_id)
+            .order_by(Grade.student, Grade.subject, Grade.id)
+            .tuples()
+            .iterator())
+
+
+def cards(subjects, after_id=0):
+    """Cards of students with id above after_id, in id order, built from a single pass over their grades.
+    subjects is a list of (id, name) of every subject, listed on every card. A card holds the student,
+    grade_matrix and averages, like the student profile page, with subjects and grades as dicts."""
+    grades = groupby(_grades(after_id), key=lambda row: row[0])
+    current_id, current = next(grades, (None, ()))
+    for student_id, first_name, last_name, group, username in _students(after_id):
+        by_subject = {}
+        while current_id is not None and current_id <= student_id:  # grades of removed students are skipped
+            if current_id == student_id:
+                for row in current:
+                    by_subject.setdefault(row[1], []).append(
+                        dict(grade=row[2], teacher_name='{} {}'.format(row[3], row[4])))
+            current_id, current = next(grades, (None, ()))
+        averages = {subject_id: (float(sum(grade['grade'] for grade in grades)) / len(grades), len(grades))
+                    for subject_id, grades in by_subject.items()}
+        yield dict(student=dict(id=student_id, first_name=first_name, last_name=last_name, group=group,
+                                username=username),
+                   grade_matrix=[(dict(id=subject_id, name=name), by_subject.get(subject_id, []))
+                                 for subject_id, name in subjects],
+                   averages=averages)
+
+
+def _init_worker(output, term):
+    _worker['template'] = Environment(loader=FileSystemLoader(_templates), autoescape=True).get_template(TEMPLATE)
+    _worker['output'] = output
+    _worker['term'] = term
+
+
+def render_card(card):
+    """Renders and stores a card, unless a card with the same content exists. Returns (student, path)."""
+    html = _worker['template'].render(term=_worker['term'], **card).encode('utf-8')
+    digest = hashlib.sha1(html).hexdigest()
+    path = os.path.join('cards', digest[:2], digest + '.html')
+    full_path = os.path.join(_worker['output'], path)
+    if not os.path.exists(full_path):
+        directory = os.path.dirname(full_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        temporary = '{}.{}.tmp'.format(full_path, os.getpid())
+        with open(temporary, 'wb') as f:
+            f.write(html)
+        os.replace(temporary, full_path)  # readers never see a partial card
+    return card['student'], path
+
+
+def render_cards(chunk):
+    return [render_card(card) for card in chunk]
+
+
+def _done(manifest):
+    """Id of the last student in the manifest, 0 if there is none. A partly written last line is dropped."""
+    if not os.path.exists(manifest):
+        return 0
+    last_id = 0
+    with open(manifest, 'r+') as f:
+        lines = f.read().split('\n')
+        complete = lines[:-1]  # every complete line ends with a newline
+        if lines[-1]:
+            f.seek(0)
+            f.truncate()
+            f.write(''.join(line + '\n' for line in complete))
+    if complete:
+        last_id = int(complete[-1].split('\t')[0])
+    return last_id
+
+
+def generate(output, term='', processes=None, restart=False, progress=None, chunk_size=64):
+    """Renders cards of all students into directory output, continuing an interrupted run unless restart.
+    progress(done, elapsed seconds) is called every 1000 cards. Returns the number of cards rendered."""
+    manifest = os.path.join(output, MANIFEST)
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    if restart and os.path.exists(manifest):
+        os.remove(manifest)
+    after_id = _done(manifest)
+    subjects = list(Subject.select(Subject.id, Subject.name).order_by(Subject.name).tuples())
+    start = time()
+    done = 0
+    pool = Pool(processes, initializer=_init_worker, initargs=(output, term))
+    pending = deque()  # chunks being rendered, written to the manifest in order
+    window = 2 * (processes or cpu_count())
+    card_iterator = cards(subjects, after_id)
+    try:
+        with open(manifest, 'a') as f:
+            # the database is read in this thread only; at most window chunks wait for rendering
+            for chunk in iter(lambda: list(islice(card_iterator, chunk_size)), []):
+                pending.append(pool.apply_async(render_cards, (chunk,)))
+                if len(pending) >= window:
+                    done = _write(f, pending.popleft().get(), done, start, progress)
+            while pending:
+                done = _write(f, pending.popleft().get(), done, start, progress)
+    finally:
+        pool.terminate()
+    return done
+
+
+def _write(manifest, rendered, done, start, progress):
+    for student, path in rendered:
+        manifest.write('{}\t{}\t{}\n'.format(student['id'], student['username'], path))
+    manifest.flush()
+    if progress is not None and (done + len(rendered)) // 1000 > done // 1000:
+        progress(done + len(rendered), time() - start)
+    return done + len(rendered)
+
+
+def _print_progress(done, elapsed):
+    sys.stderr.write('{} cards, {:.0f}/s\n'.format(done, done / elapsed if elapsed else 0))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render report cards of every student.')
+    parser.add_argument('--database', default='gradebook.db')
+    parser.add_argument('--output', default='report_cards')
+    parser.add_argument('--term', default='', help='shown in the heading of every card')
+    parser.add_argument('--processes', type=int, default=None, help='rendering processes, one per CPU by default')
+    parser.add_argument('--restart', action='store_true', help='render all cards again, not only the missing ones')
+    args = parser.parse_args(argv)
+    db = get_db()
+    db.init(args.database)
+    start = time()
+    done = generate(args.output, args.term, args.processes, args.restart, _print_progress)
+    print('{} cards rendered in {:.1f} s.'.format(done, time() - start))
+
+
+if __name__ == '__main__':
+    main()
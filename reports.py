@@ -0,0 +1,60 @@
+"""Read-side helpers, which prepare grade data for templates in as few queries as possible.
+Subjects and grades of records scheduled for removal are left out (see deletion.not_scheduled)."""
+from collections import OrderedDict
+from peewee import fn
+from model import Student, Subject, Grade, GradeSummary, MIN_GRADE, MAX_GRADE
+from deletion import not_scheduled, grades_not_scheduled
+
+GRADE_SCALE = list(range(MIN_GRADE, MAX_GRADE + 1))
+
+
+def grade_matrix(student):
+    """Returns an ordered list of (subject, grades) pairs for given student.
+    Every subject is listed, even those without grades.
+    Grades are fetched together with their subjects in a single query and grouped in one pass,
+    so templates never trigger lazy grade.subject lookups."""
+    matrix = OrderedDict((subject.id, (subject, [])) for subject in Subject.select().where(not_scheduled('subject')))
+    grades = (Grade
+              .select(Grade, Subject)
+              .join(Subject)
+              .where(Grade.student == student, grades_not_scheduled()))
+    for grade in grades:
+        matrix[grade.subject.id][1].append(grade)
+    return list(matrix.values())
+
+
+def student_averages(student):
+    """{subject id: (average, count)} of student's grades, read from one GradeSummary row per subject."""
+    query = (GradeSummary
+             .select(GradeSummary.subject, GradeSummary.total, GradeSummary.count)
+             .where(GradeSummary.student == student)
+             .tuples())
+    return {subject_id: (float(total) / count, count) for subject_id, total, count in query}
+
+
+def group_statistics(group):
+    """Per subject statistics of grades in a group: list of (subject name, mean, count, histogram),
+    where histogram holds numbers of grades, rounded to each value of GRADE_SCALE.
+    Computed with a single GROUP BY query."""
+    histogram = [fn.SUM(fn.ROUND(Grade.grade) == value) for value in GRADE_SCALE]
+    query = (Grade
+             .select(Subject.name, fn.AVG(Grade.grade), fn.COUNT(Grade.id), *histogram)
+             .join(Student)
+             .switch(Grade)
+             .join(Subject)
+             .where(Student.group == group, grades_not_scheduled())
+             .group_by(Grade.subject)
+             .order_by(Subject.name)
+             .tuples())
+    return [(row[0], row[1], row[2], list(row[3:])) for row in query]
+
+
+def teacher_grade_counts(teacher):
+    """List of (subject name, count) of grades given by teacher."""
+    return list(Grade
+                .select(Subject.name, fn.COUNT(Grade.id))
+                .join(Subject)
+                .where(Grade.teacher == teacher, grades_not_scheduled())
+                .group_by(Grade.subject)
+                .order_by(Subject.name)
+                .tuples())
@@ -0,0 +1,92 @@
+"""Full-text search of students and teachers by name, username and group.
+An FTS5 table, person_search, is kept in sync with both tables by triggers, so rows written in bulk
+(imports, raw SQL) are indexed as well. Words of a query match as prefixes, best matches first.
+SQLite builds without FTS5 fall back to LIKE prefix matching on names and usernames."""
+import re
+from peewee import OperationalError
+from model import Student, Teacher, get_db
+from deletion import not_scheduled
+
+KINDS = ('student', 'teacher')
+SEARCH_LIMIT = 10
+
+_create_table = ('CREATE VIRTUAL TABLE person_search USING fts5('
+                 'kind UNINDEXED, person_id UNINDEXED, first_name, last_name, username, grp, '
+                 "tokenize = 'unicode61', prefix = '2 3')")
+# indexed values of a row of each table, which is named like the kind
+_values = {
+    'student': "'student', {row}.id, {row}.first_name, {row}.last_name, {row}.username, {row}.\"group\"",
+    'teacher': "'teacher', {row}.id, {row}.first_name, {row}.last_name, {row}.username, ''",
+}
+_trigger_template = '''CREATE TRIGGER IF NOT EXISTS {table}_search_{event} AFTER {event} ON "{table}" BEGIN
+    {body}
+END'''
+_insert = 'INSERT INTO person_search (kind, person_id, first_name, last_name, username, grp) VALUES ({});'
+_delete = "DELETE FROM person_search WHERE kind = '{kind}' AND person_id = old.id;"
+
+
+def _table_exists(db):
+    return bool(db.execute_sql("SELECT 1 FROM sqlite_master WHERE name = 'person_search'").fetchone())
+
+
+def create_search_index(db):
+    """Creates the search table and its triggers, indexing existing students and teachers.
+    Returns False if the table already exists or SQLite lacks FTS5."""
+    if _table_exists(db):
+        return False
+    try:
+        with db.transaction():
+            db.execute_sql(_create_table)
+            for kind, values in _values.items():
+                new_row = _insert.format(values.format(row='new'))
+                db.execute_sql(_trigger_template.format(table=kind, event='INSERT', body=new_row))
+                db.execute_sql(_trigger_template.format(table=kind, event='DELETE', body=_delete.format(kind=kind)))
+                db.execute_sql(_trigger_template.format(
+                    table=kind, event='UPDATE', body=_delete.format(kind=kind) + '\n    ' + new_row))
+                db.execute_sql('INSERT INTO person_search (kind, person_id, first_name, last_name, username, grp) '
+                               'SELECT {} FROM "{}"'.format(values.format(row='"{}"'.format(kind)), kind))
+    except OperationalError:  # no such module: fts5
+        return False
+    return True
+
+
+def _match_expression(text):
+    """FTS5 query matching every word of text as a prefix, e.g. 'ann sm' -> "ann"* "sm"*."""
+    words = re.findall(r'\w+', text, re.UNICODE)
+    return ' '.join('"{}"*'.format(word) for word in words)
+
+
+def search(text, kinds=KINDS, limit=SEARCH_LIMIT):
+    """Up to limit students and teachers matching text, as dicts with kind, id, names, username and group."""
+    expression = _match_expression(text)
+    if not expression or not kinds:
+        return []
+    db = get_db()
+    if not _table_exists(db):
+        return _search_like(text, kinds, limit)
+    cursor = db.execute_sql(
+        'SELECT kind, person_id, first_name, last_name, username, grp FROM person_search '
+        'WHERE person_search MATCH ? AND kind IN ({}) AND NOT EXISTS (SELECT 1 FROM pendingdeletion '
+        'WHERE pendingdeletion.kind = person_search.kind AND object_id = person_search.person_id) '
+        'ORDER BY rank LIMIT ?'.format(', '.join('?' * len(kinds))),
+        [expression] + list(kinds) + [limit])
+    return [dict(kind=kind, id=person_id, first_name=first_name, last_name=last_name, username=username,
+                 group=group or None)
+            for kind, person_id, first_name, last_name, username, group in cursor]
+
+
+def _search_like(text, kinds, limit):
+    results = []
+    for kind, model_class in (('student', Student), ('teacher', Teacher)):
+        if kind not in kinds or len(results) >= limit:
+            continue
+        condition = None
+        for word in re.findall(r'\w+', text, re.UNICODE):
+            pattern = word + '%'
+            word_condition = ((model_class.first_name ** pattern) | (model_class.last_name ** pattern) |
+                              (model_class.username ** pattern))
+            condition = word_condition if condition is None else condition & word_condition
+        for person in model_class.select().where(condition, not_scheduled(kind)).limit(limit - len(results)):
+            results.append(dict(kind=kind, id=person.id, first_name=person.first_name, last_name=person.last_name,
+                                username=person.username, group=getattr(person, 'group', None)))
+    return results
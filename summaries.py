@@ -0,0 +1,72 @@
+"""Maintenance of GradeSummary rows.
+Code adding or removing grades calls add_grades/refresh_students within its own transaction;
+rebuild recomputes every summary from the grades, for repairs.
+
+    python summaries.py --database gradebook.db"""
+import argparse
+from collections import OrderedDict
+from decimal import Decimal
+from peewee import fn
+from model import GradeSummary, get_db, _sqlite_max_variables
+
+# last_grade is taken from the grade with the highest id, i.e. the most recently added one
+summary_select = ('SELECT student_id, subject_id, COUNT(id), SUM(grade), MIN(grade), MAX(grade), '
+                   '(SELECT last.grade FROM grade AS last WHERE last.student_id = grade.student_id '
+                   'AND last.subject_id = grade.subject_id ORDER BY last.id DESC LIMIT 1) '
+                   'FROM grade {} GROUP BY student_id, subject_id')
+summary_insert = ('INSERT INTO gradesummary '
+                   '(student_id, subject_id, count, total, lowest, highest, last_grade) ')
+
+
+def add_grades(grades):
+    """Adds (student id, subject id, grade) of newly inserted grades, in order of insertion, to the summaries.
+    Every summary changed is updated by a single statement."""
+    changes = OrderedDict()
+    for student_id, subject_id, grade in grades:
+        grade = Decimal(grade)
+        count, total, lowest, highest, last = changes.get((student_id, subject_id), (0, 0, grade, grade, grade))
+        changes[student_id, subject_id] = (count + 1, total + grade, min(lowest, grade), max(highest, grade), grade)
+    for (student_id, subject_id), (count, total, lowest, highest, last) in changes.items():
+        updated = (GradeSummary
+                   .update(count=GradeSummary.count + count,
+                           total=GradeSummary.total + float(total),
+                           lowest=fn.MIN(GradeSummary.lowest, float(lowest)),
+                           highest=fn.MAX(GradeSummary.highest, float(highest)),
+                           last_grade=last)
+                   .where(GradeSummary.student == student_id, GradeSummary.subject == subject_id)
+                   .execute())
+        if not updated:
+            GradeSummary.insert(student=student_id, subject=subject_id, count=count, total=total,
+                                lowest=lowest, highest=highest, last_grade=last).execute()
+
+
+def refresh_students(student_ids):
+    """Recomputes summaries of given students from their grades, after some of the grades were removed."""
+    db = get_db()
+    student_ids = list(student_ids)
+    for start in range(0, len(student_ids), _sqlite_max_variables):
+        batch = student_ids[start:start + _sqlite_max_variables]
+        condition = 'WHERE student_id IN ({})'.format(', '.join('?' * len(batch)))
+        db.execute_sql('DELETE FROM gradesummary ' + condition, batch)
+        db.execute_sql(summary_insert + summary_select.format(condition), batch)
+
+
+def rebuild(db):
+    """Recomputes every summary from the grades. Returns number of summaries."""
+    with db.transaction():
+        db.execute_sql('DELETE FROM gradesummary')
+        db.execute_sql(summary_insert + summary_select.format(''))
+    return GradeSummary.select().count()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Rebuild grade summaries from the grades.')
+    parser.add_argument('--database', default='gradebook.db')
+    args = parser.parse_args(argv)
+    db = get_db()
+    db.init(args.database)
+    print('{} summaries rebuilt.'.format(rebuild(db)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,48 @@
 from playhouse.test_utils import test_database
+from peewee import JOIN, IntegrityError
 from bcrypt import hashpw, gensalt
 from gradebook import app
+import gradebook
 import model
+import reports
+import instrumentation
+import benchmark
+import cache
+import forms
+import importer
+import migrations
+import passwords
+import summaries
+import search
+import versions
+import invalidation
+import feed
+import deletion
+import analytics
+import reportcards
+import audit
+import pagination
+import admin
+from exceptions import VerifierBusy, HistoryUnavailable, NonNumericGrades
+import io
+import os
+import tempfile
+import shutil
+from datetime import date, datetime
+from decimal import Decimal
+from time import sleep
 import unittest
+import json
+
+
+def setUpModule():
+    # every request polls the change log of the invalidation bus
+    model.get_db().init('test_db.db')
+    model.get_db().create_tables([model.ChangeEvent], safe=True)
+
+
+def tearDownModule():
+    model.get_db().drop_tables([model.ChangeEvent], safe=True)
 
 
 class DefaultGetNoUserTest(unittest.TestCase):
@@ -71,6 +111,93 @@ class AdminPanelTest(unittest.TestCase):
         self.assertIn(b"PSWD", resp.data)
 
 
+class InstrumentationTest(unittest.TestCase):
+    def setUp(self):
+        app.testing = True
+        app.config['INSTRUMENTATION'] = True
+        instrumentation.get_metrics().reset()
+        invalidation.get_bus().poll(force=True)  # so that requests of a test do not poll the change log
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['INSTRUMENTATION'] = False
+
+    def test_timing_headers(self):
+        resp = self.client.get('/')
+        self.assertEqual(resp.headers['X-Query-Count'], '0')
+        self.assertIn('render;dur=', resp.headers['Server-Timing'])
+
+    def test_metrics_per_endpoint(self):
+        self.client.get('/')
+        self.client.get('/')
+        self.client.post('/admin/login/', data=dict(login='test', pswd='test'))
+        resp = self.client.get('/admin/metrics/')
+        endpoints = json.loads(resp.data.decode('utf-8'))['endpoints']
+        self.assertEqual(endpoints['homepage']['requests'], 2)
+        self.assertEqual(endpoints['homepage']['errors'], 0)
+
+
+class AppFactoryTest(unittest.TestCase):
+    def test_create_app(self):
+        """A new application serves requests; warming it up compiles templates into the bytecode cache."""
+        cache_dir = tempfile.mkdtemp()
+        try:
+            factory_app = gradebook.create_app({'DATABASE': 'test_db.db', 'TEMPLATE_CACHE_DIR': cache_dir})
+            gradebook.warm_up(factory_app)
+            self.assertTrue(os.listdir(cache_dir))
+            resp = factory_app.test_client().get('/teacher_login/')
+            self.assertIn(b"<h2>Log in as a teacher</h2>", resp.data)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_shared_template_cache_refused(self):
+        """Bytecode is executed, so a template cache directory others may write to is not used."""
+        cache_dir = tempfile.mkdtemp()
+        try:
+            os.chmod(cache_dir, 0o777)
+            with self.assertRaises(RuntimeError):
+                gradebook.template_cache(cache_dir)
+            os.chmod(cache_dir, 0o700)
+            self.assertEqual(gradebook.template_cache(cache_dir).directory, cache_dir)
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+class PasswordVerifierTest(unittest.TestCase):
+    def setUp(self):
+        self.verifier = passwords.PasswordVerifier(workers=1, queue_limit=4)
+        self.stored_hash = hashpw(b'secret', gensalt(4)).decode('utf-8')
+
+    def tearDown(self):
+        self.verifier.shutdown()
+
+    def test_verify(self):
+        self.assertTrue(self.verifier.verify(self.stored_hash, 'secret'))
+        self.assertFalse(self.verifier.verify(self.stored_hash, 'wrong'))
+        self.assertFalse(self.verifier.verify(None, 'secret'))
+        self.assertEqual(self.verifier.stats()['pending'], 0)
+
+    def test_timeout(self):
+        """A check that times out is cancelled, or keeps counting against the queue limit until it ends."""
+        self.verifier.timeout = 0
+        with self.assertRaises(VerifierBusy):
+            self.verifier.verify(self.stored_hash, 'secret')
+        self.verifier.timeout = 10
+        self.assertTrue(self.verifier.verify(self.stored_hash, 'secret'))
+        for _ in range(100):
+            if not self.verifier.stats()['pending']:
+                break
+            sleep(0.05)
+        self.assertEqual(self.verifier.stats()['pending'], 0)
+        self.assertEqual(self.verifier.stats()['rejected'], 1)
+
+    def test_queue_limit(self):
+        self.verifier.queue_limit = 0
+        with self.assertRaises(VerifierBusy):
+            self.verifier.verify(self.stored_hash, 'secret')
+        self.assertEqual(self.verifier.stats()['rejected'], 1)
+
+
 class DatabaseOperationsTest(unittest.TestCase):
     model.get_db().init('test_db.db')
     _student_template = {'first_name': 'test',
@@ -82,13 +209,16 @@ class DatabaseOperationsTest(unittest.TestCase):
                          'last_name': 'test',
                          'username': 'test_teacher',
                          'password': 'test'}
-    _table_model = [model.Student, model.Teacher, model.Subject, model.Grade, model.TeacherSubject]
+    _table_model = [model.Student, model.Teacher, model.Subject, model.Grade, model.TeacherSubject,
+                    model.GradeSummary, model.ResourceVersion, model.PendingDeletion, model.GradeEvent]
 
     def setUp(self):
         app.testing = True
+        app.config['CONDITIONAL_PAGES'] = False  # tables are created without the triggers bumping versions
         self.client = app.test_client()
 
     def tearDown(self):
+        app.config['CONDITIONAL_PAGES'] = True
         model.get_db().drop_tables(self._table_model, safe=True)
 
     def test_db_student(self):
@@ -155,6 +285,713 @@ class DatabaseOperationsTest(unittest.TestCase):
             self.assertTrue(test_teacher.delete_instance())
             self.assertTrue(test_student.delete_instance())
 
+    def test_db_set_based_deletes(self):
+        """Records are deleted with their dependents at once, or scheduled and purged chunk by chunk."""
+        with test_database(model.get_db(), self._table_model, create_tables=True, drop_tables=True):
+            maths = model.Subject.create(name='maths')
+            art = model.Subject.create(name='art')
+            teacher = model.Teacher.create(**self._teacher_template)
+            other = model.Teacher.create(**dict(self._teacher_template, username='other'))
+            student = model.Student.create(**self._student_template)
+            model.TeacherSubject.create(teacher=teacher, specialization=maths)
+            for grade, subject, by in (('2', maths, teacher), ('3', maths, teacher), ('5', art, teacher),
+                                       ('4', maths, other)):
+                model.Grade.create(student=student, subject=subject, teacher=by, grade=grade)
+            summaries.rebuild(model.get_db())
+
+            self.assertTrue(deletion.remove('subject', art.id, threshold=10))
+            self.assertFalse(model.Subject.select().where(model.Subject.name == 'art').exists())
+            self.assertEqual(model.GradeSummary.select().count(), 1)
+
+            self.assertFalse(deletion.remove('teacher', teacher.id, threshold=1))
+            self.assertTrue(deletion.is_scheduled('teacher', teacher.id))
+            self.assertEqual(deletion.purge_chunk('teacher', teacher.id, chunk_size=1), 1)
+            summary = model.GradeSummary.get()
+            self.assertEqual((summary.count, summary.lowest), (2, 3))
+            self.assertEqual(deletion.purge(chunk_size=1), 1)
+            self.assertFalse(deletion.is_scheduled('teacher', teacher.id))
+            self.assertEqual(model.Teacher.select().count(), 1)
+            self.assertEqual(model.TeacherSubject.select().count(), 0)
+            self.assertEqual(model.GradeSummary.get().total, 4)
+
+            with self.client.session_transaction() as session:
+                session.update(logged_in=True, type='X')
+            self.client.post('/admin/student_profile/test_student/')
+            self.assertEqual(model.Student.select().count(), 0)
+            self.assertEqual(model.Grade.select().count(), 0)
+            self.assertEqual(model.GradeSummary.select().count(), 0)
+
+    def test_db_scheduled_removal(self):
+        """A student scheduled for removal is hidden from listings, search, grading and login until purged."""
+        with test_database(model.get_db(), self._table_model, create_tables=True, drop_tables=True):
+            cache.get_cache().clear()
+            maths = model.Subject.create(name='maths')
+            teacher = model.Teacher.create(**self._teacher_template)
+            student = model.Student.create(**dict(self._student_template, group='1',
+                                                  password=hashpw(b'test', gensalt(4)).decode('utf-8')))
+            for grade in ('3', '4'):
+                model.Grade.create(student=student, subject=maths, teacher=teacher, grade=grade)
+            self.assertFalse(deletion.remove('student', student.id, threshold=1))
+
+            resp = self.client.post('/student_login/', data=dict(username='test_student', password='test'))
+            self.assertIn(b'Wrong username or password', resp.data)
+            self.assertEqual(search.search('test', kinds=('student',)), [])
+            with self.client.session_transaction() as session:
+                session.update(logged_in=True, type='X')
+            self.assertNotIn(b'test_student', self.client.get('/admin/students/').data)
+            self.assertEqual(json.loads(self.client.get('/api/v1/students/').data.decode('utf-8'))['items'], [])
+            with self.client.session_transaction() as session:
+                session.update(logged_in=True, type='T', user_id=teacher.id, username='test_teacher')
+            resp = self.client.post('/add_grade/', data=dict(student_select='test_student', subject_select='maths',
+                                                             grade='5'))
+            self.assertIn(b'There is no student test_student', self.client.get('/').data + resp.data)
+            self.assertNotIn(b'test_student', self.client.get('/group/1/').data)
+            self.assertEqual(model.Grade.select().count(), 2)
+
+            deletion.purge()
+            self.assertEqual(model.Student.select().count(), 0)
+            self.assertEqual(model.PendingDeletion.select().count(), 0)
+            cache.get_cache().clear()
+
+    def test_db_scheduled_grades_hidden(self):
+        """Grades of a subject and of a student scheduled for removal are left out of the API, exports, reports
+        and analytics, and purging them recomputes the summaries they were part of."""
+        with test_database(model.get_db(), self._table_model, create_tables=True, drop_tables=True):
+            cache.get_cache().clear()
+            maths = model.Subject.create(name='maths')
+            art = model.Subject.create(name='art')
+            teacher = model.Teacher.create(**self._teacher_template)
+            student = model.Student.create(**dict(self._student_template, group='1'))
+            leaving = model.Student.create(**dict(self._student_template, group='1', username='leaving'))
+            grades = [model.Grade.create(student=graded, subject=subject, teacher=teacher, grade=grade)
+                      for graded, subject, grade in ((student, maths, '3'), (student, art, '5'), (leaving, maths, '4'))]
+            summaries.rebuild(model.get_db())
+            self.assertFalse(deletion.remove('subject', art.id, threshold=0))
+            self.assertFalse(deletion.remove('student', leaving.id, threshold=0))
+            with self.client.session_transaction() as session:
+                session.update(logged_in=True, type='T', user_id=teacher.id, username='test_teacher')
+
+            def api(url):
+                return json.loads(self.client.get('/api/v1/' + url).data.decode('utf-8'))
+
+            self.assertEqual(api('groups/')['items'], [{'group': '1', 'students': 1}])
+            self.assertEqual([grade['grade'] for grade in api('grades/')['items']], [3.0])
+            self.assertEqual(api('batch/grades?ids=' + ','.join(str(grade.id) for grade in grades))['missing'],
+                             [grades[1].id, grades[2].id])
+            resp = self.client.get('/api/v1/batch/grades?ids=' + ','.join(str(i) for i in range(1, 999)))
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(self.client.get('/group/1/export.csv').data.decode('utf-8').splitlines()[1:],
+                             ['1,test_student,test,test,maths,3,test_teacher'])
+            self.assertEqual([row[:3] for row in reports.group_statistics('1')], [('maths', 3, 1)])
+            self.assertEqual([(subject.name, [grade.id for grade in subject_grades])
+                              for subject, subject_grades in reports.grade_matrix(student)],
+                             [('maths', [grades[0].id])])
+            if analytics.numpy is not None:
+                report = analytics.group_report('1')
+                self.assertEqual([row[:2] for row in report.subject_rows()], [(maths, 1)])
+                self.assertEqual([row[0] for row in report.student_rows()], [student])
+            self.assertEqual(self.client.get('/student_profile/leaving').status_code, 404)
+
+            self.assertEqual(deletion.purge_chunk('subject', art.id), 1)
+            self.assertEqual(deletion.purge_chunk('student', leaving.id), 1)
+            self.assertEqual([(summary.student.id, summary.subject.id) for summary in model.GradeSummary.select()],
+                             [(student.id, maths.id)])
+            deletion.purge()
+            self.assertEqual(model.PendingDeletion.select().count(), 0)
+            cache.get_cache().clear()
+
+    @unittest.skipIf(analytics.numpy is None, 'numpy is not installed')
+    def test_db_group_analytics(self):
+        """Group statistics, student means and percentile ranks agree with the grades, alone or school-wide."""
+        with test_database(model.get_db(), self._table_model, create_tables=True, drop_tables=True):
+            maths = model.Subject.create(name='maths')
+            model.Subject.create(name='art')
+            teacher = model.Teacher.create(**self._teacher_template)
+            students = [model.Student.create(**dict(self._student_template, group='1', last_name=name,
+                                                    username=name.lower()))
+                        for name in ('A', 'B', 'C')]
+            other = model.Student.create(**dict(self._student_template, group='2', username='other'))
+            for student, grade in ((students[0], '2'), (students[0], '4'), (students[1], '5'), (students[2], '3'),
+                                   (other, '1')):
+                model.Grade.create(student=student, subject=maths, teacher=teacher, grade=grade)
+
+            report = analytics.group_report('1')
+            [(subject, count, mean, median, std, distribution)] = report.subject_rows()
+            self.assertEqual((subject.name, count, mean, median), ('maths', 4, 3.5, 3.5))
+            self.assertAlmostEqual(std, 1.118, places=3)
+            self.assertEqual(distribution, [0, 0, 1, 1, 1, 1, 0])
+            self.assertEqual([cells for student, cells in report.student_rows()],
+                             [[(3.0, 100 * 1.0 / 3)], [(5.0, 100 * 2.5 / 3)], [(3.0, 100 * 1.0 / 3)]])
+            self.assertEqual([school.to_dict() for school in analytics.group_reports()],
+                             [report.to_dict(), analytics.group_report('2').to_dict()])
+
+            with self.client.session_transaction() as session:
+                session.update(logged_in=True, type='T', user_id=teacher.id)
+            resp = self.client.get('/group/1/analytics')
+            self.assertIn(b'3.50', resp.data)
+
+    def test_db_report_cards(self):
+        """Every student gets a content-addressed card; a rerun continues after the manifest's last student."""
+        with test_database(model.get_db(), self._table_model, create_tables=True, drop_tables=True):
+            maths = model.Subject.create(name='maths')
+            model.Subject.create(name='art')
+            teacher = model.Teacher.create(**dict(self._teacher_template, first_name='Ann', last_name='Lee'))
+            first = model.Student.create(**self._student_template)
+            model.Student.create(**dict(self._student_template, username='no_grades'))
+            for grade in ('2', '5'):
+                model.Grade.create(student=first, subject=maths, teacher=teacher, grade=grade)
+            output = tempfile.mkdtemp()
+            try:
+                self.assertEqual(reportcards.generate(output, term='Winter', processes=2), 2)
+                with open(os.path.join(output, reportcards.MANIFEST)) as f:
+                    manifest = [line.split('\t') for line in f.read().splitlines()]
+                self.assertEqual([(student_id, username) for student_id, username, path in manifest],
+                                 [('1', 'test_student'), ('2', 'no_grades')])
+                with open(os.path.join(output, manifest[0][2])) as f:
+                    card = f.read()
+                self.assertIn('Winter', card)
+                self.assertIn('title="Ann Lee">5 , </div>', card)
+                self.assertIn('3.50', card)
+
+                self.assertEqual(reportcards.generate(output, processes=1), 0)
+                model.Student.create(**dict(self._student_template, username='late'))
+                self.assertEqual(reportcards.generate(output, term='Winter', processes=1), 1)
+                self.assertEqual(reportcards.generate(output, term='Winter', processes=1, restart=True), 3)
+            finally:
+                shutil.rmtree(output)
+
+    def test_db_grade_matrix(self):
+        """Grade matrix lists every subject, with student's grades grouped under the right one."""
+        with test_database(model.get_db(), self._table_model, create_tables=True, drop_tables=True):
+            test_subject_1 = model.Subject.create(name='test_subject1')
+            test_subject_2 = model.Subject.create(name='test_subject2')
+            test_teacher = model.Teacher.create(**self._teacher_template)
+            test_student = model.Student.create(**self._student_template)
+            for grade in ('1', '3'):
+                model.Grade.create(student=test_student, subject=test_subject_1, teacher=test_teacher, grade=grade)
+            matrix = reports.grade_matrix(test_student)
+            self.assertEqual([subject for subject, grades in matrix], [test_subject_1, test_subject_2])
+            self.assertEqual(sorted(grade.grade for grade in matrix[0][1]), [1, 3])
+            self.assertEqual(matrix[1][1], [])
+
+    def test_db_benchmark_seed(self):
+        """Benchmark dataset is seeded with requested sizes and valid references."""
+        with test_database(model.get_db(), self._table_model + [model.GradeSnapshot],
+                           create_tables=True, drop_tables=True):
+            benchmark.seed(model.get_db(), **benchmark.SCALES['tiny'])
+            self.assertEqual(model.Student.select().count(), benchmark.SCALES['tiny']['students'])
+            self.assertEqual(model.Grade.select().count(), benchmark.SCALES['tiny']['grades'])
+            self.assertEqual(model.Student.select(model.Student.group).distinct().count(),
+                             benchmark.SCALES['tiny']['groups'])
+            self.assertFalse(model.Grade.select().join(model.Student, JOIN.LEFT_OUTER).where(
+                model.Student.id >> None))
+            self.assertEqual(model.GradeEvent.select().count(), 0)  # seeded grades are a snapshot
+            self.assertEqual(migrations.run_migrations(model.get_db()), [])  # the schema is current
+            for table in ('snapshotgrade', 'person_search', 'schemamigration'):
+                model.get_db().execute_sql('DROP TABLE "{}"'.format(table))
+
+    def test_db_form_choices(self):
+        """Form choices are loaded on first use and stay cached until invalidated."""
+        with test_database(model.get_db(), self._table_model, create_tables=True, drop_tables=True):
+            cache.get_cache().clear()
+            model.Subject.create(name='test_subject')
+            with app.test_request_context():
+                self.assertIn(('test_subject', 'test_subject'), forms.AddSpecializationForm().subject_select.choices)
+                self.assertEqual(forms.AddGradeForm().subject_select.choices, [('', ''), ('test_subject', 'test_subject')])
+                model.Subject.create(name='other_subject')
+                self.assertNotIn(('other_subject', 'other_subject'), forms.subject_choices())
+                cache.get_cache().invalidate(cache.SUBJECT_CHOICES)
+                self.assertIn(('other_subject', 'other_subject'), forms.AddGradeForm().subject_select.choices)
+            cache.get_cache().clear()
+
+    def test_db_bulk_grading(self):
+        """Grades for a whole group are saved only if every filled row is valid."""
+        with test_database(model.get_db(), self._table_model, create_tables=True, drop_tables=True):
+            cache.get_cache().clear()
+            model.Subject.create(name='test_subject')
+            test_teacher = model.Teacher.create(**self._teacher_template)
+            students = [model.Student.create(first_name='test', last_name=str(i), group='1',
+                                             username='test_student{}'.format(i), password='test') for i in range(3)]
+            with self.client.session_transaction() as session:
+                session.update(logged_in=True, type='T', user_id=test_teacher.id, username=test_teacher.username)
+            data = {'subject_select': 'test_subject',
+                    'grade_{}'.format(students[0].id): '5',
+                    'grade_{}'.format(students[1].id): '7'}
+            resp = self.client.post('/group/1/', data=data)
+            self.assertIn(b'has to be between 0 and 6', resp.data)
+            self.assertIn(b'min="0" max="6" step="0.1"', resp.data)  # fractional grades can be typed in
+            self.assertEqual(model.Grade.select().count(), 0)
+            data['grade_{}'.format(students[1].id)] = '4'
+            self.client.post('/group/1/', data=data)
+            self.assertEqual(sorted(grade.grade for grade in model.Grade.select()), [4, 5])
+            cache.get_cache().clear()
+
+    def test_db_export_csv(self):
+        """Group export streams a header and one CSV row per grade of the group."""
+        with test_database(model.get_db(), self._table_model, create_tables=True, drop_tables=True):
+            test_subject = model.Subject.create(name='test_subject')
+            test_teacher = model.Teacher.create(**self._teacher_template)
+            test_student = model.Student.create(**dict(self._student_template, group='1'))
+            model.Student.create(**dict(self._student_template, group='2', username='other_student'))
+            model.Grade.create(student=test_student, subject=test_subject, teacher=test_teacher, grade='5')
+            with self.client.session_transaction() as session:
+                session.update(logged_in=True, type='T', user_id=test_teacher.id, username=test_teacher.username)
+            resp = self.client.get('/group/1/export.csv')
+            self.assertTrue(resp.is_streamed)
+            lines = resp.data.decode('utf-8').splitlines()
+            self.assertEqual(lines, ['group,student,first_name,last_name,subject,grade,teacher',
+                                     '1,test_student,test,test,test_subject,5,test_teacher'])
+
+    def test_db_import_students(self):
+        """Import creates valid rows and reports invalid ones and taken usernames per line."""
+        with test_database(model.get_db(), self._table_model, create_tables=True, drop_tables=True):
+            model.Student.create(**self._student_template)
+            csv_file = io.StringIO('first_name,last_name,group,username,password\n'
+                                   'a,b,1,new_student,secret\n'
+                                   'a,b,1,short_password,abc\n'
+                                   'a,b,1,test_student,secret\n')
+            with app.app_context():
+                report = importer.import_users('students', csv_file, workers=1)
+            self.assertEqual(report.created, 1)
+            self.assertEqual([(line, username) for line, username, message in report.errors],
+                             [(3, 'short_password'), (4, 'test_student')])
+            new_student = model.Student.get(model.Student.username == 'new_student')
+            self.assertEqual(hashpw(b'secret', new_student.password.encode('utf-8')),
+                             new_student.password.encode('utf-8'))
+
+    def test_db_grade_aggregates(self):
+        """Averages, group statistics and teacher counts are aggregated by the database."""
+        with test_database(model.get_db(), self._table_model, create_tables=True, drop_tables=True):
+            test_subject = model.Subject.create(name='test_subject')
+            test_teacher = model.Teacher.create(**self._teacher_template)
+            test_student = model.Student.create(**self._student_template)
+            for grade in (Decimal('4.5'), 5, 2):
+                model.Grade.create(student=test_student, subject=test_subject, teacher=test_teacher, grade=grade)
+                summaries.add_grades([(test_student.id, test_subject.id, grade)])
+            average, count = reports.student_averages(test_student)[test_subject.id]
+            self.assertAlmostEqual(float(average), 11.5 / 3)
+            self.assertEqual(count, 3)
+            [(name, mean, count, histogram)] = reports.group_statistics('test')
+            self.assertEqual((name, count), ('test_subject', 3))
+            self.assertEqual(histogram, [0, 0, 1, 0, 0, 2, 0])
+            self.assertEqual(reports.teacher_grade_counts(test_teacher), [('test_subject', 3)])
+
+    def test_db_grade_summaries(self):
+        """Summaries follow added and removed grades and match a rebuild from scratch."""
+        with test_database(model.get_db(), self._table_model, create_tables=True, drop_tables=True):
+            test_subject = model.Subject.create(name='test_subject')
+            test_teacher = model.Teacher.create(**self._teacher_template)
+            other_teacher = model.Teacher.create(**dict(self._teacher_template, username='other_teacher'))
+            test_student = model.Student.create(**dict(self._student_template, group='1'))
+            with self.client.session_transaction() as session:
+                session.update(logged_in=True, type='T', user_id=test_teacher.id, username='test_teacher')
+            for grade in ('4.5', '2', '5'):
+                self.client.post('/add_grade/', data=dict(student_select='test_student',
+                                                          subject_select='test_subject', grade=grade))
+            self.client.post('/group/1/', data={'subject_select': 'test_subject',
+                                                   'grade_{}'.format(test_student.id): '3'})
+            model.Grade.create(student=test_student, subject=test_subject, teacher=other_teacher, grade=6)
+            summaries.add_grades([(test_student.id, test_subject.id, 6)])
+
+            def current():
+                return list(model.GradeSummary.select(
+                    model.GradeSummary.count, model.GradeSummary.total, model.GradeSummary.lowest,
+                    model.GradeSummary.highest, model.GradeSummary.last_grade).tuples())
+
+            self.assertEqual(current(), [(5, Decimal('20.5'), Decimal('2'), Decimal('6'), Decimal('6'))])
+            self.assertEqual(summaries.rebuild(model.get_db()), 1)
+            self.assertEqual(current(), [(5, Decimal('20.5'), Decimal('2'), Decimal('6'), Decimal('6'))])
+            with self.client.session_transaction() as session:
+                session.update(logged_in=True, type='X')
+            self.client.post('/admin/teacher_profile/test_teacher/')
+            self.assertEqual(current(), [(1, Decimal('6'), Decimal('6'), Decimal('6'), Decimal('6'))])
+            self.client.post('/admin/student_profile/test_student/')
+            self.assertEqual(current(), [])
+
+    def test_db_numeric_grades_migration(self):
+        """Text grades of an old database are converted to numbers."""
+        with test_database(model.get_db(), [model.Student, model.Teacher, model.Subject],
+                           create_tables=True, drop_tables=True):
+            db = model.get_db()
+            db.execute_sql('CREATE TABLE grade (id INTEGER PRIMARY KEY, student_id INTEGER NOT NULL, '
+                           'subject_id INTEGER NOT NULL, teacher_id INTEGER NOT NULL, grade VARCHAR(255) NOT NULL)')
+            db.execute_sql("INSERT INTO grade (student_id, subject_id, teacher_id, grade) VALUES (1, 1, 1, '4.5')")
+            db.execute_sql("INSERT INTO grade (student_id, subject_id, teacher_id, grade) VALUES (1, 1, 1, 'A')")
+            with self.assertRaises(NonNumericGrades):  # it would become a 0
+                migrations.numeric_grades(db)
+            self.assertEqual(db.execute_sql('SELECT grade FROM grade ORDER BY id').fetchall(), [('4.5',), ('A',)])
+            db.execute_sql("DELETE FROM grade WHERE grade = 'A'")
+            self.assertTrue(migrations.numeric_grades(db))
+            self.assertFalse(migrations.numeric_grades(db))
+            self.assertEqual(db.execute_sql('SELECT grade, typeof(grade) FROM grade').fetchall(), [(4.5, 'real')])
+            self.assertEqual(model.Grade.get().grade, Decimal('4.5'))
+
+    def test_db_migration_history(self):
+        """An old database is migrated once, in batches, and every migration which ran is recorded with its duration."""
+        tables = [model.Student, model.Teacher, model.Subject, model.TeacherSubject, model.Grade,
+                  model.GradeSummary, model.ResourceVersion, model.PendingDeletion, model.SchemaMigration,
+                  model.GradeEvent, model.GradeSnapshot]
+        with test_database(model.get_db(), [model.Student, model.Teacher, model.Subject, model.TeacherSubject],
+                           create_tables=True, drop_tables=False):
+            db = model.get_db()
+            db.execute_sql('CREATE TABLE grade (id INTEGER PRIMARY KEY, student_id INTEGER NOT NULL, '
+                           'subject_id INTEGER NOT NULL, teacher_id INTEGER NOT NULL, grade VARCHAR(255) NOT NULL)')
+            db.execute_sql('CREATE INDEX grade_student_id ON grade (student_id)')  # of the old foreign key
+            for student_id, grade in ((1, '4.5'), (1, '2'), (2, '3'), (3, '5')):
+                db.execute_sql('INSERT INTO grade (student_id, subject_id, teacher_id, grade) VALUES (?, 1, 1, ?)',
+                               [student_id, grade])
+            batch_size = migrations.BATCH_SIZE
+            migrations.BATCH_SIZE = 2
+            try:
+                applied = migrations.run_migrations(db)
+                self.assertEqual(db.execute_sql('SELECT grade FROM grade ORDER BY id').fetchall(),
+                                 [(4.5,), (2,), (3,), (5,)])
+                self.assertEqual(db.execute_sql('SELECT student_id, count, total FROM gradesummary '
+                                                'ORDER BY student_id').fetchall(), [(1, 2, 6.5), (2, 1, 3), (3, 1, 5)])
+                self.assertEqual(migrations._indexes(db, 'grade'),
+                                 {'grade_student_id_subject_id', 'grade_subject_id_student_id'})
+            finally:
+                migrations.BATCH_SIZE = batch_size
+                db.drop_tables(tables, safe=True)
+                db.execute_sql('DROP TABLE IF EXISTS person_search')
+                db.execute_sql('DROP TABLE IF EXISTS snapshotgrade')
+            self.assertEqual(applied[:3], ['numeric_grades', 'composite_indexes', 'grade_summaries'])
+            self.assertNotIn('initial_schema', applied)
+            self.assertNotIn('change_log', applied)  # created by setUpModule
+        with test_database(model.get_db(), tables, create_tables=True, drop_tables=True):
+            db = model.get_db()
+            model.Grade.create(student=1, subject=1, teacher=1, grade='4')
+            self.assertTrue(migrations.grade_summaries(db))  # an interrupted fill is completed
+            self.assertFalse(migrations.grade_summaries(db))
+            self.assertEqual(model.GradeSummary.get().count, 1)
+            self.assertEqual(migrations.run_migrations(db), ['search_index', 'grade_audit_log'])
+            self.assertEqual(migrations.run_migrations(db), [])
+            recorded = migrations.applied_migrations(db)
+            self.assertEqual(sorted(recorded), ['grade_audit_log', 'search_index'])  # the others had nothing to do
+            self.assertTrue(all(record.seconds >= 0 for record in recorded.values()))
+            db.execute_sql('DROP TABLE person_search')
+            db.execute_sql('DROP TABLE snapshotgrade')
+
+    def test_db_grade_audit_log(self):
+        """Every change of a grade is logged; grades of any moment are rebuilt from snapshots and the log."""
+        with test_database(model.get_db(), self._table_model + [model.GradeSnapshot],
+                           create_tables=True, drop_tables=True):
+            db = model.get_db()
+            cache.get_cache().clear()
+            try:
+                self.assertTrue(migrations.grade_audit_log(db))
+                self.assertFalse(migrations.grade_audit_log(db))
+                model.Subject.create(name='maths')
+                teacher = model.Teacher.create(**self._teacher_template)
+                student = model.Student.create(**dict(self._student_template, group='1'))
+                with self.client.session_transaction() as session:
+                    session.update(logged_in=True, type='T', user_id=teacher.id, username='test_teacher')
+                self.client.post('/add_grade/', data=dict(student_select='test_student', subject_select='maths',
+                                                          grade='4'))
+                sleep(0.01)
+                first_graded = datetime.now()
+                sleep(0.01)
+                audit.take_snapshot(db)
+                self.client.post('/group/1/', data={'subject_select': 'maths',
+                                                    'grade_{}'.format(student.id): '5'})
+                batch_size, batch_pause = migrations.BATCH_SIZE, migrations.BATCH_PAUSE
+                migrations.BATCH_SIZE, migrations.BATCH_PAUSE = 1, 0
+                try:
+                    snapshot = audit.take_snapshot(db)  # a grade per batch
+                finally:
+                    migrations.BATCH_SIZE, migrations.BATCH_PAUSE = batch_size, batch_pause
+                self.assertIsNotNone(snapshot.completed_at)
+                self.assertEqual(db.execute_sql('SELECT COUNT(*) FROM snapshotgrade WHERE snapshot_id = ?',
+                                                [snapshot.id]).fetchone(), (2,))
+                model.GradeSnapshot.create(event_id=0, term=0, taken_at=0)  # interrupted, never used
+                model.Grade.update(grade=3).where(model.Grade.grade == 4).execute()
+                sleep(0.01)
+                edited = datetime.now()
+                sleep(0.01)
+                resp = self.client.get('/api/v1/audit/students/{}?as_of={}'.format(student.id, date.today()))
+                self.assertEqual([grade['grade'] for grade in json.loads(resp.data.decode('utf-8'))['grades']],
+                                 [3, 5])
+                deletion.delete_now('student', student.id)
+
+                self.assertEqual([(event.action, event.grade, event.previous) for event in audit.events(student.id)],
+                                 [(audit.CREATED, 4, None), (audit.CREATED, 5, None), (audit.CHANGED, 3, 4),
+                                  (audit.DELETED, None, 3), (audit.DELETED, None, 5)])
+                self.assertEqual(audit.events(student.id, audit.term_of(date.today())).count(), 5)
+                grades_as_of = lambda moment: [grade['grade'] for grade in audit.grades_as_of(student.id, moment)]
+                self.assertEqual(grades_as_of(first_graded), [4])
+                self.assertEqual(grades_as_of(edited), [3, 5])
+                self.assertEqual(grades_as_of(date.today()), [])
+                with self.assertRaises(HistoryUnavailable):
+                    audit.grades_as_of(student.id, date(2000, 1, 1))
+                with self.assertRaises(IntegrityError):
+                    db.execute_sql('DELETE FROM gradeevent')
+                self.assertFalse(db.execute_sql("SELECT 1 FROM sqlite_master WHERE name = 'grade_audit_insert'")
+                                 .fetchone())  # grades are logged per statement
+                self.assertEqual(audit.term_name(audit.term_of(date(2018, 1, 31))), '2017/18 winter')
+                self.assertEqual(audit.term_name(audit.term_of(date(2018, 2, 1))), '2017/18 summer')
+            finally:
+                db.execute_sql('DROP TABLE IF EXISTS snapshotgrade')
+                cache.get_cache().clear()
+
+    def test_db_unique_specialization(self):
+        """A teacher can have each specialization only once."""
+        with test_database(model.get_db(), self._table_model, create_tables=True, drop_tables=True):
+            test_subject = model.Subject.create(name='test_subject')
+            test_teacher = model.Teacher.create(**self._teacher_template)
+            model.TeacherSubject.create(teacher=test_teacher, specialization=test_subject)
+            with self.assertRaises(IntegrityError):
+                with model.get_db().transaction():
+                    model.TeacherSubject.create(teacher=test_teacher, specialization=test_subject)
+            with self.client.session_transaction() as session:
+                session.update(logged_in=True, type='X')
+            resp = self.client.post('/admin/add_specialization/test_teacher/', data={'subject_select': 'test_subject'})
+            self.assertIn(b'Teacher already has this specialization', resp.data)
+            self.assertEqual(model.TeacherSubject.select().count(), 1)
+
+    def test_db_session_identity(self):
+        """Pages needing only the group read it from the session, until admin edits the student."""
+        with test_database(model.get_db(), self._table_model, create_tables=True, drop_tables=True):
+            test_student = model.Student.create(**self._student_template)
+            with self.client.session_transaction() as session:
+                session.update(logged_in=True, type='S', user_id=test_student.id, username='test_student')
+            self.assertIn(b'Group test', self.client.get('/group/').data)  # loads the student, stores a snapshot
+            statements = []
+            model.get_db().listeners.append(lambda sql, params, seconds: statements.append(sql))
+            try:
+                self.client.get('/group/')
+            finally:
+                model.get_db().listeners.pop()
+            self.assertFalse([sql for sql in statements if 'FROM "student" AS' in sql and 'LIMIT' in sql])
+            admin = app.test_client()
+            with admin.session_transaction() as session:
+                session.update(logged_in=True, type='X')
+            admin.post('/admin/student_profile/test_student/edit/',
+                       data=dict(first_name='test', last_name='test', group='other'))
+            self.assertIn(b'Group other', self.client.get('/group/').data)
+
+    def test_db_login(self):
+        """Wrong passwords and unknown usernames get the same answer."""
+        with test_database(model.get_db(), self._table_model, create_tables=True, drop_tables=True):
+            student = dict(self._student_template, password=hashpw(b'test', gensalt(4)).decode('utf-8'))
+            model.Student.create(**student)
+            resp = self.client.post('/student_login/', data=dict(username='test_student', password='wrong'))
+            self.assertIn(b'Wrong username or password', resp.data)
+            resp = self.client.post('/student_login/', data=dict(username='nobody', password='wrong'))
+            self.assertIn(b'Wrong username or password', resp.data)
+            resp = self.client.post('/student_login/', data=dict(username='test_student', password='test'))
+            self.assertEqual(resp.status_code, 302)
+
+    def test_db_admin_pagination(self):
+        """Listings are walked page by page in both directions, keeping sort and filters."""
+        with test_database(model.get_db(), self._table_model, create_tables=True, drop_tables=True):
+            for i, last_name in enumerate(['Cole', 'Adams', 'Baker', 'Adams', 'Dunn']):
+                model.Student.create(**dict(self._student_template, last_name=last_name, group=str(i % 2),
+                                            username='student{}'.format(i)))
+            with self.client.session_transaction() as session:
+                session.update(logged_in=True, type='X')
+
+            def usernames(page):
+                return [student.username for student in page.items]
+
+            with app.test_request_context('/admin/students/?per_page=2'):
+                first = pagination.paginate(model.Student, model.Student.select(), admin._student_orders)
+            self.assertEqual(usernames(first), ['student1', 'student3'])
+            self.assertIsNone(first.previous_url)
+            with app.test_request_context(first.next_url):
+                second = pagination.paginate(model.Student, model.Student.select(), admin._student_orders)
+            self.assertEqual(usernames(second), ['student2', 'student0'])
+            with app.test_request_context(second.next_url):
+                third = pagination.paginate(model.Student, model.Student.select(), admin._student_orders)
+            self.assertEqual(usernames(third), ['student4'])
+            self.assertIsNone(third.next_url)
+            with app.test_request_context(third.previous_url):
+                back = pagination.paginate(model.Student, model.Student.select(), admin._student_orders)
+            self.assertEqual(usernames(back), ['student2', 'student0'])
+            self.assertEqual(back.total, 5)
+
+            resp = self.client.get('/admin/students/?group=1&sort=username&per_page=1')
+            self.assertIn(b'student1', resp.data)
+            self.assertNotIn(b'student3', resp.data)
+            self.assertIn(b'2 in total', resp.data)
+            self.assertIn(b'after=', resp.data)
+            self.assertEqual(self.client.get('/admin/students/?after=nonsense').status_code, 400)
+
+    def test_db_search(self):
+        """Students and teachers are found by prefixes of their names, kept in sync by triggers."""
+        with test_database(model.get_db(), self._table_model, create_tables=True, drop_tables=True):
+            db = model.get_db()
+            db.execute_sql('DROP TABLE IF EXISTS person_search')
+            model.Student.create(**dict(self._student_template, first_name='Anna', last_name='Smith'))
+            self.assertTrue(search.create_search_index(db))
+            model.Teacher.create(**dict(self._teacher_template, first_name='Annabel', last_name='Jones'))
+            self.assertEqual(sorted(person['username'] for person in search.search('ann')),
+                             ['test_student', 'test_teacher'])
+            self.assertEqual(search.search('ann sm'), [dict(kind='student', id=1, first_name='Anna', last_name='Smith',
+                                                            username='test_student', group='test')])
+            self.assertEqual(search.search('ann', kinds=['teacher'])[0]['last_name'], 'Jones')
+            model.Student.update(last_name='Brown').execute()
+            self.assertEqual(search.search('smith'), [])
+            with self.client.session_transaction() as session:
+                session.update(logged_in=True, type='X')
+            resp = self.client.get('/search/?q=brown&format=json')
+            self.assertEqual(json.loads(resp.data.decode('utf-8'))['results'][0]['username'], 'test_student')
+            model.Student.delete().execute()
+            self.assertEqual(search.search('anna', kinds=['student']), [])
+            db.execute_sql('DROP TABLE person_search')
+
+    def test_db_json_api(self):
+        """The JSON API selects fields, follows cursors, loads related records and resolves batches of ids."""
+        with test_database(model.get_db(), self._table_model, create_tables=True, drop_tables=True):
+            self.assertEqual(self.client.get('/api/v1/students/').status_code, 401)
+            with self.client.session_transaction() as session:
+                session.update(logged_in=True, type='T')
+            subject = model.Subject.create(name='Maths')
+            teacher = model.Teacher.create(**self._teacher_template)
+            model.TeacherSubject.create(teacher=teacher, specialization=subject)
+            for i in range(3):
+                student = model.Student.create(**dict(self._student_template, group='1', last_name='S{}'.format(i),
+                                                      username='student{}'.format(i)))
+                model.Grade.create(student=student, subject=subject, teacher=teacher, grade='4')
+
+            def get(url):
+                resp = self.client.get(url)
+                self.assertEqual(resp.status_code, 200)
+                return json.loads(resp.data.decode('utf-8'))
+
+            first = get('/api/v1/students/?group=1&per_page=2&fields=username')
+            self.assertEqual(first['items'], [{'username': 'student0'}, {'username': 'student1'}])
+            self.assertEqual(first['total'], 3)
+            second = get(first['next'])
+            self.assertEqual(second['items'], [{'username': 'student2'}])
+            self.assertIsNone(second['next'])
+            self.assertEqual(self.client.get('/api/v1/students/?fields=password').status_code, 400)
+            self.assertEqual(get('/api/v1/groups/')['items'], [{'group': '1', 'students': 3}])
+            self.assertEqual(get('/api/v1/teachers/?fields=specializations')['items'],
+                             [{'specializations': ['Maths']}])
+            grades = get('/api/v1/students/student1?include=grades')['grades']
+            self.assertEqual([(grade['student'], grade['subject'], grade['grade']) for grade in grades],
+                             [('student1', 'Maths', 4.0)])
+            self.assertEqual(get('/api/v1/grades/?student=3')['items'][0]['teacher'], 'test_teacher')
+            batch = get('/api/v1/batch/students?ids=1,3,99&fields=username')
+            self.assertEqual(batch['items'], {'1': {'username': 'student0'}, '3': {'username': 'student2'}})
+            self.assertEqual(batch['missing'], [99])
+            self.assertEqual(self.client.get('/api/v1/batch/students?ids=a').status_code, 400)
+
+    def test_db_conditional_pages(self):
+        """Pages are answered with 304 until grades or records they show change."""
+        with test_database(model.get_db(), self._table_model, create_tables=True, drop_tables=True):
+            app.config['CONDITIONAL_PAGES'] = True
+            versions.clear_pages()
+            versions.create_version_triggers(model.get_db())
+            model.Subject.create(name='test_subject')
+            test_teacher = model.Teacher.create(**self._teacher_template)
+            test_student = model.Student.create(**self._student_template)
+            with self.client.session_transaction() as session:
+                session.update(logged_in=True, type='T', user_id=test_teacher.id, username='test_teacher')
+            resp = self.client.get('/student_profile/test_student')
+            etag = resp.headers['ETag']
+            resp = self.client.get('/student_profile/test_student', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b'')
+            self.client.post('/add_grade/', data=dict(student_select='test_student', subject_select='test_subject',
+                                                      grade='5'))
+            self.client.get('/')  # shows the flashed message
+            resp = self.client.get('/student_profile/test_student', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b'5', resp.data)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+            self.assertEqual(versions.get_versions(['student:test_student', 'group:test', 'teacher:test_teacher',
+                                                    'students', 'subjects', 'unknown']), [2, 2, 2, 1, 1, 0])
+            model.Subject.update(name='renamed').execute()
+            resp = self.client.get('/student_profile/test_student')
+            self.assertIn(b'renamed', resp.data)
+            with self.client.session_transaction() as session:
+                session.update(logged_in=True, type='X')
+            etag = self.client.get('/admin/students/').headers['ETag']
+            model.Student.update(first_name='edited').where(model.Student.id == test_student.id).execute()
+            resp = self.client.get('/admin/students/', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b'edited', resp.data)
+            teacher_version = versions.get_versions(['teacher:test_teacher'])[0]
+            self.client.post('/admin/student_profile/test_student/')  # grades have no triggers, removals bump owners
+            self.assertEqual(versions.get_versions(['teacher:test_teacher']), [teacher_version + 1])
+            self.assertFalse(model.get_db().execute_sql(
+                "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'grade'").fetchone())
+
+    def test_db_invalidation_bus(self):
+        """Keys published by one worker are dropped from caches of the others when they poll."""
+        with test_database(model.get_db(), self._table_model, create_tables=True, drop_tables=True):
+            model.ChangeEvent.delete().execute()
+            this_worker = invalidation.InvalidationBus(cache.Cache(), invalidation.DatabaseChangeLog(keep=3))
+            other_worker = invalidation.InvalidationBus(cache.Cache(), invalidation.DatabaseChangeLog(keep=3))
+            for bus in (this_worker, other_worker):
+                bus.poll(force=True)
+                bus.cache.get(cache.SUBJECT_CHOICES, lambda: 'old')
+                bus.cache.get(cache.identity_key('S', 1), lambda: 'old')
+                bus.cache.get(cache.identity_key('S', 2), lambda: 'old')
+            this_worker.publish(cache.identity_key('S', 1))
+            self.assertEqual(this_worker.cache.get(cache.identity_key('S', 1), lambda: 'new'), 'new')
+            self.assertEqual(other_worker.cache.get(cache.identity_key('S', 1), lambda: 'new'), 'old')
+            self.assertEqual(other_worker.poll(force=True), 1)
+            self.assertEqual(other_worker.cache.get(cache.identity_key('S', 1), lambda: 'new'), 'new')
+            self.assertEqual(other_worker.cache.get(cache.identity_key('S', 2), lambda: 'new'), 'old')
+            for i in range(5):  # more than the log keeps, so the other worker has to drop everything
+                this_worker.publish(cache.SUBJECT_CHOICES)
+            other_worker.poll(force=True)
+            self.assertEqual(other_worker.cache.get(cache.identity_key('S', 2), lambda: 'new'), 'new')
+            self.assertEqual(model.ChangeEvent.select().count(), 3)
+
+    def test_db_grade_feed(self):
+        """New grades reach subscribers of their student or group, missed ones are replayed on reconnection."""
+        with test_database(model.get_db(), self._table_model, create_tables=True, drop_tables=True):
+            test_subject = model.Subject.create(name='test_subject')
+            test_teacher = model.Teacher.create(**self._teacher_template)
+            test_student = model.Student.create(**self._student_template)
+            other_student = model.Student.create(**dict(self._student_template, username='other', group='other'))
+            grade_feed = feed.GradeFeed(poll_interval=3600)
+            latest = feed.latest_event_id()
+            student_queue = grade_feed.subscribe(lambda event: event['student_id'] == test_student.id, latest)
+            group_queue = grade_feed.subscribe(lambda event: event['group'] == 'other', latest)
+
+            def add_grade(student, grade):
+                created = model.Grade.create(student=student, subject=test_subject, teacher=test_teacher, grade=grade)
+                audit.log_grades(audit.CREATED, model.Grade.id == created.id)
+                return created
+
+            first = add_grade(test_student, 5)
+            latest_grade = add_grade(other_student, 3)
+            self.assertEqual(grade_feed.poll(), 2)
+            event = student_queue.get_nowait()
+            self.assertEqual((event['grade_id'], event['grade'], event['subject']), (first.id, '5', 'test_subject'))
+            self.assertTrue(student_queue.empty())
+            self.assertEqual(group_queue.get_nowait()['student'], 'other')
+
+            latest_grade.delete_instance()  # the next grade reuses its id, events do not
+            self.assertEqual(add_grade(test_student, 4).id, latest_grade.id)
+            self.assertEqual(grade_feed.poll(), 1)
+            self.assertEqual(student_queue.get_nowait()['grade'], '4')
+            with self.client.session_transaction() as session:
+                session.update(logged_in=True, type='S', user_id=test_student.id, username='test_student')
+            resp = self.client.get('/feed/', headers={'Last-Event-ID': str(event['id'])}, buffered=False)
+            self.assertEqual(resp.mimetype, 'text/event-stream')
+            chunk = next(iter(resp.response))
+            self.assertIn(b'event: grade', chunk)
+            self.assertIn(b'"grade": "4"', chunk)
+            resp.close()
+
+    def test_db_connection_pool(self):
+        """Connections get configured pragmas and are returned to the pool after each request."""
+        db = model.get_db()
+        if not db.is_closed():
+            db.close()
+        db.connect()
+        self.assertEqual(db.execute_sql('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEqual(db.execute_sql('PRAGMA busy_timeout').fetchone()[0], 5000)
+        db.close()
+        self.assertTrue(db.is_closed())
+        self.client.get('/student_profile/')  # not logged in, redirects
+        self.assertTrue(db.is_closed())
+
 
 class UserOperationsTest(unittest.TestCase):
     model.get_db().init('test_db.db')
@@ -167,7 +1004,8 @@ class UserOperationsTest(unittest.TestCase):
                          'last_name': 'test',
                          'username': 'test_teacher',
                          'password': 'test'}
-    _table_model = [model.Student, model.Teacher, model.Subject, model.Grade, model.TeacherSubject]
+    _table_model = [model.Student, model.Teacher, model.Subject, model.Grade, model.TeacherSubject,
+                    model.GradeSummary]
 
     # FIXME: passing data to form
     def login_student(self, login, password):
@@ -0,0 +1,101 @@
+"""Version stamps of resources and conditional responses derived from them.
+Triggers bump a ResourceVersion counter whenever rows behind a resource change, whichever code path
+changed them (views, imports, cascades). Grades, written and removed in bulk, have no triggers, which would
+bump three counters per row; code writing them calls bump_grade_versions once for the whole change.
+Read-mostly pages list the resources they show; one query for their versions then yields an ETag,
+answering 304 Not Modified or serving the page from a cache of rendered pages keyed on the same versions.
+
+Resources: 'student:<username>', 'group:<group>', 'teacher:<username>', 'students', 'teachers', 'subjects'."""
+from hashlib import sha1
+from flask import current_app, make_response, request, session
+from cache import PageCache
+from model import ResourceVersion, get_db, _sqlite_max_variables
+
+_bump = ('INSERT OR REPLACE INTO resourceversion (key, version) VALUES ({key}, '
+         'COALESCE((SELECT version FROM resourceversion WHERE key = {key}), 0) + 1);')
+_teacher_of = "(SELECT 'teacher:' || username FROM teacher WHERE id = {row}.teacher_id)"
+
+# table: keys bumped by a change of one of its rows, as SQL expressions over the row
+_resources = {
+    'student': ("'students'", "'student:' || {row}.username", "'group:' || {row}.\"group\""),
+    'teacher': ("'teachers'", "'teacher:' || {row}.username"),
+    'subject': ("'subjects'",),
+    'teachersubject': (_teacher_of,),
+}
+_trigger_template = '''CREATE TRIGGER IF NOT EXISTS {table}_version_{event} AFTER {event} ON "{table}" BEGIN
+    {body}
+END'''
+
+# keys of students, their groups and teachers, by ids
+_grade_keys = ("SELECT 'student:' || username AS key FROM student WHERE id IN ({students}) "
+               "UNION SELECT 'group:' || \"group\" FROM student WHERE id IN ({students}) "
+               "UNION SELECT 'teacher:' || username FROM teacher WHERE id IN ({teachers})")
+
+_pages = PageCache()
+
+
+def create_version_triggers(db):
+    """Creates triggers bumping versions of resources, unless they exist."""
+    with db.transaction():
+        for table, keys in _resources.items():
+            for event, rows in (('INSERT', ('new',)), ('DELETE', ('old',)), ('UPDATE', ('old', 'new'))):
+                body = '\n    '.join(_bump.format(key=key.format(row=row)) for row in rows for key in keys)
+                db.execute_sql(_trigger_template.format(table=table, event=event, body=body))
+
+
+def bump_versions(keys):
+    """Bumps versions of given resources, for changes no trigger sees."""
+    keys = list(keys)
+    db = get_db()
+    db.execute_sql('UPDATE resourceversion SET version = version + 1 WHERE key IN ({})'.format(
+        ', '.join('?' * len(keys))), keys)
+    db.execute_sql('INSERT OR IGNORE INTO resourceversion (key, version) VALUES {}'.format(
+        ', '.join(['(?, 1)'] * len(keys))), keys)
+
+
+def bump_grade_versions(student_ids, teacher_ids):
+    """Bumps versions of students, their groups and teachers, whose grades were added or removed,
+    with two statements per up to 333 ids of each. Called in the transaction changing the grades,
+    before the students or teachers themselves are removed."""
+    db = get_db()
+    student_ids = list(student_ids)
+    teacher_ids = list(teacher_ids)
+    size = _sqlite_max_variables // 3
+    for start in range(0, max(len(student_ids), len(teacher_ids)), size):
+        students = student_ids[start:start + size]
+        teachers = teacher_ids[start:start + size]
+        keys = _grade_keys.format(students=', '.join('?' * len(students)), teachers=', '.join('?' * len(teachers)))
+        params = students + students + teachers
+        db.execute_sql('UPDATE resourceversion SET version = version + 1 WHERE key IN ({})'.format(keys), params)
+        db.execute_sql('INSERT OR IGNORE INTO resourceversion (key, version) SELECT key, 1 FROM ({})'.format(keys),
+                       params)
+
+
+def get_versions(keys):
+    """Versions of given resources in the same order, 0 for those never changed. A single query."""
+    versions = dict(ResourceVersion.select(ResourceVersion.key, ResourceVersion.version)
+                    .where(ResourceVersion.key << list(keys)).tuples())
+    return [versions.get(key, 0) for key in keys]
+
+
+def conditional_page(keys, render):
+    """Response with the page returned by render, revalidated by versions of resources (keys) it shows.
+    A matching If-None-Match is answered with 304, without rendering; otherwise the page comes from
+    the page cache, rendered only if some version changed. The ETag covers the URL and the session's user,
+    since the layout depends on them. Pages with pending flash messages are neither cached nor revalidated."""
+    if not current_app.config['CONDITIONAL_PAGES'] or session.get('_flashes'):
+        return render()
+    versions = get_versions(keys)
+    etag = sha1(repr((request.full_path, session.get('type'), session.get('user_id'),
+                      list(zip(keys, versions)))).encode('utf-8')).hexdigest()
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(_pages.get(etag, render, current_app.config['PAGE_CACHE_SIZE']))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'  # revalidate on every use
+    return response
+
+
+def clear_pages():
+    _pages.clear()
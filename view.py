@@ -1,11 +1,21 @@
-from forms import StudentLoginForm, AddGradeForm, TeacherLoginForm
+from forms import StudentLoginForm, AddGradeForm, TeacherLoginForm, BulkGradeForm
 from forms import flash_errors
-from model import Student, Teacher, Subject, Grade, TeacherSubject
-from model import get_db
+from model import Student, Teacher, Subject, Grade, GradeEvent, TeacherSubject, MIN_GRADE, MAX_GRADE
+from model import get_db, insert_in_batches
+from summaries import add_grades
+from search import search, KINDS
+from versions import conditional_page, bump_grade_versions
+from audit import log_grades, last_grade_id, CREATED
+from deletion import not_scheduled
+from feed import event_stream, get_feed
+from reports import grade_matrix, student_averages, group_statistics, teacher_grade_counts, GRADE_SCALE
 from peewee import DatabaseError
-from bcrypt import hashpw
-from flask import flash, render_template, redirect, session, url_for
-from exceptions import WrongPassword
+from flask import abort, current_app, flash, g, jsonify, render_template, redirect, request, session, url_for
+from decimal import Decimal, InvalidOperation
+from cache import get_cache, identity_key
+from time import time
+from exceptions import WrongPassword, VerifierBusy
+from passwords import get_verifier
 
 
 """This module contains only methods, which are used in main file gradebook.py"""
@@ -13,11 +23,24 @@ from exceptions import WrongPassword
 db = get_db()
 
 
+_user_classes = {'S': Student, 'T': Teacher}
+
+
+def store_identity(user):
+    """Saves a snapshot of user's name (and group) in the signed session cookie."""
+    valid_since = get_cache().get(identity_key(session['type'], user.id), time)
+    session['identity'] = {'first_name': user.first_name,
+                           'last_name': user.last_name,
+                           'group': getattr(user, 'group', None),
+                           'issued': max(time(), valid_since)}
+
+
 def authorize_student(student):
     session['logged_in'] = True
     session['user_id'] = student.id
     session['username'] = student.username
     session['type'] = 'S'
+    store_identity(student)
 
 
 def authorize_teacher(teacher):
@@ -25,32 +48,56 @@ def authorize_teacher(teacher):
     session['user_id'] = teacher.id
     session['username'] = teacher.username
     session['type'] = 'T'
+    store_identity(teacher)
 
 
 def get_current_user():
-    """Returns an object of Student or Teacher class, whose credentials are currently saved in session."""
-    if session['logged_in']:
-        if session['type'] == 'S':
-            return Student.get(Student.username == session['username'])
-        elif session['type'] == 'T':
-            return Teacher.get(Teacher.username == session['username'])
+    """Returns an object of Student or Teacher class, whose credentials are currently saved in session.
+    It is loaded by primary key at most once per request."""
+    if 'current_user' not in g:
+        g.current_user = None
+        model_class = _user_classes.get(session.get('type')) if session.get('logged_in') else None
+        if model_class is not None:
+            g.current_user = model_class.get(model_class.id == session['user_id'])
+            if _valid_identity() is None:
+                store_identity(g.current_user)
+    return g.current_user
+
+
+def _valid_identity():
+    """Session snapshot, unless it is missing or was issued before the user was last edited by admin."""
+    snapshot = session.get('identity')
+    if snapshot and snapshot['issued'] >= get_cache().get(identity_key(session['type'], session['user_id']), time):
+        return snapshot
+
+
+def get_current_identity():
+    """Like get_current_user, but built from the session snapshot without a query, when the snapshot is valid.
+    Only id, names, username and group are filled in, so the object is meant for reading, never for saving."""
+    model_class = _user_classes.get(session.get('type')) if session.get('logged_in') else None
+    snapshot = _valid_identity() if model_class is not None and current_app.config['SESSION_IDENTITY'] else None
+    if 'current_user' in g or snapshot is None:
+        return get_current_user()
+    fields = dict(id=session['user_id'], username=session['username'],
+                  first_name=snapshot['first_name'], last_name=snapshot['last_name'])
+    if model_class is Student:
+        fields['group'] = snapshot['group']
+    return model_class(**fields)
 
 
 def student_login_():
     form = StudentLoginForm()
     if form.validate_on_submit():
+        student = Student.select().where(Student.username == form.username.data, not_scheduled('student')).first()
         try:
-            student = Student.get(username=form.username.data)
-            # adequate salt is stored in the password itself
-            stored_password = student.password.encode('utf-8')
-            password_to_check = form.password.data.encode('utf-8')
-            password = hashpw(password_to_check, stored_password)
-            if password != stored_password:
+            # unknown usernames cost a hash as well, so they are not told apart by the answer or its timing
+            if not get_verifier().verify(student.password if student is not None else None, form.password.data):
                 raise WrongPassword('Wrong password')
         except WrongPassword:
-            flash('Wrong password')
-        except Student.DoesNotExist:
             flash('Wrong username or password')
+        except VerifierBusy:
+            flash('Too many people are logging in right now, please try again in a moment.')
+            return render_template('student_login.html', form=form), 503
         else:
             authorize_student(student)
             return redirect(url_for('student_profile'))
@@ -59,56 +106,64 @@ def student_login_():
 
 
 def student_profile_():
-    student = get_current_user()
-    subjects = Subject.select()
-    grades = Grade.select().where(Grade.student == student)
-    return render_template('student_profile.html', student=student, subjects=subjects, grades=grades)
+    def render():
+        student = get_current_identity()
+        return render_template('student_profile.html', student=student, grade_matrix=grade_matrix(student),
+                               averages=student_averages(student))
+    return conditional_page(['student:' + session['username'], 'subjects'], render)
 
 
 def student_profile_foreign_(username):
-    student = Student.get(Student.username == username)
-    subjects = Subject.select()
-    grades = Grade.select().where(Grade.student == student)
-    return render_template('student_profile.html', student=student, subjects=subjects, grades=grades)
+    def render():
+        student = Student.select().where(Student.username == username, not_scheduled('student')).first()
+        if student is None:
+            abort(404)
+        return render_template('student_profile.html', student=student, grade_matrix=grade_matrix(student),
+                               averages=student_averages(student))
+    return conditional_page(['student:' + username, 'subjects'], render)
 
 
 def add_grade_():
     form = AddGradeForm()
     if form.validate_on_submit():
+        teacher = get_current_user()
         try:
             with db.transaction():
                 grade = Grade.create(
-                    student=Student.get(Student.username == form.student_select.data),
-                    subject=Subject.get(Subject.name == form.subject_select.data),
-                    teacher=get_current_user(),
+                    student=Student.get(Student.username == form.student_select.data, not_scheduled('student')),
+                    subject=Subject.get(Subject.name == form.subject_select.data, not_scheduled('subject')),
+                    teacher=teacher,
                     grade=form.grade.data
                 )
+                add_grades([(grade.student.id, grade.subject.id, grade.grade)])
+                bump_grade_versions([grade.student.id], [teacher.id])
+                log_grades(CREATED, Grade.id == grade.id)
+        except Student.DoesNotExist:
+            flash('There is no student ' + form.student_select.data)
         except DatabaseError:
             flash('An error occurred while adding a grade')
         else:
+            get_feed().notify()
             flash('Grade ' + str(grade.grade) + ' assigned to student ' + str(grade.student))
             return redirect(url_for('groups', group=grade.student.username))
     flash_errors(form)
-    students = Student.select()
     subjects = Subject.select()
-    return render_template('add_grade.html', students=students, subjects=subjects, form=form)
+    return render_template('add_grade.html', subjects=subjects, form=form)
 
 
 def teacher_login_():
     form = TeacherLoginForm()
     if form.validate_on_submit():
+        teacher = Teacher.select().where(Teacher.username == form.username.data, not_scheduled('teacher')).first()
         try:
-            teacher = Teacher.get(username=form.username.data)
-            # adequate salt is stored in the password itself
-            stored_password = teacher.password.encode('utf-8')
-            password_to_check = form.password.data.encode('utf-8')
-            password = hashpw(password_to_check, stored_password)
-            if password != stored_password:
+            # unknown usernames cost a hash as well, so they are not told apart by the answer or its timing
+            if not get_verifier().verify(teacher.password if teacher is not None else None, form.password.data):
                 raise WrongPassword('Wrong password')
         except WrongPassword:
-            flash('Wrong password')
-        except Teacher.DoesNotExist:
             flash('Wrong username or password')
+        except VerifierBusy:
+            flash('Too many people are logging in right now, please try again in a moment.')
+            return render_template('teacher_login.html', form=form), 503
         else:
             authorize_teacher(teacher)
             return redirect(url_for('teacher_profile'))
@@ -117,25 +172,129 @@ def teacher_login_():
 
 
 def teacher_profile_():
-    teacher = get_current_user()
-    specs = TeacherSubject.select().where(TeacherSubject.teacher == teacher)
-    return render_template('teacher_profile.html', teacher=teacher, specializations=specs)
+    def render():
+        teacher = get_current_identity()
+        specs = TeacherSubject.select(TeacherSubject, Subject).join(Subject).where(TeacherSubject.teacher == teacher)
+        return render_template('teacher_profile.html', teacher=teacher, specializations=specs,
+                               grade_counts=teacher_grade_counts(teacher))
+    return conditional_page(['teacher:' + session['username'], 'subjects'], render)
 
 
 def groups_():
-    student_groups = Student.select(Student.group).distinct().order_by(Student.group.asc())
-    return render_template('groups.html', student_groups=student_groups)
+    def render():
+        student_groups = (Student.select(Student.group).where(not_scheduled('student')).distinct()
+                          .order_by(Student.group.asc()))
+        return render_template('groups.html', student_groups=student_groups)
+    return conditional_page(['students'], render)
 
 
 def group_():
-    group_number = get_current_user().group
-    students = Student.select().where(Student.group == group_number)
-    return render_template('group.html', group=group_number, students=students)
+    group_number = get_current_identity().group
+
+    def render():
+        students = (Student.select().where(Student.group == group_number, not_scheduled('student'))
+                    .order_by(Student.last_name))
+        return render_template('group.html', group=group_number, students=students,
+                               statistics=group_statistics(group_number), grade_scale=GRADE_SCALE)
+    return conditional_page(['group:' + group_number, 'subjects'], render)
+
+
+def parse_group_grades(students, formdata):
+    """Reads 'grade_<student id>' inputs of the bulk grading form.
+    Returns (grades, errors): dicts of valid grades and of error messages, both keyed by student id.
+    Students with an empty input are skipped."""
+    grades = {}
+    errors = {}
+    for student in students:
+        value = formdata.get('grade_{}'.format(student.id), '').strip()
+        if not value:
+            continue
+        try:
+            grade = Decimal(value)
+        except InvalidOperation:
+            errors[student.id] = 'Grade of {} {} is not a number.'.format(student.first_name, student.last_name)
+            continue
+        if not grade.is_finite() or not MIN_GRADE <= grade <= MAX_GRADE:
+            errors[student.id] = 'Grade of {} {} has to be between {} and {}.'.format(
+                student.first_name, student.last_name, MIN_GRADE, MAX_GRADE)
+        else:
+            grades[student.id] = grade
+    return grades, errors
 
 
 def group_foreign_(group_number):
-    students = Student.select().where(Student.group == group_number)
-    return render_template('group.html', group=group_number, students=students)
+    """Group page for teachers, with a form grading every student of the group in one subject at once.
+    Nothing is saved unless all filled rows are valid; then all grades are written in one transaction."""
+    students = list(Student.select().where(Student.group == group_number, not_scheduled('student'))
+                    .order_by(Student.last_name))
+    form = BulkGradeForm()
+    errors = {}
+    if form.validate_on_submit():
+        grades, errors = parse_group_grades(students, request.form)
+        for message in errors.values():
+            flash(message)
+        if not grades and not errors:
+            flash('No grades to save.')
+        elif not errors:
+            teacher = get_current_user()
+            try:
+                with db.transaction():
+                    subject = Subject.get(Subject.name == form.subject_select.data, not_scheduled('subject'))
+                    rows = [{'student': student_id, 'subject': subject.id, 'teacher': teacher.id, 'grade': grade}
+                            for student_id, grade in grades.items()]
+                    last_id = last_grade_id()
+                    insert_in_batches(Grade, rows)
+                    add_grades((row['student'], row['subject'], row['grade']) for row in rows)
+                    bump_grade_versions(grades, [teacher.id])
+                    log_grades(CREATED, Grade.id > last_id)
+            except (DatabaseError, Subject.DoesNotExist):
+                flash('An error occurred while adding grades')
+            else:
+                get_feed().notify()
+                flash('{} grades of {} assigned to group {}'.format(len(grades), subject.name, group_number))
+                return redirect(url_for('group_foreign', group_number=group_number))
+    flash_errors(form)
+    return render_template('group.html', group=group_number, students=students, form=form, errors=errors,
+                           statistics=group_statistics(group_number), grade_scale=GRADE_SCALE)
+
+
+def student_feed_():
+    """Server-Sent Events with new grades of the logged in student."""
+    student_id = session['user_id']
+    return event_stream(lambda event: event['student_id'] == student_id, GradeEvent.student_id == student_id,
+                        request.headers.get('Last-Event-ID', type=int))
+
+
+def group_feed_(group_number):
+    """Server-Sent Events with new grades of students in a group."""
+    group = str(group_number)
+    return event_stream(lambda event: event['group'] == group, Student.group == group,
+                        request.headers.get('Last-Event-ID', type=int))
+
+
+def group_analytics_(group_number):
+    """Statistics of a group's grades per subject and of every student within the group (see analytics.py)."""
+    import analytics  # numpy takes long to import, the first analytics page does it
+    if analytics.numpy is None:
+        abort(404)
+    group = str(group_number)
+
+    def render():
+        return render_template('group_analytics.html', group=group, report=analytics.group_report(group),
+                               grade_scale=GRADE_SCALE)
+    return conditional_page(['group:' + group, 'subjects'], render)
+
+
+def search_():
+    """Students and teachers matching the 'q' argument, optionally limited to one 'kind'.
+    Answers with JSON for ?format=json (used by autocompletion) and with a page of links otherwise."""
+    text = request.args.get('q', '').strip()
+    kinds = [request.args['kind']] if request.args.get('kind') in KINDS else KINDS
+    limit = max(1, min(request.args.get('limit', 10, type=int), 50))
+    results = search(text, kinds, limit)
+    if request.args.get('format') == 'json':
+        return jsonify(results=results)
+    return render_template('search.html', query=text, results=results)
 
 
 def logout_():